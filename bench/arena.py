@@ -0,0 +1,88 @@
+"""Allocation throughput and peak RSS: the fixed arena in a mem buffer
+against an mmap-backed region, for rounds of small allocations followed
+by a reset. Needs nasm and ld on PATH.
+
+    python bench/arena.py [allocations per round] [rounds]
+"""
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+PROGRAM = """import "std.un"
+import "mem.un"
+
+mem buf {buf_size}
+mem status 4096
+
+fn main
+    {setup}
+    for round = 0; round < {rounds}; round = round + 1
+        for i = 0; i < {count}; i = i + 1
+            p = {alloc}
+            p[0] = 1
+        end
+        {reset}
+    end
+    ; report the peak RSS
+    fd = open("/proc/self/status", 0)
+    write(1, status, read(fd, status, 4096))
+    ret 0
+end
+"""
+
+VARIANTS = {
+    # the fixed arena has to be sized for the largest round up front
+    "fixed arena": {
+        "setup": "arena_init(buf, {arena_size})",
+        "alloc": "arena_alloc(buf, {size})",
+        "reset": "arena_reset(buf)",
+    },
+    "region": {
+        "setup": "r = region_new(4096)",
+        "alloc": "region_alloc(r, {size})",
+        "reset": "region_reset(r)",
+    },
+}
+
+
+def run(workdir, variant, count, rounds, size):
+    arena_size = count * size + 16
+    fields = {k: v.format(arena_size=arena_size, size=size) for k, v in variant.items()}
+    buf_size = arena_size if variant is VARIANTS["fixed arena"] else 16
+    with open(os.path.join(workdir, "bench.un"), "w") as f:
+        f.write(PROGRAM.format(buf_size=buf_size, rounds=rounds, count=count, **fields))
+    subprocess.run([sys.executable, os.path.join(ROOT, "main.py"), "bench.un"],
+                   cwd=workdir, check=True)
+    start = time.perf_counter()
+    result = subprocess.run([os.path.join(workdir, "out")], capture_output=True,
+                            text=True, check=True)
+    elapsed = time.perf_counter() - start
+    status = dict(line.split(":", 1) for line in result.stdout.splitlines())
+    return elapsed, int(status["VmHWM"].split()[0])
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    workdir = tempfile.mkdtemp()
+    try:
+        for name in ("std.un", "mem.un", "io.un"):
+            shutil.copy(os.path.join(ROOT, name), workdir)
+        print(f"{rounds} rounds of {count} allocations")
+        print(f"{'':>12} {'size':>5} {'ns/alloc':>9} {'peak RSS':>10}")
+        for size in (16, 64, 1000):
+            for name, variant in VARIANTS.items():
+                elapsed, rss = run(workdir, variant, count, rounds, size)
+                ns = elapsed / (count * rounds) * 1e9
+                print(f"{name:>12} {size:>5} {ns:>9.1f} {rss / 1024:>8.1f}MB")
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
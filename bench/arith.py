@@ -0,0 +1,79 @@
+"""Operations on constants: run time of loops that multiply, divide and
+take remainders by constants, with and without --no-arith-opt (imul and
+idiv for all of them). Uses nasm and ld when nasm is on PATH, else the
+builtin backend.
+
+    python bench/arith.py [iterations]
+"""
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+KERNELS = {
+    "x * 10": "t = t + x * 10",
+    "x * 7": "t = t + x * 7",
+    "x / 8": "t = t + x / 8",
+    "x / 10": "t = t + x / 10",
+    "x % 8": "t = t + x % 8",
+    "x % 1000": "t = t + x % 1000",
+    # digits of a number, as printing one does
+    "digits": """y = x
+        for y > 0
+            t = t + y % 10
+            y = y / 10
+        end""",
+}
+
+# argc keeps x unknown at compile time
+PROGRAM = """import "std.un"
+
+fn main(argc, argv)
+    t = 0
+    for i = 0; i < {iterations}; i = i + 1
+        x = i * argc - 12345
+        {kernel}
+    end
+    ret t - t
+end
+"""
+
+
+def run_time(workdir, source, flags, backend, repeat=3):
+    with open(os.path.join(workdir, "bench.un"), "w") as f:
+        f.write(source)
+    subprocess.run([sys.executable, os.path.join(ROOT, "main.py"), "--backend", backend,
+                    *flags, "bench.un"], cwd=workdir, check=True)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([os.path.join(workdir, "out")], check=True)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20_000_000
+    backend = "nasm" if shutil.which("nasm") else "builtin"
+    workdir = tempfile.mkdtemp()
+    try:
+        for name in ("std.un", "io.un", "mem.un"):
+            shutil.copy(os.path.join(ROOT, name), workdir)
+        print(f"{iterations} iterations, {backend} backend")
+        print(f"{'kernel':>10} {'imul/idiv':>10} {'reduced':>9} {'speedup':>8}")
+        for name, kernel in KERNELS.items():
+            source = PROGRAM.format(iterations=iterations, kernel=kernel)
+            before = run_time(workdir, source, ["--no-arith-opt"], backend)
+            after = run_time(workdir, source, [], backend)
+            print(f"{name:>10} {before:9.3f}s {after:8.3f}s {before / after:7.2f}x")
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""End-to-end build latency: nasm and ld against the builtin encoder, for
+a small program and for one with the whole standard library in use.
+Needs nasm and ld on PATH.
+
+    python bench/build.py [builds]
+"""
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+PROGRAMS = {
+    "hello": """import "std.un"
+
+fn main
+    print "hello\\n"
+    ret 0
+end
+""",
+    "main.un": None,  # the example program in the repository
+}
+
+
+def build_time(workdir, source, backend):
+    """Seconds for one build of source, from starting the compiler to
+    having ./out"""
+    out = os.path.join(workdir, "out")
+    if os.path.exists(out):
+        os.remove(out)
+    start = time.perf_counter()
+    subprocess.run([sys.executable, os.path.join(ROOT, "main.py"), "--backend", backend, source],
+                   cwd=workdir, check=True)
+    elapsed = time.perf_counter() - start
+    subprocess.run([out, os.path.join(ROOT, "main.un")], cwd=workdir, check=True,
+                   stdout=subprocess.DEVNULL)
+    return elapsed
+
+
+def main():
+    builds = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    workdir = tempfile.mkdtemp()
+    try:
+        for name in ("std.un", "io.un", "mem.un", "main.un"):
+            shutil.copy(os.path.join(ROOT, name), workdir)
+        print(f"median of {builds} builds")
+        print(f"{'program':>8} {'nasm+ld':>9} {'builtin':>9} {'speedup':>8}")
+        for name, source in PROGRAMS.items():
+            if source is not None:
+                with open(os.path.join(workdir, name + ".un"), "w") as f:
+                    f.write(source)
+                name += ".un"
+            times = {}
+            for backend in ("nasm", "builtin"):
+                times[backend] = statistics.median(
+                    build_time(workdir, name, backend) for _ in range(builds))
+            print(f"{name:>8} {times['nasm'] * 1000:>7.1f}ms {times['builtin'] * 1000:>7.1f}ms "
+                  f"{times['nasm'] / times['builtin']:>7.2f}x")
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
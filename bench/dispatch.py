@@ -0,0 +1,105 @@
+"""match dispatch: run time of a bytecode-interpreter loop switching on
+each opcode with a match statement against the same loop written as a
+chain of if/else blocks, for dense opcodes (a jump table) and for
+opcodes spread over 0-255 (a binary search). The bytecode is random and
+is run over and over: a 64-opcode program lets the branch predictor learn
+the sequence, a 4096-opcode one mostly does not. Uses nasm and ld when
+nasm is on PATH, else the builtin backend.
+
+    python bench/dispatch.py [millions of dispatches]
+"""
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+LENGTHS = (64, 4096)
+
+# argc seeds the bytecode so that nothing is known at compile time
+PROGRAM = """import "std.un"
+
+mem code {length}
+
+fn main(argc, argv)
+    seed = argc
+    for i = 0; i < {length}; i = i + 1
+        seed = seed * 1103515245 + 12345
+        x = seed / 65536
+        x = x - x / 1048576 * 1048576
+        code[i] = (x - x / {opcodes} * {opcodes}) * {spacing}
+    end
+    acc = 0
+    for r = 0; r < {rounds}; r = r + 1
+        for pc = 0; pc < {length}; pc = pc + 1
+            op = code[pc]
+{dispatch}
+        end
+    end
+    ret acc - acc
+end
+"""
+
+
+def match_dispatch(opcodes, spacing):
+    lines = ["            match op"]
+    for k in range(opcodes):
+        lines += [f"            case {k * spacing}", f"                acc = acc + {k + 1}"]
+    lines.append("            end")
+    return "\n".join(lines)
+
+
+def if_dispatch(opcodes, spacing):
+    lines = []
+    for k in range(opcodes):
+        indent = "    " * (3 + k)
+        lines += [f"{indent}if op == {k * spacing}", f"{indent}    acc = acc + {k + 1}"]
+        if k + 1 < opcodes:
+            lines.append(f"{indent}else")
+    for k in reversed(range(opcodes)):
+        lines.append("    " * (3 + k) + "end")
+    return "\n".join(lines)
+
+
+def run_time(workdir, source, backend, repeat):
+    with open(os.path.join(workdir, "bench.un"), "w") as f:
+        f.write(source)
+    subprocess.run([sys.executable, os.path.join(ROOT, "main.py"), "--backend", backend,
+                    "bench.un"], cwd=workdir, check=True)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([os.path.join(workdir, "out")], check=True)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def main():
+    dispatches = int(float(sys.argv[1]) * 1e6) if len(sys.argv) > 1 else 20 * 10**6
+    backend = "nasm" if shutil.which("nasm") else "builtin"
+    workdir = tempfile.mkdtemp()
+    try:
+        for name in ("std.un", "io.un", "mem.un"):
+            shutil.copy(os.path.join(ROOT, name), workdir)
+        print(f"{dispatches / 1e6:g}M dispatches, {backend} backend")
+        print(f"{'opcodes':>8} {'values':>7} {'program':>8} {'if chain':>9} {'match':>9} "
+              f"{'speedup':>8}")
+        for opcodes in (4, 16, 64):
+            for layout, spacing in (("dense", 1), ("spread", 256 // opcodes)):
+                for length in LENGTHS:
+                    times = [run_time(workdir, PROGRAM.format(
+                        length=length, rounds=dispatches // length, opcodes=opcodes,
+                        spacing=spacing, dispatch=gen(opcodes, spacing)), backend, 3)
+                        for gen in (if_dispatch, match_dispatch)]
+                    print(f"{opcodes:>8} {layout:>7} {length:>8} {times[0]:8.3f}s "
+                          f"{times[1]:8.3f}s {times[0] / times[1]:7.2f}x")
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""Loop optimization: instructions per iteration and run time with and
+without --no-loop-opt, for a few loop-heavy kernels. Needs nasm and ld on
+PATH.
+
+    python bench/loops.py [iterations]
+"""
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+KERNELS = {
+    # the counter only indexes the buffer, so it becomes a pointer
+    "scan": """
+fn kernel(s)
+    n = 0
+    for i = 0; s[i] != 0; i = i + 1
+        n = n + 1
+    end
+    ret n
+end
+""",
+    "fill": """
+fn kernel(s)
+    for i = 0; i < {length}; i = i + 1
+        s[i] = 1
+    end
+    ret 0
+end
+""",
+    # i * 24 becomes an addition per iteration
+    "products": """
+fn kernel(s)
+    t = 0
+    for i = 0; i < {length}; i = i + 1
+        t = t + i * 24
+    end
+    ret t
+end
+""",
+}
+
+PROGRAM = """import "std.un"
+
+mem buf {size}
+{kernel}
+fn main
+    for i = 0; i < {length}; i = i + 1
+        buf[i] = 97
+    end
+    for k = 0; k < {calls}; k = k + 1
+        kernel(buf)
+    end
+    ret 0
+end
+"""
+
+
+def loop_body(asm):
+    """Instructions from the loop start label to the jump back to it"""
+    lines = asm[asm.index("kernel:"):].splitlines()
+    start = next(i for i, line in enumerate(lines) if re.match(r"\.for_\w+:", line))
+    label = lines[start][:-1]
+    end = next(i for i, line in enumerate(lines)
+               if i > start and line.split()[-1:] == [label])
+    return [line for line in lines[start + 1:end + 1] if not line.endswith(":")]
+
+
+def run(workdir, source, flags):
+    """Build source, returning instructions per iteration and run seconds"""
+    with open(os.path.join(workdir, "bench.un"), "w") as f:
+        f.write(source)
+    subprocess.run([sys.executable, os.path.join(ROOT, "main.py"), *flags, "bench.un"],
+                   cwd=workdir, check=True)
+    with open(os.path.join(workdir, "out.asm")) as f:
+        insns = len(loop_body(f.read()))
+    start = time.perf_counter()
+    subprocess.run([os.path.join(workdir, "out")], check=True)
+    return insns, time.perf_counter() - start
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 100000000
+    length = 1000
+    calls = iterations // length
+    workdir = tempfile.mkdtemp()
+    try:
+        shutil.copy(os.path.join(ROOT, "std.un"), workdir)
+        print(f"{calls} calls of {length} iterations")
+        print(f"{'kernel':>8} {'insns before':>13} {'after':>6} {'time before':>12} {'after':>8}")
+        for name, kernel in KERNELS.items():
+            source = PROGRAM.format(kernel=kernel.format(length=length), size=length + 1,
+                                    length=length, calls=calls)
+            old_insns, old = run(workdir, source, ["--no-loop-opt"])
+            new_insns, new = run(workdir, source, [])
+            print(f"{name:>8} {old_insns:>13} {new_insns:>6} {old:>11.3f}s {new:>7.3f}s")
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
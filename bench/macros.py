@@ -0,0 +1,57 @@
+"""Macro expansion scaling: the old per-define str.replace loop against
+expand_macros, for growing define tables.
+
+    python bench/macros.py [lines]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from main import expand_macros, preprocess_and_import  # noqa: E402
+
+
+def replace_loop(source, defines):
+    """The expansion loop preprocess_and_import used before expand_macros"""
+    result = []
+    for line in source.split("\n"):
+        for name, value in defines.items():
+            if value:
+                line = line.replace(name, value)
+        result.append(line)
+    return "\n".join(result)
+
+
+def token_expand(source, defines):
+    return "\n".join(expand_macros(line, defines) for line in source.split("\n"))
+
+
+def make_source(n_defines, n_lines):
+    header = [f"#define CONST_{i} {i}" for i in range(n_defines)]
+    body = []
+    for i in range(n_lines):
+        body.append(f"    x{i} = CONST_{i % n_defines} + y * CONST_{(i * 7) % n_defines}")
+    return "\n".join(header), "\n".join(body)
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - start
+
+
+def main():
+    n_lines = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    print(f"{'defines':>8} {'replace loop':>14} {'expand_macros':>14} {'speedup':>8}")
+    for n_defines in (10, 100, 1000, 5000):
+        header, body = make_source(n_defines, n_lines)
+        defines = {}
+        preprocess_and_import(header, defines)
+        old = timed(replace_loop, body, defines)
+        new = timed(token_expand, body, defines)
+        print(f"{n_defines:>8} {old * 1000:>12.1f}ms {new * 1000:>12.1f}ms {old / new:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
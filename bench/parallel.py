@@ -0,0 +1,79 @@
+"""Code generation on a process pool: time to compile a program of
+thousands of functions with --jobs 1, 2, 4 and 8, checking that each
+gives the same assembly as the serial build. Runs the compiler in
+process and times compile_to_asm, so it needs neither nasm nor ld.
+
+    python bench/parallel.py [functions]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+import main as compiler  # noqa: E402
+
+FUNCTION = """
+noinline fn f{i}(n)
+    t = 0
+    for k = 0; k < n; k = k + 1
+        if k == {i}
+            print "hit {tag}\\n"
+        end
+        t = t + k * {i}
+    end
+    if t > 100
+        print "big {tag}\\n"
+    else
+        t = f{next}(n - 1)
+    end
+    ret t
+end
+"""
+
+
+def program(functions):
+    parts = ['import "std.un"\n']
+    for i in range(functions):
+        parts.append(FUNCTION.format(i=i, tag=i % 50, next=(i + 1) % functions))
+    parts.append("fn main\n    ret f0(3)\nend\n")
+    return "".join(parts)
+
+
+def compile_time(source, jobs):
+    """Seconds for compile_to_asm with jobs processes, and its output"""
+    compiler.fn_inline.clear()
+    compiler.fn_exported.clear()
+    program = compiler.parse_tokens(*compiler.tokenize(compiler.preprocess_and_import(source)))
+    compiler.codegen_jobs = jobs
+    start = time.perf_counter()
+    asm = compiler.compile_to_asm(program)
+    return time.perf_counter() - start, asm
+
+
+def main():
+    functions = int(sys.argv[1]) if len(sys.argv) > 1 else 4000
+    workdir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    try:
+        shutil.copy(os.path.join(ROOT, "std.un"), workdir)
+        os.chdir(workdir)
+        source = program(functions)
+        print(f"{functions} functions, {os.cpu_count()} CPUs")
+        print(f"{'jobs':>4} {'compile':>9} {'speedup':>8} {'output':>9}")
+        serial, reference = compile_time(source, 1)
+        print(f"{1:>4} {serial:>8.2f}s {1:>7.2f}x {'':>9}")
+        for jobs in (2, 4, 8):
+            elapsed, asm = compile_time(source, jobs)
+            same = "identical" if asm == reference else "DIFFERS"
+            print(f"{jobs:>4} {elapsed:>8.2f}s {serial / elapsed:>7.2f}x {same:>9}")
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
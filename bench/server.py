@@ -0,0 +1,97 @@
+"""Builds per second of one long-lived compiler against a process per
+build: every file compiled by its own main.py, all of them on one batch
+command line, and each sent to a --server over its Unix socket (once
+with a bare socket client, once through main.py --connect). Uses the
+builtin backend so that the compiler, not nasm, is measured.
+
+    python bench/server.py [builds]
+"""
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+MAIN = os.path.join(ROOT, "main.py")
+
+PROGRAM = """import "std.un"
+
+fn main
+    print "hello {i}\\n"
+    ret 0
+end
+"""
+
+
+def request(path, cwd, argv):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        conn.connect(path)
+        conn.sendall(json.dumps({"cwd": cwd, "argv": argv}).encode())
+        conn.shutdown(socket.SHUT_WR)
+        reply = b""
+        while chunk := conn.recv(65536):
+            reply += chunk
+    reply = json.loads(reply)
+    if reply["status"] != 0:
+        sys.exit(reply["stderr"])
+
+
+def timed(fn):
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+def main():
+    builds = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    workdir = tempfile.mkdtemp()
+    env = {**os.environ, "UN_CACHE_DIR": os.path.join(workdir, "cache")}
+    sock = os.path.join(workdir, "sock")
+    server = None
+    try:
+        for name in ("std.un", "io.un", "mem.un"):
+            shutil.copy(os.path.join(ROOT, name), workdir)
+        files = []
+        for i in range(builds):
+            files.append(f"p{i}.un")
+            with open(os.path.join(workdir, files[-1]), "w") as f:
+                f.write(PROGRAM.format(i=i))
+        flags = ["--backend", "builtin"]
+
+        def run(*argv):
+            subprocess.run([sys.executable, MAIN, *flags, *argv], cwd=workdir, env=env,
+                           check=True)
+
+        run(files[0])  # fill the import cache
+        server = subprocess.Popen([sys.executable, MAIN, "--server", sock], cwd=workdir, env=env)
+        while not os.path.exists(sock):
+            time.sleep(0.01)
+        request(sock, workdir, [*flags, files[0]])  # warm the server
+
+        times = {
+            "process per build": timed(lambda: [run(name) for name in files]),
+            "batch": timed(lambda: run(*files)),
+            "server": timed(lambda: [request(sock, workdir, [*flags, name]) for name in files]),
+            "server, main.py client": timed(lambda: [run("--connect", sock, name)
+                                                     for name in files]),
+        }
+        out = subprocess.run([os.path.join(workdir, "p7")], stdout=subprocess.PIPE, check=True)
+        assert out.stdout == b"hello 7\n", out.stdout
+
+        print(f"{builds} builds")
+        print(f"{'mode':>24} {'builds/s':>9} {'ms/build':>9}")
+        for mode, seconds in times.items():
+            print(f"{mode:>24} {builds / seconds:9.1f} {seconds / builds * 1000:9.2f}")
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""Buffered print against one write per print, for a million lines of
+output to a file. Needs nasm and ld on PATH, and Linux for the write
+syscall counts from /proc.
+
+    python bench/stdio.py [lines]
+"""
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+PROGRAM = """import "std.un"
+
+fn print_unbuffered(s)
+    write(1, s, strlen(s))
+    ret 0
+end
+
+fn main
+    for i = 0; i < {lines}; i = i + 1
+        {print} "line "
+        {print} "of output\\n"
+    end
+    ret 0
+end
+"""
+
+
+def build(workdir, print_fn, lines):
+    with open(os.path.join(workdir, "bench.un"), "w") as f:
+        f.write(PROGRAM.format(print=print_fn, lines=lines))
+    subprocess.run([sys.executable, os.path.join(ROOT, "main.py"), "bench.un"],
+                   cwd=workdir, check=True)
+    binary = os.path.join(workdir, print_fn)
+    os.replace(os.path.join(workdir, "out"), binary)
+    return binary
+
+
+def run(binary, output):
+    """Seconds and write syscalls for one run. A shell reaps the binary,
+    which adds its I/O counters to the shell's own."""
+    script = f'"{binary}" > "{output}"; cat /proc/$$/io'
+    start = time.perf_counter()
+    io = subprocess.run(["sh", "-c", script], capture_output=True, text=True, check=True)
+    elapsed = time.perf_counter() - start
+    counters = dict(line.split(": ") for line in io.stdout.splitlines())
+    return elapsed, int(counters["syscw"])
+
+
+def main():
+    lines = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    workdir = tempfile.mkdtemp()
+    try:
+        shutil.copy(os.path.join(ROOT, "std.un"), workdir)
+        output = os.path.join(workdir, "output.txt")
+        print(f"{lines} lines, 2 prints per line")
+        print(f"{'':>16} {'time':>9} {'writes':>9}")
+        for print_fn in ("print_unbuffered", "print"):
+            elapsed, writes = run(build(workdir, print_fn, lines), output)
+            print(f"{print_fn:>16} {elapsed:>8.3f}s {writes:>9}")
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
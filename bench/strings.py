@@ -0,0 +1,112 @@
+"""String routines: the SSE2 versions in std.un against plain byte loops,
+for growing string lengths. Needs nasm and ld on PATH.
+
+    python bench/strings.py [calls]
+"""
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# the byte-at-a-time versions, strlen_loop is what std.un used to ship
+LOOPS = """
+fn strlen_loop(s)
+    result = 0
+    for i = 0; s[i] != 0; i=i+1
+        result = result + 1
+    end
+    ret result
+end
+
+fn memchr_loop(p, c, n)
+    for i = 0; i < n; i = i + 1
+        if p[i] == c
+            ret p + i
+        end
+    end
+    ret 0
+end
+
+fn strcmp_loop(a, b)
+    for i = 0; a[i] == b[i]; i = i + 1
+        if a[i] == 0
+            ret 0
+        end
+    end
+    ret a[i] - b[i]
+end
+
+fn memcmp_loop(a, b, n)
+    for i = 0; i < n; i = i + 1
+        if a[i] != b[i]
+            ret a[i] - b[i]
+        end
+    end
+    ret 0
+end
+"""
+
+# each call walks the whole string: no early match or difference
+CALLS = {
+    "strlen": "strlen a",
+    "memchr": "memchr a, 0, LEN + 1",
+    "strcmp": "strcmp a, b",
+    "memcmp": "memcmp a, b, LEN",
+}
+
+
+def program(call, length, calls):
+    return f"""import "std.un"
+
+mem a {length + 1}
+mem b {length + 1}
+{LOOPS}
+fn main
+    for i = 0; i < {length}; i = i + 1
+        a[i] = 97
+        b[i] = 97
+    end
+    for k = 0; k < {calls}; k = k + 1
+        {call.replace("LEN", str(length))}
+    end
+    ret 0
+end
+"""
+
+
+def run(workdir, source):
+    """Build source and return the seconds the binary takes to run"""
+    with open(os.path.join(workdir, "bench.un"), "w") as f:
+        f.write(source)
+    subprocess.run([sys.executable, os.path.join(ROOT, "main.py"), "bench.un"],
+                   cwd=workdir, check=True)
+    start = time.perf_counter()
+    subprocess.run([os.path.join(workdir, "out")], check=True)
+    return time.perf_counter() - start
+
+
+def main():
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    workdir = tempfile.mkdtemp()
+    try:
+        shutil.copy(os.path.join(ROOT, "std.un"), workdir)
+        print(f"{'routine':>8} {'length':>7} {'byte loop':>11} {'std.un':>11} {'speedup':>8}")
+        for name, call in CALLS.items():
+            for length in (0, 7, 16, 64, 256, 1024, 4096):
+                empty = run(workdir, program("", length, calls))
+                old = run(workdir, program(call.replace(name, f"{name}_loop", 1), length, calls))
+                new = run(workdir, program(call, length, calls))
+                old_ns = max(old - empty, 0) / calls * 1e9
+                new_ns = max(new - empty, 0) / calls * 1e9
+                speedup = f"{old_ns / new_ns:>7.1f}x" if new_ns else f"{'-':>8}"
+                print(f"{name:>8} {length:>7} {old_ns:>9.1f}ns {new_ns:>9.1f}ns {speedup}")
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
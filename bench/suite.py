@@ -0,0 +1,290 @@
+"""Benchmark suite: compiler throughput on generated programs of growing
+size, and run time of compiled kernels. Writes the results as JSON so
+that two commits can be compared.
+
+Compile times are per phase, as the compiler's --time-passes reports
+them: preprocessing with imports, tokenizing, parsing, the AST passes,
+pass 1 (symbols and register allocation), pass 2 (code generation and
+peephole), .data and .bss, then nasm and ld, or the builtin encoder when
+nasm is not on PATH. Kernel instruction counts need perf; without it
+they are null.
+
+    python bench/suite.py [-o results.json] [--sizes 1,2,4,8] [--repeat 3]
+    python bench/suite.py --compare old.json [new.json]
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+import main as compiler  # noqa: E402
+
+# per unit of size: functions, define table entries and imported modules
+FUNCTIONS = 40
+DEFINES = 200
+IMPORT_DEPTH = 3
+
+FUNCTION = """
+fn f{i}(n)
+    t = 0
+    for a = 0; a < n; a = a + 1
+        for b = 0; b < a; b = b + 1
+            for c = 0; c < b; c = c + 1
+                if c == K{k}
+                    t = t + f{prev}(c) * 3
+                else
+                    t = t - c / 2
+                end
+            end
+        end
+    end
+    if t > 1000
+        print "f{i} overflow\\n"
+    end
+    ret t
+end
+"""
+
+MODULE = """#define DEPTH{level} {level}
+{imports}
+fn depth{level}()
+    ret DEPTH{level}
+end
+"""
+
+KERNELS = {
+    # the SSE2 strlen over a 1 MiB string, many times
+    "strlen": """import "std.un"
+
+mem buf 1048577
+
+fn main
+    for i = 0; i < 1048576; i = i + 1
+        buf[i] = 97
+    end
+    n = 0
+    for k = 0; k < 10000; k = k + 1
+        n = n + strlen(buf)
+    end
+    ret n - 10000 * 1048576
+end
+""",
+    # small allocations from a growable region, reset every round
+    "arena": """import "std.un"
+import "mem.un"
+
+fn main
+    r = region_new(4096)
+    for round = 0; round < 1000; round = round + 1
+        for i = 0; i < 50000; i = i + 1
+            p = region_alloc(r, 24)
+            p[0] = 1
+        end
+        region_reset(r)
+    end
+    ret 0
+end
+""",
+    # buffered print of many short lines
+    "print": """import "std.un"
+
+fn main
+    for i = 0; i < 10000000; i = i + 1
+        print "line "
+        print "of output\\n"
+    end
+    ret 0
+end
+""",
+    # arithmetic in nested loops, no calls
+    "loops": """import "std.un"
+
+fn main
+    t = 0
+    for i = 0; i < 100000; i = i + 1
+        for j = 0; j < 10000; j = j + 1
+            t = t + i * 24 - j
+        end
+    end
+    ret t - t
+end
+""",
+}
+
+
+def write_program(workdir, size):
+    """Write a program of the given size to workdir, returning the entry
+    file and what it contains"""
+    functions = FUNCTIONS * size
+    depth = IMPORT_DEPTH * size
+    for level in range(depth):
+        imports = f'import "mod{level + 1}.un"' if level + 1 < depth else ""
+        with open(os.path.join(workdir, f"mod{level}.un"), "w") as f:
+            f.write(MODULE.format(level=level, imports=imports))
+    parts = ['import "std.un"\n', 'import "mod0.un"\n']
+    parts += [f"#define K{k} {k % 7}\n" for k in range(DEFINES * size)]
+    parts += [FUNCTION.format(i=i, k=i * 13 % (DEFINES * size), prev=max(i - 1, 0))
+              for i in range(functions)]
+    # argc keeps the calls from being evaluated at compile time
+    parts.append(f"fn main(argc, argv)\n    ret f{functions - 1}(argc + 2) + depth0()\nend\n")
+    source = "".join(parts)
+    with open(os.path.join(workdir, "gen.un"), "w") as f:
+        f.write(source)
+    return "gen.un", {"size": size, "functions": functions, "defines": DEFINES * size,
+                      "import_depth": depth, "lines": source.count("\n")}
+
+
+def compile_phases(path, backend):
+    """Seconds and peak memory per phase, and the compiler's counts, for
+    one build of path in the working directory"""
+    compiler.pass_times.clear()
+    compiler.compile_stats.clear()
+    compiler.build(path, backend)
+    return dict(compiler.pass_times), dict(compiler.compile_stats)
+
+
+def bench_compile(workdir, sizes, repeat, backend):
+    results = []
+    for size in sizes:
+        path, info = write_program(workdir, size)
+        runs = [compile_phases(path, backend) for _ in range(repeat)]
+        phases = {name: statistics.median(times[name][0] for times, _ in runs)
+                  for name in runs[0][0]}
+        memory = {name: peak for name, (_, peak) in runs[-1][0].items()}
+        stats = {name: value for name, value in runs[-1][1].items() if name != "stack_slots"}
+        results.append({**info, "phases": phases, "total": sum(phases.values()),
+                        "peak_rss_kib": memory, "stats": stats})
+    return results
+
+
+def instructions(binary, workdir):
+    """User-space instructions retired by one run, or None without perf"""
+    if not shutil.which("perf"):
+        return None
+    result = subprocess.run(["perf", "stat", "-x,", "-e", "instructions:u", binary],
+                            cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                            text=True)
+    for line in result.stderr.splitlines():
+        fields = line.split(",")
+        if len(fields) > 2 and fields[2].startswith("instructions") and fields[0].isdigit():
+            return int(fields[0])
+    return None
+
+
+def bench_kernels(workdir, repeat, backend):
+    results = []
+    for name, source in KERNELS.items():
+        with open(os.path.join(workdir, "kernel.un"), "w") as f:
+            f.write(source)
+        subprocess.run([sys.executable, os.path.join(ROOT, "main.py"), "--backend", backend,
+                        "kernel.un"], cwd=workdir, check=True, env={**os.environ, "UN_CACHE": "0"})
+        binary = os.path.join(workdir, name)
+        os.replace(os.path.join(workdir, "out"), binary)
+        runs = []
+        for _ in range(repeat):
+            with open(os.path.join(workdir, "output"), "wb") as output:
+                start = time.perf_counter()
+                subprocess.run([binary], cwd=workdir, stdout=output, check=True)
+                runs.append(time.perf_counter() - start)
+        results.append({"kernel": name, "seconds": statistics.median(runs), "runs": runs,
+                        "instructions": instructions(binary, workdir)})
+    return results
+
+
+def commit():
+    result = subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True,
+                            text=True)
+    return result.stdout.strip() or None
+
+
+def ratio(new, old):
+    return f"{new / old:>6.2f}x" if old else f"{'':>7}"
+
+
+def compare(old, new):
+    """Print the new results against the old ones, as ratios new/old"""
+    print(f"{old['commit'] or '?':.10} -> {new['commit'] or '?':.10}")
+    sizes = {entry["size"]: entry for entry in old["compile"]}
+    for entry in new["compile"]:
+        base = sizes.get(entry["size"])
+        if base:
+            phases = " ".join(f"{name} {ratio(seconds, base['phases'].get(name, 0))}"
+                              for name, seconds in entry["phases"].items())
+            print(f"size {entry['size']:>3}: total {ratio(entry['total'], base['total'])}  "
+                  f"{phases}")
+    kernels = {entry["kernel"]: entry for entry in old["runtime"]}
+    for entry in new["runtime"]:
+        base = kernels.get(entry["kernel"])
+        if base:
+            insns = ""
+            if entry["instructions"] and base["instructions"]:
+                insns = f"  instructions {ratio(entry['instructions'], base['instructions'])}"
+            print(f"{entry['kernel']:>8}: time {ratio(entry['seconds'], base['seconds'])}{insns}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("-o", "--output", default="bench-results.json")
+    parser.add_argument("--sizes", default="1,2,4,8",
+                        help="program sizes, in units of %d functions" % FUNCTIONS)
+    parser.add_argument("--repeat", type=int, default=3, help="runs per measurement")
+    parser.add_argument("--compare", nargs="+", metavar="JSON",
+                        help="compare old results with new ones, or with a fresh run")
+    args = parser.parse_args()
+
+    if args.compare and len(args.compare) == 2:
+        with open(args.compare[0]) as f, open(args.compare[1]) as g:
+            compare(json.load(f), json.load(g))
+        return
+
+    backend = "nasm" if shutil.which("nasm") else "builtin"
+    workdir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    try:
+        for name in ("std.un", "io.un", "mem.un"):
+            shutil.copy(os.path.join(ROOT, name), workdir)
+        # imports are found relative to the working directory
+        os.chdir(workdir)
+        sizes = [int(size) for size in args.sizes.split(",")]
+        results = {
+            "commit": commit(),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+            "backend": backend,
+            "compile": bench_compile(workdir, sizes, args.repeat, backend),
+            "runtime": bench_kernels(workdir, args.repeat, backend),
+        }
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"{'size':>4} {'fns':>5} {'lines':>6} " + " ".join(
+        f"{name:>10}" for name in results["compile"][0]["phases"]) + f" {'total':>8}")
+    for entry in results["compile"]:
+        print(f"{entry['size']:>4} {entry['functions']:>5} {entry['lines']:>6} " + " ".join(
+            f"{seconds * 1000:>8.1f}ms" for seconds in entry["phases"].values())
+            + f" {entry['total']:>7.2f}s")
+    for entry in results["runtime"]:
+        insns = entry["instructions"]
+        print(f"{entry['kernel']:>8} {entry['seconds']:>8.3f}s "
+              f"{insns if insns is not None else '-':>14} instructions")
+    print(f"results in {args.output}")
+    if args.compare:
+        with open(args.compare[0]) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,22 @@
+import argparse
+import collections
+import concurrent.futures
+import hashlib
+import io
+import json
+import multiprocessing
+import os
 import re
+import resource
+import select
+import signal
+import socket
+import struct
 import subprocess
 import sys
+import tempfile
+import time
+import traceback
 
 # prog = """
 # fn strlen(s)
@@ -18,15 +34,24 @@ import sys
 # end
 # """
 
-def preprocess_and_import(source, defines=None, included=None):
-    """Preprocess and expand imports together, so defines work across files"""
+def preprocess_and_import(source, defines=None, included=None, modules=None, chunks=None):
+    """Preprocess and expand imports together, so defines work across files.
+
+    If modules is a list, imports are not inlined: each imported file is
+    preprocessed on its own and appended to modules as (filename, text),
+    nested imports before the files that import them. When chunks is
+    given, the result is also appended to it as (text, imported) pieces,
+    so tokenize_program can reuse the token streams of the imports.
+    """
     if defines is None:
         defines = {}
     if included is None:
         included = set()
 
     result = []
+    imports = []  # indexes in result of the imported texts
     cond_stack = []  # stack of (active, seen_true) tuples
+    in_asm = False
 
     for line in source.split("\n"):
         stripped = line.strip()
@@ -83,65 +108,426 @@ def preprocess_and_import(source, defines=None, included=None):
 
             if filename not in included:
                 included.add(filename)
-                with open(filename) as f:
-                    imported = f.read()
-                # Recursively process import with current defines
-                imported_result = preprocess_and_import(imported, defines, included)
-                result.append(imported_result)
+                text = import_file(filename, defines, included, modules)
+                if modules is None:
+                    imports.append(len(result))
+                    result.append(text)
+                else:
+                    modules.append((filename, text))
             continue
 
         # Regular line - include if active, with macro substitution
+        # outside of asm blocks
         if active:
-            for name, value in defines.items():
-                if value:
-                    line = line.replace(name, value)
+            if in_asm:
+                in_asm = stripped != "end"
+            elif stripped == "asm":
+                in_asm = True
+            elif defines:
+                line = expand_macros(line, defines)
             result.append(line)
 
+    if chunks is not None:
+        start = 0
+        for i in imports + [len(result)]:
+            if start < i:
+                chunks.append(("\n".join(result[start:i]), False))
+            if i < len(result):
+                chunks.append((result[i], True))
+            start = i + 1
     return "\n".join(result)
 
 
-file = open(sys.argv[1])
-prog = preprocess_and_import(file.read())
-
-# --- Scanner ---
+MACRO_RE = re.compile(r'"(?:[^"\\]|\\.)*"?|\w+')
+
+
+def expand_macros(line, defines, expanding=frozenset()):
+    """Replace whole identifiers that name a define, skipping string
+    literals. The replacement is rescanned, but a macro is never expanded
+    inside its own expansion."""
+
+    def replace(m):
+        word = m.group()
+        value = defines.get(word)
+        if not value or word in expanding:
+            return word
+        return expand_macros(value, defines, expanding | {word})
+
+    return MACRO_RE.sub(replace, line)
+
+
+# --- Import cache ---
+def file_hash(data):
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+# hashed into every cache key so a compiler change invalidates old entries
+with open(__file__) as f:
+    COMPILER_HASH = file_hash(f.read())
+
+
+class ImportCache:
+    """Content-addressed on-disk cache of preprocessed imports.
+
+    Entries are keyed on the file content, the active defines and the set
+    of already included files. Object files of separately compiled modules
+    are kept next to them as <key>.o. Each entry holds the expanded text and
+    its token stream, the defines after the import and the files it pulled
+    in, together with their content hashes so that a changed nested import
+    is a miss. The least recently used entries are evicted once the
+    directory grows past max_bytes. A long-lived compiler (batch mode,
+    --server) also keeps the entries it has seen in memory, so a warm
+    import is neither reread nor retokenized.
+    """
+
+    MEMORY_ENTRIES = 256
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.memory = {}  # key -> entry, oldest first
+        self.reset_counters()
+        os.makedirs(path, exist_ok=True)
+
+    def reset_counters(self):
+        self.hits = 0
+        self.misses = 0
+        self.object_hits = 0
+        self.object_misses = 0
+        self.evictions = 0
+
+    def key(self, *state):
+        return file_hash(json.dumps([COMPILER_HASH, *state]))
+
+    def get(self, key):
+        entry_path = os.path.join(self.path, key + ".json")
+        try:
+            entry = self.memory.pop(key, None)
+            if entry is None:
+                with open(entry_path) as f:
+                    entry = json.load(f)
+            for dep, digest in entry["deps"].items():
+                with open(dep) as f:
+                    if file_hash(f.read()) != digest:
+                        raise ValueError(dep)
+        except (OSError, ValueError, KeyError):
+            self.misses += 1
+            return None
+        try:
+            os.utime(entry_path)  # mark as recently used
+        except FileNotFoundError:
+            pass  # evicted from disk by another process, still good in memory
+        self.remember(key, entry)
+        self.hits += 1
+        return entry
+
+    def remember(self, key, entry):
+        self.memory[key] = entry
+        if len(self.memory) > self.MEMORY_ENTRIES:
+            del self.memory[next(iter(self.memory))]
+
+    def put(self, key, entry):
+        entry_path = os.path.join(self.path, key + ".json")
+        tmp_path = f"{entry_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, entry_path)
+        self.remember(key, {**entry, "defines": dict(entry["defines"])})
+        self.evict()
+
+    def object_path(self, key):
+        return os.path.join(self.path, key + ".o")
+
+    def get_object(self, key):
+        """Return the path of a cached object file, or None"""
+        path = self.object_path(key)
+        try:
+            os.utime(path)  # mark as recently used
+        except FileNotFoundError:
+            self.object_misses += 1
+            return None
+        self.object_hits += 1
+        return path
+
+    def evict(self):
+        entries = []
+        total = 0
+        for name in os.listdir(self.path):
+            if not name.endswith((".json", ".o")) or name == "stats.json":
+                continue
+            st = os.stat(os.path.join(self.path, name))
+            entries.append((st.st_mtime, st.st_size, name))
+            total += st.st_size
+        entries.sort()
+        while total > self.max_bytes and entries:
+            _, size, name = entries.pop(0)
+            try:
+                os.remove(os.path.join(self.path, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+            self.evictions += 1
+
+    def save_stats(self):
+        """Add this run's counters to the totals kept in stats.json"""
+        stats_path = os.path.join(self.path, "stats.json")
+        try:
+            with open(stats_path) as f:
+                totals = json.load(f)
+        except (OSError, ValueError):
+            totals = {}
+        for name in ("hits", "misses", "object_hits", "object_misses", "evictions"):
+            totals[name] = totals.get(name, 0) + getattr(self, name)
+        tmp_path = f"{stats_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(totals, f)
+        os.replace(tmp_path, stats_path)
+        return totals
+
+
+import_cache = None
+token_cache = {}  # file_hash of an imported text -> its (tokens, positions)
+
+
+def imported_tokens(text):
+    """Tokenize an imported text once per content"""
+    key = file_hash(text)
+    if key not in token_cache:
+        remember_tokens(key, tokenize(text))
+    return token_cache[key]
+
+
+def remember_tokens(key, tokens):
+    # bounded like the cache's memory, for a long-lived compiler
+    token_cache[key] = tokens
+    if len(token_cache) > ImportCache.MEMORY_ENTRIES:
+        del token_cache[next(iter(token_cache))]
+
+
+def import_file(filename, defines, included, modules=None):
+    """Preprocess an imported file, going through import_cache if enabled"""
+    with open(filename) as f:
+        source = f.read()
+    if import_cache is None:
+        # Recursively process import with current defines
+        return preprocess_and_import(source, defines, included, modules)
+
+    separate = modules is not None
+    key = import_cache.key(source, defines, sorted(included), separate)
+    entry = import_cache.get(key)
+    if entry is not None:
+        defines.clear()
+        defines.update(entry["defines"])
+        included.update(entry["included"])
+        text_key = file_hash(entry["text"])
+        if text_key not in token_cache:
+            remember_tokens(text_key, ([tuple(tok) for tok in entry["tokens"]],
+                                       [tuple(position) for position in entry["positions"]]))
+        if separate:
+            modules.extend(tuple(m) for m in entry["modules"])
+        return entry["text"]
+
+    before = set(included)
+    nested = [] if separate else None
+    text = preprocess_and_import(source, defines, included, nested)
+    if separate:
+        modules.extend(nested)
+    deps = {}
+    for dep in included - before:
+        with open(dep) as f:
+            deps[dep] = file_hash(f.read())
+    tokens, positions = imported_tokens(text)
+    import_cache.put(key, {
+        "text": text,
+        "tokens": tokens,
+        "positions": positions,
+        "defines": defines,
+        "included": sorted(included - before),
+        "modules": nested,
+        "deps": deps,
+    })
+    return text
+
+
+# --- Tokenizer ---
+TOKEN_RE = re.compile(
+    r"[ \t]*(?:"
+    r'"(?P<str>(?:[^"\\]|\\.)*)"?'
+    r"|(?P<word>[^\W\d]\w*)"
+    r"|(?P<num>\d+)"
+    r"|(?P<op>[+\-*/%]|=(?!=))"
+    r"|(?P<lbracket>\[)"
+    r"|(?P<rbracket>\])"
+    r"|&[ \t]*(?P<addr>\w*)"
+    r"|@[ \t]*(?P<deref>\w*)"
+    r"|(?P<cmp>[=<>!]=?)"
+    r"|(?P<sym>\S)"
+    r")"
+)
+ESCAPE_RE = re.compile(r"\\(.)")
+ESCAPES = {"n": "\n", "t": "\t"}
+
+
+def unescape(m):
+    c = m.group(1)
+    return ESCAPES.get(c, c)
+
+
+def tokenize(source):
+    """Turn preprocessed source into a flat token array.
+
+    Returns (tokens, positions) where tokens are (kind, value) tuples and
+    positions holds the (line, col) of each token. Lines inside an asm
+    block are kept verbatim as ("asm", line) tokens, lines starting with
+    ";" are comments.
+    """
+    tokens = []
+    positions = []
+    in_asm = False
+    for lineno, line in enumerate(source.split("\n"), 1):
+        stripped = line.strip()
+        if not stripped:
+            continue
+        if in_asm:
+            col = line.index(stripped[0]) + 1
+            if stripped == "end":
+                in_asm = False
+                tokens.append(("word", "end"))
+            else:
+                tokens.append(("asm", stripped))
+            positions.append((lineno, col))
+            tokens.append(("nl", None))
+            positions.append((lineno, len(line) + 1))
+            continue
+        if stripped[0] == ";":
+            continue
+        if stripped == "asm":
+            in_asm = True
+
+        i = 0
+        end = len(line.rstrip())
+        while i < end:
+            m = TOKEN_RE.match(line, i)
+            kind = m.lastgroup
+            value = m.group(kind)
+            if kind == "str":
+                value = ESCAPE_RE.sub(unescape, value)
+            elif kind == "lbracket" or kind == "rbracket":
+                value = None
+            text = m.group()
+            tokens.append((kind, value))
+            positions.append((lineno, i + len(text) - len(text.lstrip(" \t")) + 1))
+            i = m.end()
+        tokens.append(("nl", None))
+        positions.append((lineno, len(line) + 1))
+    return tokens, positions
+
+
+def tokenize_program(chunks):
+    """Tokenize the pieces preprocess_and_import produced, as if they had
+    been joined; imports reuse their cached token streams"""
+    tokens = []
+    positions = []
+    lines = 0
+    for text, imported in chunks:
+        toks, poss = imported_tokens(text) if imported and import_cache else tokenize(text)
+        tokens += toks
+        positions += [(line + lines, col) for line, col in poss]
+        lines += text.count("\n") + 1
+    return tokens, positions
+
+
+# --- Token cursor ---
+tokens = []
+positions = []
 pos = 0
 
 
+class CompileError(Exception):
+    pass
+
+
+def error(msg, at=None):
+    """Raise a CompileError pointing at token index at (default: current)"""
+    if at is None:
+        at = pos
+    if positions:
+        line, col = positions[min(at, len(positions) - 1)]
+        msg = f"{line}:{col}: {msg}"
+    raise CompileError(msg)
+
+
 def peek():
-    return prog[pos] if pos < len(prog) else ""
+    return tokens[pos] if pos < len(tokens) else None
 
 
-def advance():
+def next_token():
     global pos
-    c = peek()
-    pos += 1
-    return c
+    if pos < len(tokens):
+        tok = tokens[pos]
+        pos += 1
+        return tok
+    return None
 
 
-def skip_ws():
-    while peek() in " \t":
-        advance()
+def expect(tok, what):
+    if peek() != tok:
+        error(f"expected {what}")
+    return next_token()
 
 
 def skip_line():
-    while peek() and peek() != "\n":
-        advance()
-    if peek() == "\n":
-        advance()
+    """Skip the rest of the current line, including the newline"""
+    global pos
+    while pos < len(tokens) and tokens[pos][0] != "nl":
+        pos += 1
+    pos += 1
 
 
-def read_word():
-    result = ""
-    while peek().isalnum() or peek() == "_":
-        result += advance()
-    return result
+def describe(tok):
+    return "end of line" if tok[0] == "nl" else repr(tok[1])
 
 
-def read_number():
-    result = ""
-    while peek().isdigit():
-        result += advance()
-    return result
+def at_line_end():
+    tok = peek()
+    return tok is None or tok[0] == "nl"
+
+
+def end_line():
+    """Consume the newline ending a statement, complaining about leftovers"""
+    if not at_line_end():
+        error(f"unexpected {describe(peek())}")
+    skip_line()
+
+
+def read_line():
+    """Read the tokens up to the end of the line, consuming the newline"""
+    start = pos
+    skip_line()
+    return tokens[start:pos - 1]
+
+
+def line_has(tok):
+    """Check whether tok occurs in the rest of the current line"""
+    i = pos
+    while i < len(tokens) and tokens[i][0] != "nl":
+        if tokens[i] == tok:
+            return True
+        i += 1
+    return False
+
+
+def read_until(delim):
+    """Read tokens until delimiter or end of line, don't consume it"""
+    global pos
+    start = pos
+    while pos < len(tokens) and tokens[pos] != delim and tokens[pos][0] != "nl":
+        pos += 1
+    return tokens[start:pos]
+
+
+def tokens_text(toks):
+    return "".join(str(v) for _, v in toks)
 
 
 def eval_const_expr(expr):
@@ -174,13 +560,16 @@ def eval_const_expr(expr):
 
     def parse_term():
         left = parse_factor()
-        while peek_char() and peek_char() in "*/":
+        while peek_char() and peek_char() in "*/%":
             op = advance_char()
             right = parse_factor()
             if op == "*":
                 left *= right
+            elif right == 0:
+                raise ZeroDivisionError(expr)
             else:
-                left //= right
+                # truncating, like the generated code
+                left = fold_binop(op, left, right)
         return left
 
     def parse_expr():
@@ -197,125 +586,478 @@ def eval_const_expr(expr):
     return parse_expr()
 
 
-def read_string():
-    advance()  # skip opening "
-    result = ""
-    while peek() and peek() != '"':
-        if peek() == "\\":
-            advance()
-            c = advance()
-            if c == "n":
-                result += "\n"
-            elif c == "t":
-                result += "\t"
-            elif c == "\\":
-                result += "\\"
-            elif c == '"':
-                result += '"'
-            else:
-                result += c
-        else:
-            result += advance()
-    advance()  # skip closing "
-    return result
-
-
 def read_params():
     params = []
-    skip_ws()
-    if peek() != "(":
+    if peek() != ("sym", "("):
         return params
-    advance()  # skip (
+    next_token()  # skip (
     while True:
-        skip_ws()
-        if peek() == ")":
-            advance()
+        tok = next_token()
+        if tok is None or tok == ("sym", ")") or tok[0] == "nl":
             break
-        if peek().isalpha() or peek() == "_":
-            params.append(read_word())
-        skip_ws()
-        if peek() == ",":
-            advance()
+        if tok[0] == "word":
+            params.append(tok[1])
     return params
 
 
-def read_until_newline():
-    result = ""
-    while peek() and peek() != "\n":
-        result += advance()
-    if peek() == "\n":
-        advance()
-    return result
+# --- Parser ---
+# The AST is made of tuples tagged by their first element:
+#   ("fn", name, params, body)       ("mem", [(name, size), ...])
+#   ("assign", name, expr)           ("store", name, index, value)
+#   ("if", cond, body, else_body)    ("for", init, cond, post, body)
+#   ("ret", expr)                    ("asm", lines)
+#   ("call", name, args)             ("match", expr, [(values, body)], else_body)
+# Conditions are ("cmp", op, left, right). Expressions are
+# ("binop", op, left, right) or one of the operands
+#   ("num", text)  ("var", name)  ("index", name, index)  ("addr", name)
+#   ("deref", name, index)  ("str", content)  ("call", name, args)
+# A function may be annotated "inline fn", "noinline fn" or "export fn".
+fn_names = set()
+fn_inline = {}  # name -> True for inline, False for noinline functions
+fn_exported = set()
+ANNOTATIONS = {("word", "inline"), ("word", "noinline"), ("word", "export")}
+
+
+def scan_fn_names(toks):
+    """Names of the functions defined in a token array"""
+    return {
+        toks[i + 1][1]
+        for i in range(len(toks) - 1)
+        if toks[i] == ("word", "fn")
+        and (i == 0 or toks[i - 1][0] == "nl" or toks[i - 1] in ANNOTATIONS)
+    }
+
+
+def parse_tokens(toks, toks_positions, known_fns=frozenset()):
+    """Parse a token array; known_fns are functions defined elsewhere"""
+    global tokens, positions, pos
+    tokens, positions, pos = toks, toks_positions, 0
+    return parse_program(known_fns)
+
+
+def parse_program(known_fns=frozenset()):
+    """Parse the token array into a list of top-level fn and mem nodes"""
+    global fn_names
+    # calls are recognised by name, so collect the names up front
+    fn_names = scan_fn_names(tokens) | known_fns
+    program = []
+    while pos < len(tokens):
+        tok = next_token()
+        if tok[0] == "nl":
+            continue
+        if tok == ("word", "fn"):
+            program.append(parse_fn())
+        elif tok in ANNOTATIONS:
+            annotations = {tok[1]}
+            while peek() in ANNOTATIONS:
+                annotations.add(next_token()[1])
+            expect(("word", "fn"), "fn")
+            node = parse_fn()
+            if annotations & {"inline", "noinline"}:
+                fn_inline[node[1]] = "inline" in annotations
+            if "export" in annotations:
+                fn_exported.add(node[1])
+            program.append(node)
+        elif tok == ("word", "mem"):
+            program.append(parse_mem())
+        else:
+            error(f"unexpected {tok[1]!r} at top level", pos - 1)
+    return program
+
+
+def parse_fn():
+    name = next_token()
+    if name is None or name[0] != "word":
+        error("expected function name", pos - 1)
+    params = read_params()
+    end_line()
+    body, closer = parse_block()
+    if closer != "end":
+        error("else without if", pos - 1)
+    return ("fn", name[1], params, body)
+
+
+def parse_block(closers=("end", "else")):
+    """Parse statements up to one of the closer words, return (body,
+    closer). The closer's line is consumed, except after case."""
+    body = []
+    while True:
+        tok = next_token()
+        if tok is None:
+            error("missing end")
+        if tok[0] == "nl":
+            continue
+        if tok[0] == "word" and tok[1] in closers:
+            if tok[1] != "case":
+                skip_line()
+            return body, tok[1]
+        body.append(parse_statement(tok))
 
 
-def read_until(delim):
-    """Read until delimiter, don't consume it"""
-    result = ""
-    while peek() and peek() != delim and peek() != "\n":
-        result += advance()
-    return result
+def parse_statement(tok):
+    start = pos - 1
+    match tok:
+        case ("word", "if"):
+            cond = parse_cond()
+            end_line()
+            body, closer = parse_block()
+            else_body = None
+            if closer == "else":
+                else_body, closer = parse_block()
+                if closer != "end":
+                    error("else without if", pos - 1)
+            return ("if", cond, body, else_body)
 
+        case ("word", "for"):
+            init = post = None
+            if line_has(("sym", ";")):
+                # C-style: init; cond; post
+                if peek() != ("sym", ";"):
+                    init = parse_assign()
+                expect(("sym", ";"), "';'")
+                cond = parse_cond()
+                expect(("sym", ";"), "';'")
+                if not at_line_end():
+                    post = parse_assign()
+            else:
+                # while-style: just condition
+                cond = parse_cond()
+            end_line()
+            body, closer = parse_block()
+            if closer != "end":
+                error("else without if", pos - 1)
+            return ("for", init, cond, post, body)
 
-def next_token():
-    skip_ws()
-    if peek() == "":
-        return None
-    if peek() == "\n":
-        advance()
-        return ("nl", None)
-    if peek() == '"':
-        return ("str", read_string())
-    if peek().isalpha() or peek() == "_":
-        return ("word", read_word())
-    if peek().isdigit():
-        return ("num", read_number())
-    if peek() in "+-*/":
-        return ("op", advance())
-    if peek() == "[":
-        advance()
-        return ("lbracket", None)
-    if peek() == "]":
-        advance()
-        return ("rbracket", None)
-    if peek() == "&":
-        advance()
-        skip_ws()
-        var_name = read_word()
-        return ("addr", var_name)
-    if peek() == "@":
-        advance()
-        skip_ws()
-        var_name = read_word()
-        return ("deref", var_name)
-    if peek() in "=<>!":
-        c = advance()
-        if peek() == "=":
-            return ("cmp", c + advance())
-        elif c == "=":
-            return ("op", c)
+        case ("word", "match"):
+            return parse_match()
+
+        case ("word", "ret"):
+            expr = None
+            if not at_line_end():
+                expr = parse_expr()
+            end_line()
+            return ("ret", expr)
+
+        case ("word", "asm"):
+            end_line()
+            lines = []
+            while peek() is not None and peek()[0] == "asm":
+                lines.append(next_token()[1])
+                skip_line()
+            expect(("word", "end"), "end of asm block")
+            skip_line()
+            return ("asm", lines)
+
+        case ("word", "mem"):
+            return parse_mem()
+
+        case ("word", name) if name in fn_names:
+            node = ("call", name, parse_args())
+            end_line()
+            return node
+
+        case ("word", name):
+            if peek() == ("lbracket", None):
+                # array assignment: name[index] = value
+                index = parse_index()
+                expect(("op", "="), "'='")
+                node = ("store", name, index, parse_expr())
+            else:
+                node = parse_assign(tok)
+            end_line()
+            return node
+
+    error(f"unexpected {tok[1]!r}", start)
+
+
+def parse_assign(target=None):
+    if target is None:
+        target = next_token()
+    if target is None or target[0] != "word":
+        error("expected variable name", pos - 1)
+    expect(("op", "="), "'='")
+    return ("assign", target[1], parse_expr())
+
+
+def parse_match():
+    """match expr, then case lines of constants each followed by their
+    block, an optional else block and end"""
+    expr = parse_expr()
+    end_line()
+    cases = []
+    seen = set()
+    body, closer = parse_block(("case", "else", "end"))
+    if body:
+        error("expected case", pos - 1)
+    while closer == "case":
+        values = []
+        for part in split_line(read_line(), ("sym", ",")):
+            if not part or not all(t[0] == "num" or t[0] == "op" and t[1] != "="
+                                   or t in (("sym", "("), ("sym", ")")) for t in part):
+                error("case values must be constants", pos - 1)
+            value = wrap(eval_const_expr(tokens_text(part)))
+            if value in seen:
+                error(f"duplicate case value {value}", pos - 1)
+            seen.add(value)
+            values.append(value)
+        body, closer = parse_block(("case", "else", "end"))
+        cases.append((values, body))
+    else_body = None
+    if closer == "else":
+        else_body, closer = parse_block(("end",))
+    return ("match", expr, cases, else_body)
+
+
+def split_line(toks, sep):
+    """toks split at each sep token"""
+    parts = [[]]
+    for tok in toks:
+        if tok == sep:
+            parts.append([])
         else:
-            return ("cmp", c)
-    return ("sym", advance())
+            parts[-1].append(tok)
+    return parts
+
+
+def parse_mem():
+    """mem name size, or a block of name size lines closed by end"""
+    buffers = []
+    line = read_line()
+    if line:
+        lines = [line]
+    else:
+        lines = []
+        while True:
+            if pos >= len(tokens):
+                error("missing end")
+            line = read_line()
+            if not line:
+                continue
+            if line[0] == ("word", "end"):
+                break
+            lines.append(line)
+    for line in lines:
+        if line[0][0] != "word" or len(line) < 2:
+            error("expected mem buffer name and size", pos - 1)
+        buffers.append((line[0][1], eval_const_expr(tokens_text(line[1:]))))
+    return ("mem", buffers)
+
+
+def parse_cond():
+    left = parse_expr()
+    op = next_token()
+    if op is None or op[0] != "cmp" or op[1] not in JUMP_IF_FALSE:
+        error("expected comparison", pos - 1)
+    return ("cmp", op[1], left, parse_expr())
+
+
+def parse_expr():
+    """term ((+|-) term)*"""
+    node = parse_term()
+    while peek() in (("op", "+"), ("op", "-")):
+        op = next_token()[1]
+        node = ("binop", op, node, parse_term())
+    return node
+
+
+def parse_term():
+    """operand ((*|/|%) operand)*"""
+    node = parse_operand()
+    while peek() in (("op", "*"), ("op", "/"), ("op", "%")):
+        op = next_token()[1]
+        node = ("binop", op, node, parse_operand())
+    return node
+
+
+def parse_operand():
+    tok = next_token()
+    if tok is None:
+        error("expected value")
+    match tok[0]:
+        case "num" | "str":
+            return tok
+        case "addr":
+            return tok
+        case "deref":
+            index = None
+            if peek() == ("lbracket", None):
+                index = parse_index()
+            return ("deref", tok[1], index)
+        case "word":
+            if tok[1] in fn_names:
+                return ("call", tok[1], parse_args())
+            if peek() == ("lbracket", None):
+                return ("index", tok[1], parse_index())
+            return ("var", tok[1])
+        case "sym" if tok[1] == "(":
+            node = parse_expr()
+            expect(("sym", ")"), "')'")
+            return node
+    error(f"expected value, got {describe(tok)}", pos - 1)
+
+
+def parse_index():
+    expect(("lbracket", None), "'['")
+    tok = next_token()
+    if tok is None or tok[0] not in ("num", "word"):
+        error("expected index", pos - 1)
+    expect(("rbracket", None), "']'")
+    return tok if tok[0] == "num" else ("var", tok[1])
+
+
+def parse_args():
+    """Call arguments, either fn(a, b) or space-separated fn a, b"""
+    args = []
+    if peek() == ("sym", "("):
+        next_token()  # skip (
+        while True:
+            if at_line_end():
+                error("missing ')'")
+            tok = peek()
+            if tok == ("sym", ")"):
+                next_token()
+                break
+            if tok == ("sym", ","):
+                next_token()
+                continue
+            args.append(parse_expr())
+    else:
+        while not at_line_end():
+            if peek() == ("sym", ","):
+                next_token()
+                continue
+            args.append(parse_expr())
+    if len(args) > len(arg_regs):
+        error(f"too many arguments (max {len(arg_regs)})")
+    return args
+
+
+# --- Pass statistics ---
+# Every phase is timed; --time-passes and --stats print the results and
+# --stats-json writes them for tools. Peak memory is the high-water mark
+# of the resident set: the compiler's own after each of its phases, and
+# for nasm and ld the tool's, sampled while it runs.
+pass_times = {}  # phase -> [seconds, peak RSS in KiB], summed over modules
+compile_stats = {}  # counter -> value, summed over modules
+tool_stats = False  # whether nasm and ld are timed and their peak sampled
+
+
+def timed(name, fn, *args):
+    """fn(*args), timed as phase name"""
+    start = time.perf_counter()
+    result = fn(*args)
+    entry = pass_times.setdefault(name, [0.0, 0])
+    entry[0] += time.perf_counter() - start
+    entry[1] = max(entry[1], resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+    return result
+
+
+def resident_peak(pid):
+    """VmHWM of a running process in KiB, 0 once it has exited"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def run_tool(name, argv):
+    """Run nasm or ld as phase name; returns the exit code. Under --server
+    the tool's output is passed on to sys.stderr, which is the client's."""
+    if not tool_stats and sys.stderr is sys.__stderr__:
+        return subprocess.run(argv).returncode
+    start = time.perf_counter()
+    with tempfile.TemporaryFile() as output:
+        process = subprocess.Popen(argv, stdout=output, stderr=output)
+        if tool_stats:
+            # The kernel's rusage of a child counts the compiler's memory
+            # it was forked from, so the peak is sampled every millisecond.
+            peak = 0
+            exited = os.pidfd_open(process.pid)
+            try:
+                while not select.select([exited], [], [], 0.001)[0]:
+                    peak = max(peak, resident_peak(process.pid))
+            finally:
+                os.close(exited)
+        process.wait()
+        output.seek(0)
+        sys.stderr.write(output.read().decode(errors="replace"))
+    if tool_stats:
+        entry = pass_times.setdefault(name, [0.0, 0])
+        entry[0] += time.perf_counter() - start
+        entry[1] = max(entry[1], peak)
+    return process.returncode
+
+
+def count(name, n):
+    compile_stats[name] = compile_stats.get(name, 0) + n
+
+
+def stats_json():
+    return json.dumps({
+        "phases": {name: {"seconds": seconds, "peak_rss_kib": peak}
+                   for name, (seconds, peak) in pass_times.items()},
+        "stats": compile_stats,
+    }, indent=2)
 
 
 # --- Compiler state ---
 functions = {}  # name -> list of param names
 fn_vars = {}  # name -> {var: offset}
 fn_stack = {}  # name -> stack size
+fn_strings = {}  # name -> {var: label} for string variables
+fn_regs = {}  # name -> {var: register} for register-allocated locals
+fn_saved = {}  # name -> [(register, offset)] callee-saved registers to restore
 string_vars = {}  # var name -> label
+global_fns = set()  # functions the linker sees
 literal_strings = {}  # content -> label (for anonymous string literals)
-strings = []
+strings = []  # (label, content), one label per distinct constant content
+writable_strings = set()  # labels of strings a function writes into, kept in .data
 mem_buffers = []  # (name, size) tuples for .bss section
-blocks = []
+buffer_labels = {}  # mem buffer name -> label
 
 current_fn = None
 vars = {}
+regs = {}
 stack_size = 0
 
 label_count = 0
 
 arg_regs = ["rdi", "rsi", "rdx", "rcx", "r8", "r9"]
 
+# conditional jump taken when the comparison is false
+JUMP_IF_FALSE = {
+    "<": "jge",
+    ">": "jle",
+    "==": "jne",
+    "!=": "je",
+    "<=": "jg",
+    ">=": "jl",
+}
+
+# match dispatch: a jump table once there are this many values and the
+# table would have fewer than JUMP_TABLE_DENSITY slots per value, else a
+# binary search down to a few compares in a row. With four values the
+# indirect jump lost to compares in bench/dispatch.py.
+JUMP_TABLE_MIN_CASES = 5
+JUMP_TABLE_DENSITY = 3
+MATCH_LINEAR_CASES = 3
+
+JUMP_IF_TRUE = {
+    "<": "jl",
+    ">": "jg",
+    "==": "je",
+    "!=": "jne",
+    "<=": "jle",
+    ">=": "jge",
+}
+
+# inlined locals are named callee.N.var
+ASM_VAR_RE = re.compile(r"\$(\w+(?:\.\w+)*)")
+
 
 def var_offset(name):
     global stack_size
@@ -325,14 +1067,21 @@ def var_offset(name):
     return vars[name]
 
 
-def add_string(name, content):
-    label = f"_str{len(strings)}"
-    strings.append((label, content))
+def add_string(name, content, writable=False):
+    """Point string variable name at its content, shared with every other
+    use of the same text unless the function writes into it"""
+    if writable:
+        label = f"_str{len(strings)}"
+        strings.append((label, content))
+        writable_strings.add(label)
+    else:
+        label = get_literal_string(content)
     string_vars[name] = label
 
 
 def get_literal_string(content):
-    """Get or create a label for a string literal"""
+    """Get or create the label of a string literal, when merging the
+    functions' code"""
     if content not in literal_strings:
         label = f"_str{len(strings)}"
         strings.append((label, content))
@@ -344,457 +1093,1417 @@ def replace_var(match):
     name = match.group(1)
     if name in string_vars:
         return string_vars[name]
-    offset = vars[name]
-    return f"[rbp - {offset}]"
-
-
-def load_val(tok, check_index=True):
-    """Load value into rax. If check_index, peek for [index]"""
-    if tok[0] == "num":
-        return f"    mov rax, {tok[1]}"
-    elif tok[0] == "addr":
-        # &x - get address of variable
-        var_name = tok[1]
-        if var_name in string_vars:
-            return f"    mov rax, {string_vars[var_name]}"
-        else:
-            off = var_offset(var_name)
-            return f"    lea rax, [rbp - {off}]"
-    elif tok[0] == "deref":
-        # @x - dereference as qword, @x[i] - indexed qword access
-        var_name = tok[1]
-        asm = []
-        # load base pointer
-        if var_name in string_vars:
-            asm.append(f"    mov rdi, {string_vars[var_name]}")
-        else:
-            off = var_offset(var_name)
-            asm.append(f"    mov rdi, [rbp - {off}]")
-        # check for indexed access
-        if check_index and peek() == "[":
-            advance()  # skip [
-            idx_tok = next_token()
-            next_token()  # skip ]
-            if idx_tok[0] == "num":
-                asm.append(f"    mov rax, [rdi + {int(idx_tok[1]) * 8}]")
-            else:
-                idx_off = var_offset(idx_tok[1])
-                asm.append(f"    mov rax, [rbp - {idx_off}]")
-                asm.append(f"    mov rax, [rdi + rax*8]")
-        else:
-            asm.append(f"    mov rax, [rdi]")
-        return "\n".join(asm)
-    elif tok[0] == "word":
-        # check for array access: name[index]
-        if check_index and peek() == "[":
-            advance()  # skip [
-            idx_tok = next_token()
-            next_token()  # skip ]
-            asm = []
-            # load base address
-            if tok[1] in string_vars:
-                asm.append(f"    mov rdi, {string_vars[tok[1]]}")
-            else:
-                off = var_offset(tok[1])
-                asm.append(f"    mov rdi, [rbp - {off}]")
-            # load index
-            if idx_tok[0] == "num":
-                asm.append(f"    add rdi, {idx_tok[1]}")
-            else:
-                idx_off = var_offset(idx_tok[1])
-                asm.append(f"    mov rax, [rbp - {idx_off}]")
-                asm.append(f"    add rdi, rax")
-            # load byte
-            asm.append(f"    movzx rax, byte [rdi]")
-            return "\n".join(asm)
-        else:
-            off = var_offset(tok[1])
-            return f"    mov rax, [rbp - {off}]"
-    else:
-        return f"    mov rax, 0"
+    return var_loc(name)
+
+
+# --- Inlining ---
+# Calls of small functions are replaced by the callee's body before
+# folding, so constant arguments and the caller's registers reach it. The
+# callee's locals get fresh names and its returns become assignments of
+# the call's result.
+INLINE_MAX_COST = 10  # statements, counting each asm line
+
+inline_enabled = True
+inline_stats = {}  # callee -> call sites inlined, summed over modules
+inline_refused = {}  # callee marked inline -> why it was not inlined
+
+inline_fns = {}  # name -> fn node of the program being inlined
+inline_buffers = set()  # mem buffers of the program and the other modules
+inline_bodies = {}  # name -> body with its own calls inlined, None while in progress
+inline_count = 0
+
+# asm that only works in the callee's own frame
+FRAME_ASM_RE = re.compile(r"^\s*[.\w]+:|\b(ret|leave|rbp)\b")
+
+
+def inline_program(program, extern_buffers=frozenset()):
+    """Inline the calls of small functions in every function of program"""
+    global inline_fns, inline_buffers, inline_bodies, inline_count
+    inline_fns = {node[1]: node for node in program if node[0] == "fn"}
+    inline_buffers = program_buffers(program) | extern_buffers
+    inline_bodies = {}
+    inline_count = 0
+    # callees first, so a long chain of calls is not inlined recursively
+    for name in callee_order(program):
+        inlined_body(name)
+    return [("fn", node[1], node[2], inlined_body(node[1])) if node[0] == "fn" else node
+            for node in program]
+
+
+def calls_in(node):
+    """Names of the functions node calls, in order"""
+    names = []
+
+    def visit(node):
+        if node[0] == "call":
+            names.append(node[1])
+        return node
+
+    rewrite(node, visit)
+    return names
+
+
+def callee_order(program):
+    """The functions of program in depth-first postorder of the calls"""
+    order = []
+    seen = set()
+    for node in program:
+        if node[0] != "fn" or node[1] in seen:
+            continue
+        seen.add(node[1])
+        stack = [(node[1], iter(calls_in(node[3])))]
+        while stack:
+            name, calls = stack[-1]
+            callee = next(calls, None)
+            if callee is None:
+                stack.pop()
+                order.append(name)
+            elif callee in inline_fns and callee not in seen:
+                seen.add(callee)
+                stack.append((callee, iter(calls_in(inline_fns[callee][3]))))
+    return order
+
+
+def callee_locals(params, body):
+    """The names a callee uses that are its own: parameters, assigned
+    variables, and any other name that is not a mem buffer, such as a
+    variable only an asm block writes"""
+    return set(params) | assigned_vars(body) | (used_names(body) - inline_buffers)
+
+
+def inlined_body(name):
+    if name not in inline_bodies:
+        inline_bodies[name] = None  # in progress, for recursive functions
+        node = inline_fns[name]
+        caller = (set(node[2]) | assigned_vars(node[3]), addressed_vars(node))
+        inline_bodies[name] = inline_block(node[3], caller)
+    return inline_bodies[name]
+
+
+def inline_cost(body):
+    return sum(len(node[1]) if node[0] == "asm" else 1 for node in walk_statements(body))
+
+
+def used_names(node):
+    """Every variable or buffer name node reads or writes"""
+    names = set()
+
+    def visit(node):
+        match node:
+            case ("var" | "addr" | "index" | "deref" | "assign" | "store", name, *_):
+                names.add(name)
+            case ("asm", lines):
+                names.update(v for line in lines for v in ASM_VAR_RE.findall(line))
+        return node
+
+    rewrite(node, visit)
+    return names
+
+
+def indexed_names(node):
+    """Names node indexes, dereferences or stores into"""
+    names = set()
+
+    def visit(node):
+        if node[0] in ("index", "deref", "store"):
+            names.add(node[1])
+        return node
+
+    rewrite(node, visit)
+    return names
+
+
+def refuse_inline(name, args, caller):
+    """Why the call name(args) can't be inlined into caller, or None"""
+    if name not in inline_fns:
+        return "defined in another module"
+    if fn_inline.get(name) is False:
+        return "marked noinline"
+    if inline_bodies.get(name, ()) is None:
+        return "recursive"
+    body = inlined_body(name)
+    params = inline_fns[name][2]
+    local = callee_locals(params, body)
+    if len(args) != len(params):
+        return "wrong number of arguments"
+    if not fn_inline.get(name) and inline_cost(body) > INLINE_MAX_COST:
+        return "too large"
+    for node in walk_statements(body):
+        match node:
+            case ("mem", _):
+                return "declares mem buffers"
+            case ("asm", lines) if any(FRAME_ASM_RE.search(line) for line in lines):
+                return "asm uses labels or the stack frame"
+            case ("for", _, _, _, loop_body) if any(s[0] == "ret" for s in walk_statements(loop_body)):
+                return "returns from inside a loop"
+    if any(arg[0] == "str" and p in assigned_vars(body) for p, arg in zip(params, args)):
+        return "assigns to a string parameter"
+    if (used_names(body) - local) & caller[0]:
+        return "uses a buffer the caller shadows"
+    return None
+
+
+def can_inline(node, caller):
+    """Whether the call node can be inlined, recording why not for
+    functions marked inline"""
+    _, name, args = node
+    reason = refuse_inline(name, args, caller)
+    if reason and fn_inline.get(name):
+        inline_refused[name] = reason
+    return reason is None
+
+
+def inline_block(body, caller):
+    result = []
+    for node in body:
+        pre = []
+        blocked = [False]
+        match node:
+            case ("assign", name, ("call", callee, args)):
+                node = ("call", callee, [inline_calls(arg, pre, caller, blocked) for arg in args])
+                if not blocked[0] and can_inline(node, caller):
+                    node = expand_call(node, ("assign", name), pre, caller)
+                else:
+                    node = ("assign", name, node)
+            case ("assign", name, expr):
+                node = ("assign", name, inline_calls(expr, pre, caller, blocked))
+            case ("store", name, index, value):
+                node = ("store", name, index, inline_calls(value, pre, caller, blocked))
+            case ("if", cond, then_body, else_body):
+                node = ("if", inline_calls(cond, pre, caller, blocked),
+                        inline_block(then_body, caller),
+                        else_body and inline_block(else_body, caller))
+            case ("match", expr, cases, else_body):
+                node = ("match", inline_calls(expr, pre, caller, blocked),
+                        [(values, inline_block(body, caller)) for values, body in cases],
+                        else_body and inline_block(else_body, caller))
+            case ("for", init, cond, post, loop_body):
+                # the condition and post statement run every iteration, so
+                # only calls in the init can be moved out
+                if init:
+                    init = ("assign", init[1], inline_calls(init[2], pre, caller, blocked))
+                node = ("for", init, cond, post, inline_block(loop_body, caller))
+            case ("ret", ("call", callee, args)):
+                node = ("call", callee, [inline_calls(arg, pre, caller, blocked) for arg in args])
+                if not blocked[0] and can_inline(node, caller):
+                    node = expand_call(node, "ret", pre, caller)
+                else:
+                    node = ("ret", node)
+            case ("ret", expr) if expr:
+                node = ("ret", inline_calls(expr, pre, caller, blocked))
+            case ("call", callee, args):
+                node = ("call", callee, [inline_calls(arg, pre, caller, blocked) for arg in args])
+                if not blocked[0] and can_inline(node, caller):
+                    expand_call(node, None, pre, caller)
+                    node = None
+        result.extend(pre)
+        if node:
+            result.append(node)
+    return result
 
 
-def load_val_rbx(tok, check_index=True):
-    """Load value into rbx. If check_index, peek for [index]"""
-    if tok[0] == "num":
-        return f"    mov rbx, {tok[1]}"
-    elif tok[0] == "addr":
-        var_name = tok[1]
-        if var_name in string_vars:
-            return f"    mov rbx, {string_vars[var_name]}"
-        else:
-            off = var_offset(var_name)
-            return f"    lea rbx, [rbp - {off}]"
-    elif tok[0] == "deref":
-        var_name = tok[1]
-        asm = []
-        if var_name in string_vars:
-            asm.append(f"    mov rsi, {string_vars[var_name]}")
-        else:
-            off = var_offset(var_name)
-            asm.append(f"    mov rsi, [rbp - {off}]")
-        if check_index and peek() == "[":
-            advance()
-            idx_tok = next_token()
-            next_token()
-            if idx_tok[0] == "num":
-                asm.append(f"    mov rbx, [rsi + {int(idx_tok[1]) * 8}]")
-            else:
-                idx_off = var_offset(idx_tok[1])
-                asm.append(f"    mov rbx, [rbp - {idx_off}]")
-                asm.append(f"    mov rbx, [rsi + rbx*8]")
-        else:
-            asm.append(f"    mov rbx, [rsi]")
-        return "\n".join(asm)
-    elif tok[0] == "word":
-        # check for array access
-        if check_index and peek() == "[":
-            advance()  # skip [
-            idx_tok = next_token()
-            next_token()  # skip ]
-            asm = []
-            # load base address
-            if tok[1] in string_vars:
-                asm.append(f"    mov rsi, {string_vars[tok[1]]}")
-            else:
-                off = var_offset(tok[1])
-                asm.append(f"    mov rsi, [rbp - {off}]")
-            # load index
-            if idx_tok[0] == "num":
-                asm.append(f"    add rsi, {idx_tok[1]}")
-            else:
-                idx_off = var_offset(idx_tok[1])
-                asm.append(f"    mov rbx, [rbp - {idx_off}]")
-                asm.append(f"    add rsi, rbx")
-            # load byte
-            asm.append(f"    movzx rbx, byte [rsi]")
-            return "\n".join(asm)
+def inline_calls(node, pre, caller, blocked, target="value"):
+    """node with inlinable calls replaced by their result, the inlined
+    code appended to pre. A call that stays blocks the ones after it from
+    being moved ahead of it."""
+    match node:
+        case ("call", name, args):
+            node = ("call", name, [inline_calls(arg, pre, caller, blocked) for arg in args])
+            if blocked[0] or not can_inline(node, caller):
+                blocked[0] = True
+                return node
+            return expand_call(node, target, pre, caller)
+        case ("binop" | "cmp" as kind, op, left, right):
+            left = inline_calls(left, pre, caller, blocked)
+            return (kind, op, left, inline_calls(right, pre, caller, blocked))
+    return node
+
+
+def expand_call(node, target, pre, caller):
+    """Append the body of the call node to pre, its result going to target:
+    ("assign", name), "ret" to return it or None to drop it. With target
+    "value" the result goes to a new variable, which is returned."""
+    global inline_count
+    _, name, args = node
+    inline_count += 1
+    inline_stats[name] = inline_stats.get(name, 0) + 1
+    prefix = f"{name}.{inline_count}"
+    params = inline_fns[name][2]
+    body = inlined_body(name)
+    if not body or body[-1][0] != "ret":
+        body = body + [("ret", None)]
+    fixed = assigned_vars(body) | addressed_vars(("fn", name, params, body)) | used_names(
+        [node for node in walk_statements(body) if node[0] == "asm"])
+    renamed = {var: f"{prefix}.{var}" for var in callee_locals(params, body)}
+    literals = {}
+    for p, arg in zip(params, args):
+        # a variable argument the callee can't change is used in place, and
+        # so is a literal it only passes on, which then stays read-only
+        if arg[0] == "var" and p not in fixed and arg[1] not in caller[1]:
+            renamed[p] = arg[1]
+        elif arg[0] == "str" and p not in fixed and p not in indexed_names(body):
+            literals[p] = arg
         else:
-            off = var_offset(tok[1])
-            return f"    mov rbx, [rbp - {off}]"
-    else:
-        return f"    mov rbx, 0"
+            pre.append(("assign", renamed[p], arg))
+
+    def rename(node):
+        match node:
+            case ("var", var) if var in literals:
+                return literals[var]
+            case ("var" | "addr" | "index" | "deref" | "assign" | "store" as kind, var, *rest) \
+                    if var in renamed:
+                return (kind, renamed[var], *rest)
+            case ("asm", lines):
+                return ("asm", [ASM_VAR_RE.sub(lambda m: "$" + renamed.get(m[1], m[1]), line)
+                                for line in lines])
+        return node
+
+    result = ("var", f"{prefix}.result")
+    if target == "value":
+        target = ("assign", result[1])
+    elif target is None:
+        # results that still make calls are kept for their effects
+        target = ("drop", f"{prefix}.unused")
+    pre.extend(return_to(tail_returns(rewrite(body, rename)), target))
+    return result
 
 
-def load_arg(tok, reg):
-    if tok[0] == "num":
-        return f"    mov {reg}, {tok[1]}"
-    elif tok[0] == "addr":
-        var_name = tok[1]
-        if var_name in string_vars:
-            return f"    mov {reg}, {string_vars[var_name]}"
-        else:
-            off = var_offset(var_name)
-            return f"    lea {reg}, [rbp - {off}]"
-    elif tok[0] == "deref":
-        var_name = tok[1]
-        asm = []
-        if var_name in string_vars:
-            asm.append(f"    mov {reg}, {string_vars[var_name]}")
-        else:
-            off = var_offset(var_name)
-            asm.append(f"    mov {reg}, [rbp - {off}]")
-        # check for indexed access
-        if peek() == "[":
-            advance()
-            idx_tok = next_token()
-            next_token()  # skip ]
-            if idx_tok[0] == "num":
-                asm.append(f"    mov {reg}, [{reg} + {int(idx_tok[1]) * 8}]")
+def tail_returns(body):
+    """body, which ends in a return, rewritten so that every return is the
+    last statement of its block: the statements after an if that returns
+    on some path are moved into its branches"""
+    for i, node in enumerate(body):
+        match node:
+            case ("ret", _):
+                return body[:i + 1]
+            case ("if", cond, then_body, else_body) \
+                    if any(s[0] == "ret" for s in walk_statements([node])):
+                rest = body[i + 1:]
+                return body[:i] + [("if", cond, tail_returns(then_body + rest),
+                                    tail_returns((else_body or []) + rest))]
+            case ("match", expr, cases, else_body) \
+                    if any(s[0] == "ret" for s in walk_statements([node])):
+                rest = body[i + 1:]
+                return body[:i] + [("match", expr,
+                                    [(values, tail_returns(case + rest)) for values, case in cases],
+                                    tail_returns((else_body or []) + rest))]
+    return body
+
+
+def return_to(body, target):
+    """body with the return ending each path replaced by a move to target"""
+    match body[-1:]:
+        case [("ret", expr)]:
+            expr = expr or ("num", "0")
+            if target == "ret":
+                last = [("ret", expr)]
+            elif target[0] == "assign":
+                last = [("assign", target[1], expr)]
+            elif expr[0] == "call":
+                last = [expr]
+            elif has_call(expr):
+                last = [("assign", target[1], expr)]
             else:
-                idx_off = var_offset(idx_tok[1])
-                asm.append(f"    push rax")
-                asm.append(f"    mov rax, [rbp - {idx_off}]")
-                asm.append(f"    mov {reg}, [{reg} + rax*8]")
-                asm.append(f"    pop rax")
-        else:
-            asm.append(f"    mov {reg}, [{reg}]")
-        return "\n".join(asm)
-    elif tok[1] in string_vars:
-        return f"    mov {reg}, {string_vars[tok[1]]}"
-    else:
-        off = var_offset(tok[1])
-        return f"    mov {reg}, [rbp - {off}]"
+                last = []
+            return body[:-1] + last
+        case [("if", cond, then_body, else_body)]:
+            return body[:-1] + [("if", cond, return_to(then_body, target),
+                                 return_to(else_body, target) or None)]
+        case [("match", expr, cases, else_body)]:
+            return body[:-1] + [("match", expr,
+                                 [(values, return_to(case, target)) for values, case in cases],
+                                 return_to(else_body, target) or None)]
+    return body
+
+
+# --- Constant folding ---
+# Evaluates arithmetic on literals and on locals holding a known constant,
+# and drops if branches and loops whose comparison is decided at compile time.
+WORD_MASK = (1 << 64) - 1
+
+COMPARE = {
+    "<": lambda a, b: a < b,
+    ">": lambda a, b: a > b,
+    "==": lambda a, b: a == b,
+    "!=": lambda a, b: a != b,
+    "<=": lambda a, b: a <= b,
+    ">=": lambda a, b: a >= b,
+}
+
+
+def wrap(value):
+    """Truncate to a signed 64-bit value like the generated code would"""
+    value &= WORD_MASK
+    return value - (1 << 64) if value >> 63 else value
+
+
+def fold_binop(op, a, b):
+    """Value of a op b as idiv/imul compute it, or None for division by zero.
+    Division truncates and the remainder has the sign of a."""
+    match op:
+        case "+":
+            return wrap(a + b)
+        case "-":
+            return wrap(a - b)
+        case "*":
+            return wrap(a * b)
+        case "/":
+            if b == 0:
+                return None
+            q = abs(a) // abs(b)
+            return wrap(q if (a < 0) == (b < 0) else -q)
+        case "%":
+            if b == 0:
+                return None
+            r = abs(a) % abs(b)
+            return wrap(-r if a < 0 else r)
+
+
+def fold_expr(node, env):
+    """node with known variables replaced and constant arithmetic evaluated"""
+    match node:
+        case ("var", name) if name in env:
+            return env[name]
+        case ("index" | "deref" as kind, name, index) if index:
+            return (kind, name, fold_expr(index, env))
+        case ("binop", op, left, right):
+            left, right = fold_expr(left, env), fold_expr(right, env)
+            if left[0] == right[0] == "num":
+                value = fold_binop(op, int(left[1]), int(right[1]))
+                if value is not None:
+                    return ("num", str(value))
+            return ("binop", op, left, right)
+        case ("cmp", op, left, right):
+            return ("cmp", op, fold_expr(left, env), fold_expr(right, env))
+        case ("call", name, args):
+            args = [fold_expr(arg, env) for arg in args]
+            if all(arg[0] in ("num", "str") for arg in args):
+                value = eval_call(name, args)
+                if value:
+                    return value
+            if any(arg[0] == "str" for arg in args):
+                return specialize(name, args) or ("call", name, args)
+            return ("call", name, args)
+    return node
 
 
-def parse_call(fn_name):
-    """Parse function call arguments and emit call code"""
-    asm = []
-    args = []
+def const_cond(cond):
+    """True or False when both sides of cond are numbers, else None"""
+    _, op, left, right = cond
+    if left[0] == right[0] == "num":
+        return COMPARE[op](int(left[1]), int(right[1]))
+    return None
+
+
+def assigned_vars(body):
+    return {node[1] for node in walk_statements(body) if node[0] == "assign"}
+
+
+def kept_buffers(body):
+    """mem statements inside code that is removed; their buffers stay"""
+    return [node for node in walk_statements(body) if node[0] == "mem"]
+
+
+def fold_program(program):
+    """Constant-fold every function of program, adding the specialized
+    copies made along the way"""
+    global fold_fns, eval_cache, specializations
+    fold_fns = {node[1]: node for node in program if node[0] == "fn"}
+    eval_cache = {}
+    specializations = {}
+    result = []
+    for node in program:
+        if node[0] == "fn":
+            _, name, params, body = node
+            node = ("fn", name, params, fold_function(node, body, {}))
+        result.append(node)
+    return result + [fn for fn in specializations.values() if fn]
+
+
+def fold_function(node, body, env):
+    """Fold body of the function node starting from env"""
+    pinned = addressed_vars(node)
+    for stmt in walk_statements(body):
+        if stmt[0] == "asm":
+            pinned |= {v for line in stmt[1] for v in ASM_VAR_RE.findall(line)}
+    return fold_block(body, env, pinned)
+
+
+def fold_block(body, env, pinned):
+    """Fold the statements of body; env maps locals to their known value
+    and is updated to the state at the end of the block"""
+    result = []
+    for node in body:
+        match node:
+            case ("assign", name, expr):
+                expr = fold_expr(expr, env)
+                if expr[0] == "num" and name not in pinned:
+                    env[name] = expr
+                else:
+                    env.pop(name, None)
+                result.append(("assign", name, expr))
+
+            case ("store", name, index, value):
+                value = fold_expr(value, env)
+                if value[0] == "num":
+                    # only the low byte is stored
+                    value = ("num", str(int(value[1]) & 0xFF))
+                result.append(("store", name, fold_expr(index, env), value))
+
+            case ("if", cond, body, else_body):
+                cond = fold_expr(cond, env)
+                taken = const_cond(cond)
+                if taken is True:
+                    result.extend(fold_block(body, env, pinned))
+                    result.extend(kept_buffers(else_body or []))
+                elif taken is False:
+                    result.extend(kept_buffers(body))
+                    result.extend(fold_block(else_body or [], env, pinned))
+                else:
+                    else_env = dict(env)
+                    body = fold_block(body, env, pinned)
+                    if else_body is not None:
+                        else_body = fold_block(else_body, else_env, pinned)
+                    # keep what both paths agree on
+                    for var in list(env):
+                        if else_env.get(var) != env[var]:
+                            del env[var]
+                    result.append(("if", cond, body, else_body))
+
+            case ("match", expr, cases, else_body):
+                expr = fold_expr(expr, env)
+                if expr[0] == "num":
+                    value = int(expr[1])
+                    taken = next((body for values, body in cases if value in values), else_body)
+                    for _, body in cases:
+                        if body is not taken:
+                            result.extend(kept_buffers(body))
+                    if else_body is not taken:
+                        result.extend(kept_buffers(else_body or []))
+                    result.extend(fold_block(taken or [], env, pinned))
+                    continue
+                envs = [dict(env) for _ in range(len(cases) + 1)]
+                cases = [(values, fold_block(body, case_env, pinned))
+                         for (values, body), case_env in zip(cases, envs)]
+                if else_body is not None:
+                    else_body = fold_block(else_body, envs[-1], pinned)
+                # keep what every path agrees on
+                for var in list(env):
+                    if any(case_env.get(var) != env[var] for case_env in envs):
+                        del env[var]
+                result.append(("match", expr, cases, else_body))
+
+            case ("for", init, cond, post, body):
+                if init:
+                    [init] = fold_block([init], env, pinned)
+                if const_cond(fold_expr(cond, env)) is False:
+                    # never entered
+                    if init:
+                        result.append(init)
+                    result.extend(kept_buffers(body))
+                    continue
+                # anything assigned in the loop is unknown at its start
+                for var in assigned_vars(body + [post] if post else body):
+                    env.pop(var, None)
+                cond = fold_expr(cond, env)
+                body_env = dict(env)
+                body = fold_block(body, body_env, pinned)
+                if post:
+                    [post] = fold_block([post], body_env, pinned)
+                result.append(("for", init, cond, post, body))
+
+            case ("ret", expr):
+                result.append(("ret", expr and fold_expr(expr, env)))
+
+            case ("call", _, _):
+                node = fold_expr(node, env)
+                # a call evaluated at compile time has no effect left
+                if node[0] == "call":
+                    result.append(node)
+
+            case _:
+                result.append(node)
+    return result
+
 
-    def collect_arg(tok):
-        """Process a token and return an arg tuple"""
-        if tok[0] == "str":
-            # string literal - get or create label
-            label = get_literal_string(tok[1])
-            return ("strlit", label)
-        elif tok[0] in ("deref", "addr"):
-            idx = None
-            if peek() == "[":
-                advance()
-                idx_tok = next_token()
-                next_token()  # skip ]
-                idx = idx_tok[1] if idx_tok else None
-            return (tok[0], tok[1], idx)
-        elif tok[0] == "word" and tok[1] in functions:
-            # nested function call - parse it recursively
-            inner_asm = parse_call(tok[1])
-            return ("call_result", inner_asm)
+# --- Compile-time evaluation ---
+# A call whose arguments are all constants is evaluated by interpreting
+# the callee. Anything with an effect (asm, stores, memory access through
+# pointers) makes it non-constant and the call is left alone. String
+# literals are treated as constants.
+EVAL_STEPS = 10000  # interpreter budget per call site
+EVAL_DEPTH = 32
+SPECIALIZE_MAX_STATEMENTS = 8
+
+fold_fns = {}  # name -> fn node of the program being folded
+eval_cache = {}  # (name, args) -> constant node or None
+specializations = {}  # (name, string args) -> specialized fn node or None
+
+
+class NotConstant(Exception):
+    pass
+
+
+def c_strcmp(a, b):
+    a, b = a.encode() + b"\0", b.encode() + b"\0"
+    for x, y in zip(a, b):
+        if x != y or x == 0:
+            return x - y
+    return 0
+
+
+# std.un routines written in asm, by what they compute
+PURE_BUILTINS = {
+    "strlen": lambda s: len(s.encode()),
+    "strcmp": c_strcmp,
+}
+builtin_fns = set()  # the PURE_BUILTINS whose calls resolve to std.un's definitions
+
+
+def std_builtins(std_toks, program):
+    """The PURE_BUILTINS that calls in program resolve to std.un's
+    definitions of, given std.un's tokens: std.un defines them and
+    nothing else in program does"""
+    defined = scan_fn_names(std_toks)
+    counts = collections.Counter(node[1] for node in program if node[0] == "fn")
+    return {name for name in PURE_BUILTINS if name in defined and counts[name] == 1}
+
+
+def eval_call(name, args):
+    """Constant node for name(args) with constant args, or None"""
+    key = (name, tuple(args))
+    if key not in eval_cache:
+        try:
+            value = call_value(name, [int(a[1]) if a[0] == "num" else a[1] for a in args],
+                               [EVAL_STEPS], 0)
+            eval_cache[key] = ("str", value) if isinstance(value, str) else ("num", str(wrap(value)))
+        except NotConstant:
+            eval_cache[key] = None
+    return eval_cache[key]
+
+
+def call_value(name, args, budget, depth):
+    if name in builtin_fns:
+        try:
+            return PURE_BUILTINS[name](*args)
+        except (TypeError, AttributeError):
+            raise NotConstant
+    node = fold_fns.get(name)
+    if node is None or depth > EVAL_DEPTH or len(args) != len(node[2]):
+        raise NotConstant
+    result = run_block(node[3], dict(zip(node[2], args)), budget, depth + 1)
+    # falling off the end returns 0
+    return result[0] if result else 0
+
+
+def run_block(body, env, budget, depth):
+    """Interpret body; returns (value,) on ret, None at the end"""
+    for node in body:
+        match node:
+            case ("assign", name, expr):
+                env[name] = eval_value(expr, env, budget, depth)
+            case ("if", cond, body, else_body):
+                branch = body if eval_value(cond, env, budget, depth) else else_body or []
+                result = run_block(branch, env, budget, depth)
+                if result:
+                    return result
+            case ("match", expr, cases, else_body):
+                value = wrap(eval_value(expr, env, budget, depth))
+                branch = next((body for values, body in cases if value in values), else_body)
+                result = run_block(branch or [], env, budget, depth)
+                if result:
+                    return result
+            case ("for", init, cond, post, body):
+                if init:
+                    run_block([init], env, budget, depth)
+                while eval_value(cond, env, budget, depth):
+                    result = run_block(body, env, budget, depth)
+                    if result:
+                        return result
+                    if post:
+                        run_block([post], env, budget, depth)
+            case ("ret", expr):
+                return (eval_value(expr, env, budget, depth) if expr else 0,)
+            case ("call", _, _):
+                eval_value(node, env, budget, depth)
+            case _:
+                raise NotConstant
+    return None
+
+
+def eval_value(node, env, budget, depth):
+    budget[0] -= 1
+    if budget[0] < 0:
+        raise NotConstant
+    match node:
+        case ("num", value):
+            return int(value)
+        case ("str", content):
+            return content
+        case ("var", name) if name in env:
+            return env[name]
+        case ("index", name, index) if isinstance(env.get(name), str):
+            data = env[name].encode() + b"\0"
+            i = eval_value(index, env, budget, depth)
+            if isinstance(i, int) and 0 <= i < len(data):
+                return data[i]
+        case ("binop", op, left, right):
+            a = eval_value(left, env, budget, depth)
+            b = eval_value(right, env, budget, depth)
+            if isinstance(a, int) and isinstance(b, int):
+                value = fold_binop(op, a, b)
+                if value is not None:
+                    return value
+        case ("cmp", op, left, right):
+            a = eval_value(left, env, budget, depth)
+            b = eval_value(right, env, budget, depth)
+            if isinstance(a, int) and isinstance(b, int):
+                return COMPARE[op](a, b)
+        case ("call", name, args):
+            return call_value(name, [eval_value(arg, env, budget, depth) for arg in args],
+                              budget, depth)
+    raise NotConstant
+
+
+def specialize(name, args):
+    """Call of a copy of name with its string literal arguments bound, when
+    that lets calls inside it be evaluated at compile time, else None"""
+    key = (name, tuple(arg if arg[0] == "str" else None for arg in args))
+    if key not in specializations:
+        specializations[key] = None  # in progress, for recursive functions
+        specializations[key] = make_specialization(name, args)
+    clone = specializations[key]
+    if clone is None:
+        return None
+    return ("call", clone[1], [arg for arg in args if arg[0] != "str"])
+
+
+def make_specialization(name, args):
+    node = fold_fns.get(name)
+    if node is None:
+        return None
+    _, name, params, body = node
+    if len(args) != len(params) or len(body) > SPECIALIZE_MAX_STATEMENTS \
+            or any(stmt[0] == "for" for stmt in walk_statements(body)):
+        return None
+    bound = {p: arg for p, arg in zip(params, args) if arg[0] == "str"}
+    stored = {stmt[1] for stmt in walk_statements(body) if stmt[0] == "store"}
+    if bound.keys() & (assigned_vars(body) | stored | addressed_vars(node)):
+        return None
+    folded = fold_function(node, body, dict(bound))
+    if count_calls(folded) >= count_calls(body):
+        return None
+    # asm blocks and indexing still refer to the parameter by name
+    prologue = [("assign", p, arg) for p, arg in bound.items() if uses_var(folded, p)]
+    params = [p for p in params if p not in bound]
+    return ("fn", f"{name}.{len(specializations)}", params, prologue + folded)
+
+
+def count_calls(node):
+    if isinstance(node, list):
+        return sum(count_calls(child) for child in node)
+    if not isinstance(node, tuple):
+        return 0
+    return (node[0] == "call") + sum(count_calls(child) for child in node[1:])
+
+
+def uses_var(node, name):
+    if isinstance(node, list):
+        return any(uses_var(child, name) for child in node)
+    if not isinstance(node, tuple):
+        return False
+    match node:
+        case ("var" | "addr" | "index" | "deref", var, *_) if var == name:
+            return True
+        case ("asm", lines):
+            return any(name in ASM_VAR_RE.findall(line) for line in lines)
+    return any(uses_var(child, name) for child in node[1:])
+
+
+# --- Dead function elimination ---
+# Only the functions reachable through calls from the roots, _start, the
+# functions marked export and those other modules call, are emitted. Any
+# function name appearing in an asm block counts as a call.
+dead_fn_enabled = True
+removed_fns = []  # functions dropped, over all modules
+
+
+def called_fns(body, names):
+    """The functions out of names that body calls or mentions in asm"""
+    found = set()
+
+    def visit(node):
+        match node:
+            case ("call", name, _):
+                found.add(name)
+            case ("asm", lines):
+                found.update(word for line in lines for word in WORD_RE.findall(line))
+        return node
+
+    rewrite(body, visit)
+    return found & names
+
+
+def reachable_fns(program, roots):
+    """Names of the functions of program reachable from roots"""
+    bodies = {node[1]: node[3] for node in program if node[0] == "fn"}
+    live = set()
+    todo = [name for name in roots if name in bodies]
+    while todo:
+        name = todo.pop()
+        if name not in live:
+            live.add(name)
+            todo.extend(called_fns(bodies[name], bodies.keys()))
+    return live
+
+
+def program_roots(program):
+    """_start and the functions of program marked export"""
+    return {node[1] for node in program
+            if node[0] == "fn" and (node[1] == "_start" or node[1] in fn_exported)}
+
+
+def drop_dead_fns(program, roots):
+    """program without the functions unreachable from roots; mem buffers
+    they declare are kept"""
+    live = reachable_fns(program, roots)
+    if not live:
+        # nothing anchors the program, so there is nothing to measure against
+        return program
+    result = []
+    for node in program:
+        if node[0] == "fn" and node[1] not in live:
+            removed_fns.append(node[1])
+            result.extend(kept_buffers(node[3]))
         else:
-            return tok
+            result.append(node)
+    return result
 
-    # check for parentheses syntax: fn(a, b)
-    skip_ws()
-    if peek() == "(":
-        advance()  # skip (
-        while True:
-            skip_ws()
-            if peek() == ")":
-                advance()
-                break
-            tok = next_token()
-            if tok and tok[0] in ("num", "word", "addr", "deref", "str"):
-                args.append(collect_arg(tok))
-            skip_ws()
-            if peek() == ",":
-                advance()
-    else:
-        # space-separated: fn a b
-        while True:
-            tok = next_token()
-            if tok is None or tok[0] == "nl":
-                break
-            if tok[0] == "lbracket":
-                continue
-            if tok[0] in ("num", "word", "addr", "deref", "str"):
-                args.append(collect_arg(tok))
-
-    # Handle nested calls first - emit their code and push results
-    nested_indices = []
-    for i, arg in enumerate(args):
-        if arg[0] == "call_result":
-            asm.append(arg[1])  # emit the nested call
-            asm.append("    push rax")  # save result
-            nested_indices.append(i)
-
-    # Pop nested results in reverse order and load into correct regs
-    # But first, load simple args
-    for i, arg in enumerate(args):
-        if arg[0] != "call_result":
-            asm.append(load_arg_ext(arg, arg_regs[i]))
-
-    # Now pop nested call results into their registers (reverse order)
-    for i in reversed(nested_indices):
-        asm.append(f"    pop {arg_regs[i]}")
-
-    asm.append(f"    call {fn_name}")
-    return "\n".join(asm)
-
-
-def load_arg_ext(tok, reg):
-    """Load arg into register, handling extended tuples for indexed deref/addr"""
-    if tok[0] == "strlit":
-        # string literal - tok[1] is the label
-        return f"    mov {reg}, {tok[1]}"
-    elif tok[0] == "call_result":
-        # handled separately via push/pop
-        return ""
-    elif len(tok) == 3 and tok[0] in ("deref", "addr"):
-        var_name = tok[1]
-        idx = tok[2]
-        if tok[0] == "deref":
-            asm = []
-            if var_name in string_vars:
-                asm.append(f"    mov {reg}, {string_vars[var_name]}")
-            else:
-                off = var_offset(var_name)
-                asm.append(f"    mov {reg}, [rbp - {off}]")
-            if idx is not None:
-                asm.append(f"    mov {reg}, [{reg} + {int(idx) * 8}]")
-            else:
-                asm.append(f"    mov {reg}, [{reg}]")
-            return "\n".join(asm)
-        else:  # addr
-            if var_name in string_vars:
-                return f"    mov {reg}, {string_vars[var_name]}"
-            else:
-                off = var_offset(var_name)
-                return f"    lea {reg}, [rbp - {off}]"
-    else:
-        return load_arg(tok, reg)
 
+# --- Loop optimization ---
+# Strength reduction on induction variables: variables stepped by a
+# constant in a for loop's post statement and not assigned in its body.
+loop_opt_enabled = True
 
-def parse_expr(first_tok):
-    # check if it's a function call
-    if first_tok[0] == "word" and first_tok[1] in functions:
-        return parse_call(first_tok[1])
 
-    # normal expression
-    asm = [load_val(first_tok)]
-    while True:
-        tok = next_token()
-        if tok is None or tok[0] == "nl":
-            break
-        if tok[0] == "op":
-            right = next_token()
-            match tok[1]:
-                case "+":
-                    asm.append(load_val_rbx(right))
-                    asm.append("    add rax, rbx")
-                case "-":
-                    asm.append(load_val_rbx(right))
-                    asm.append("    sub rax, rbx")
-                case "*":
-                    asm.append(load_val_rbx(right))
-                    asm.append("    imul rax, rbx")
-                case "/":
-                    asm.append("    xor rdx, rdx")
-                    asm.append(load_val_rbx(right))
-                    asm.append("    idiv rbx")
-    return "\n".join(asm)
-
-
-# --- First pass: collect functions, variables and strings ---
-while pos < len(prog):
-    # skip asm block contents
-    if blocks and blocks[-1] == "asm":
-        skip_ws()
-        if peek() == "\n":
-            advance()
-            continue
-        line = read_until_newline().strip()
-        if line == "end":
-            blocks.pop()
-        continue
-
-    # handle mem block contents
-    if blocks and blocks[-1] == "mem":
-        skip_ws()
-        if peek() == "\n":
-            advance()
-            continue
-        name = read_word()
-        if name == "end":
-            blocks.pop()
-            skip_line()
-            continue
-        skip_ws()
-        # read size expression until newline
-        size_expr = read_until("\n").strip()
-        if name and size_expr:
-            size = eval_const_expr(size_expr)
-            mem_buffers.append((name, size))
-        skip_line()
-        continue
+def count_uses(node, name):
+    """Reads and writes of variable name inside node"""
+    if isinstance(node, list):
+        return sum(count_uses(child, name) for child in node)
+    if not isinstance(node, tuple):
+        return 0
+    match node:
+        case ("var" | "addr" | "index" | "deref" | "assign" | "store", var, *_) if var == name:
+            own = 1
+        case ("asm", lines):
+            return sum(ASM_VAR_RE.findall(line).count(name) for line in lines)
+        case _:
+            own = 0
+    return own + sum(count_uses(child, name) for child in node[1:])
 
-    tok = next_token()
-    if tok is None:
-        break
-    if tok[0] == "nl":
-        continue
-
-    if tok == ("word", "fn"):
-        blocks.append("fn")
-        skip_ws()
-        name = read_word()
-        params = read_params()
+
+def rewrite(node, fn):
+    """Apply fn to every tuple in node, innermost first"""
+    if isinstance(node, list):
+        return [rewrite(child, fn) for child in node]
+    if isinstance(node, tuple):
+        return fn(tuple(rewrite(child, fn) for child in node))
+    return node
+
+
+def induction_step(loop, pinned):
+    """(variable, step) when the for loop steps a variable by a constant"""
+    _, init, cond, post, body = loop
+    match post:
+        case ("assign", var, ("binop", "+" | "-" as op, ("var", same), ("num", step))) \
+                if var == same and var not in pinned and var not in assigned_vars(body):
+            return var, int(step) if op == "+" else -int(step)
+    return None
+
+
+def reduce_loops(program):
+    """Strength-reduce the for loops of every function in program"""
+    result = []
+    for node in program:
+        if node[0] == "fn":
+            _, name, params, body = node
+            pinned = addressed_vars(node)
+            for stmt in walk_statements(body):
+                if stmt[0] == "asm":
+                    pinned |= {v for line in stmt[1] for v in ASM_VAR_RE.findall(line)}
+            node = ("fn", name, params, reduce_block(body, body, pinned))
+        result.append(node)
+    return result
+
+
+def reduce_block(body, fn_body, pinned):
+    result = []
+    for node in body:
+        match node:
+            case ("if", cond, then_body, else_body):
+                node = ("if", cond, reduce_block(then_body, fn_body, pinned),
+                        else_body and reduce_block(else_body, fn_body, pinned))
+            case ("match", expr, cases, else_body):
+                node = ("match", expr,
+                        [(values, reduce_block(body, fn_body, pinned)) for values, body in cases],
+                        else_body and reduce_block(else_body, fn_body, pinned))
+            case ("for", init, cond, post, loop_body):
+                node = ("for", init, cond, post, reduce_block(loop_body, fn_body, pinned))
+                step = induction_step(node, pinned)
+                if step:
+                    node = walk_pointer(node, *step, fn_body) or node
+                    result.extend(derive_products(node, *step))
+                    continue
+        result.append(node)
+    return result
+
+
+def walk_pointer(loop, var, step, fn_body):
+    """A loop whose counter only indexes one buffer, s[i] or @s[i], and is
+    not used outside the loop, becomes a pointer walking that buffer"""
+    _, init, cond, post, body = loop
+    if not init or init[1] != var:
+        return None
+    accesses = set()
+
+    def find(node):
+        match node:
+            case ("index" | "deref" as kind, base, ("var", index)) if index == var:
+                accesses.add((kind, base))
+            case ("store", base, ("var", index), _) if index == var:
+                accesses.add(("index", base))
+        return node
+
+    rewrite([cond, body], find)
+    if len(accesses) != 1:
+        return None
+    [(kind, base)] = accesses
+    uses = count_uses(loop, var)
+    # the counter may appear only in the init, the post and the accesses
+    if base == var or base in assigned_vars(body) or uses != count_uses(fn_body, var) \
+            or uses != 3 + count_accesses([cond, body], kind, base, var):
+        return None
+    scale = 8 if kind == "deref" else 1
+
+    def to_pointer(node):
+        match node:
+            case (kind_, base_, ("var", index)) if (kind_, base_, index) == (kind, base, var):
+                return (kind, var, ("num", "0"))
+            case ("store", base_, ("var", index), value) if (base_, index) == (base, var):
+                return ("store", var, ("num", "0"), value)
+        return node
+
+    start = init[2] if scale == 1 else ("binop", "*", init[2], ("num", "8"))
+    pointer = ("var", base) if start == ("num", "0") else ("binop", "+", ("var", base), start)
+    return ("for", ("assign", var, pointer),
+            rewrite(cond, to_pointer),
+            ("assign", var, ("binop", "+", ("var", var), ("num", str(step * scale)))),
+            rewrite(body, to_pointer))
+
+
+def count_accesses(node, kind, base, var):
+    if isinstance(node, list):
+        return sum(count_accesses(child, kind, base, var) for child in node)
+    if not isinstance(node, tuple):
+        return 0
+    own = node == (kind, base, ("var", var)) \
+        or kind == "index" and node[:3] == ("store", base, ("var", var))
+    return own + sum(count_accesses(child, kind, base, var) for child in node[1:])
+
+
+def derive_products(loop, var, step):
+    """Replace var * k in the loop by a variable that is set before the
+    loop and advanced by step * k at the end of each iteration. Returns
+    the statements that replace the loop."""
+    _, init, cond, post, body = loop
+    factors = set()
+
+    def find(node):
+        match node:
+            case ("binop", "*", ("var", v), ("num", k)) | ("binop", "*", ("num", k), ("var", v)) \
+                    if v == var:
+                factors.add(int(k))
+        return node
+
+    rewrite([cond, body], find)
+    if not factors:
+        return [loop]
+
+    def to_derived(node):
+        match node:
+            case ("binop", "*", ("var", v), ("num", k)) | ("binop", "*", ("num", k), ("var", v)) \
+                    if v == var:
+                return ("var", f"{var}*{k}")
+        return node
+
+    setup = [init] if init else []
+    updates = []
+    for k in sorted(factors):
+        derived = f"{var}*{k}"
+        setup.append(("assign", derived, ("binop", "*", ("var", var), ("num", str(k)))))
+        updates.append(("assign", derived, ("binop", "+", ("var", derived), ("num", str(step * k)))))
+    return setup + [("for", None, rewrite(cond, to_derived), post, rewrite(body, to_derived) + updates)]
+
+
+# --- Symbol collection ---
+def collect_symbols(program, extern_buffers=frozenset()):
+    """Fill functions, fn_vars, fn_stack, fn_strings and mem_buffers"""
+    global current_fn, vars, stack_size, string_vars
+    refs = {}
+    params_of, summaries = string_writes(program)
+    for node in program:
+        if node[0] == "mem":
+            mem_buffers.extend(node[1])
+            continue
+        _, name, params, body = node
         functions[name] = params
         current_fn = name
         vars = {}
         stack_size = 0
+        string_vars = {}
         # params are variables too
         for p in params:
             var_offset(p)
-        skip_line()
-        continue
-
-    if tok == ("word", "if"):
-        blocks.append("if")
-        skip_line()
-        continue
-
-    if tok == ("word", "else"):
-        skip_line()
-        continue
-
-    if tok == ("word", "mem"):
-        skip_ws()
-        if peek() == "\n":
-            # block style: mem\n  name size\n  ...\nend
-            blocks.append("mem")
-            skip_line()
-            continue
-        # single line: mem name size_expr
-        name = read_word()
-        skip_ws()
-        size_expr = read_until("\n").strip()
-        if name and size_expr:
-            size = eval_const_expr(size_expr)
-            mem_buffers.append((name, size))
-        skip_line()
-        continue
-
-    if tok == ("word", "for"):
-        blocks.append("for")
-        # check for C-style init variable
-        skip_ws()
-        start_pos = pos
-        line = read_until("\n")
-        if ";" in line:
-            # C-style: extract init var
-            init_part = line.split(";")[0].strip()
-            init_tokens = init_part.split()
-            if len(init_tokens) >= 3 and init_tokens[1] == "=":
-                var_offset(init_tokens[0])
-        pos = start_pos
-        skip_line()
-        continue
-
-    if tok == ("word", "end"):
-        if blocks:
-            block = blocks.pop()
-            if block == "fn":
-                fn_vars[current_fn] = vars.copy()
-                fn_stack[current_fn] = stack_size
-                current_fn = None
-        skip_line()
-        continue
-
-    if tok == ("word", "asm"):
-        blocks.append("asm")
-        skip_line()
-        continue
-
-    if tok[0] == "word" and tok[1] == "ret":
-        skip_line()
-        continue
-
-    if tok[0] == "word":
-        name = tok[1]
-        tok2 = next_token()
-        if tok2 and tok2 == ("op", "="):
-            tok3 = next_token()
-            if tok3 and tok3[0] == "str":
-                add_string(name, tok3[1])
-            elif tok3 and tok3[0] in ("num", "word"):
-                var_offset(name)
-        skip_line()
-
-# Register mem buffer names so they can be used like string labels
-for name, size in mem_buffers:
-    string_vars[name] = name
-
-# --- Second pass: generate code ---
-pos = 0
-out = []
-blocks = []
-current_fn = None
+        refs[name] = []
+        written, _ = pointer_flow(body, params_of, summaries)
+        collect_block(body, refs[name], static_strings(params, body, written))
+        fn_vars[name] = vars
+        fn_stack[name] = stack_size
+        fn_strings[name] = string_vars
+    current_fn = None
+
+    # variables that are only read get a slot after the assigned ones
+    buffer_names = {name for name, _ in mem_buffers} | extern_buffers
+    for name, names in refs.items():
+        vars = fn_vars[name]
+        stack_size = fn_stack[name]
+        for var in names:
+            if var not in buffer_names and var not in fn_strings[name]:
+                var_offset(var)
+        fn_stack[name] = stack_size
+
+    for node in program:
+        if node[0] == "fn":
+            allocate_registers(node)
+
+
+# A variable assigned one string literal stands for a label in .rodata
+# unless something may write through it: a store or & in its function,
+# an asm block writing memory at an address made from it, or a call
+# passing it to a parameter its callee writes through. Copies and
+# returned parameters carry the pointer along. What each function does
+# with its parameters is found for the whole program at once; callees
+# outside it are assumed to write through and return every argument.
+READ_ONLY_SYSCALLS = {1, 3, 9, 11, 12, 39, 60, 231}  # write, close, mmap, munmap, brk, ...
+NON_WRITING_MNEMONICS = {"cmp", "test", "push", "bt", "call", "ptest", "comisd", "ucomisd"}
+POINTER_REGS = ("rdi", "rsi", "rdx", "r10", "r8", "r9")
+
+
+def asm_pointer_flow(lines):
+    """(names written through, [(name, names it may point into)]) for an
+    asm block. Variables are followed through the registers they are
+    loaded into, never forgetting one, until the block is stable; anything
+    pushed or stored to memory may come back from a pop or a load."""
+    taint = {}  # 64-bit register -> names its value may point into
+    spilled = set()
+    written = set()
+    aliases = []
+
+    def address(operand):
+        inside = operand[operand.index("["):]
+        names = set(ASM_VAR_RE.findall(inside))
+        for word in WORD_RE.findall(ASM_VAR_RE.sub("", inside)):
+            names |= taint.get(register_of(word), set())
+        return names
+
+    def value(operand):
+        if "[" in operand:
+            return set(spilled)
+        return address(f"[{operand}]")
 
-# Note: .data section will be prepended after code generation
-# so that string literals from parse_call are included
-
-out.append("section .text")
-out.append("")
+    while True:
+        before = (sum(map(len, taint.values())), len(spilled), len(written))
+        syscall_nr = None
+        for line in lines:
+            insn = parse_insn("    " + line)
+            if insn is None:
+                syscall_nr = None  # a label can be jumped to from anywhere
+                continue
+            mnemonic, ops = insn
+            if mnemonic in REPEAT_PREFIXES and ops:
+                mnemonic, ops = ops[0], []
+            if mnemonic.startswith(("stos", "movs")) and not ops:
+                written |= taint.get("rdi", set())
+            elif mnemonic == "syscall":
+                if syscall_nr not in READ_ONLY_SYSCALLS:
+                    written |= set().union(*(taint.get(reg, set()) for reg in POINTER_REGS))
+            elif mnemonic == "call":
+                written |= spilled.union(*taint.values())
+            elif mnemonic == "push":
+                spilled |= value(ops[0])
+            elif mnemonic == "pop" and register_of(ops[0]):
+                taint.setdefault(register_of(ops[0]), set()).update(spilled)
+            elif ops and any("[" in op for op in ops[:1 + (mnemonic == "xchg")]) \
+                    and mnemonic not in NON_WRITING_MNEMONICS and not mnemonic.startswith("j"):
+                written |= set().union(*(address(op) for op in ops if "[" in op))
+                spilled |= set().union(*(value(op) for op in ops[1:]))
+            elif len(ops) > 1:
+                source = address(ops[1]) if mnemonic == "lea" else value(ops[1])
+                reg = register_of(ops[0])
+                if reg:
+                    taint.setdefault(reg, set()).update(source)
+                    if reg == "rax":
+                        syscall_nr = asm_number(ops[1]) if mnemonic == "mov" else \
+                            0 if mnemonic == "xor" and ops[0] == ops[1] else None
+                else:
+                    aliases.extend((name, source) for name in ASM_VAR_RE.findall(ops[0]))
+        if (sum(map(len, taint.values())), len(spilled), len(written)) == before:
+            return written, aliases
+
+
+def pointer_flow(body, params_of, summaries):
+    """(names written through, names that may be returned) for the body
+    of a function, given each function's params and its summary: the
+    params it writes through and those it may return"""
+    written = set()
+    returned = set()
+    aliases = []
+
+    def pointees(expr):
+        """Variables whose strings the value of expr may point into"""
+        match expr:
+            case ("var" | "addr", name):
+                return {name}
+            case ("binop", _, left, right):
+                return pointees(left) | pointees(right)
+            case ("call", callee, args):
+                return set().union(*(pointees(arg) for arg in passed(callee, args, 1)))
+        return set()
+
+    def passed(callee, args, kind):
+        """The args of a call that go to params written through (kind 0)
+        or maybe returned (kind 1)"""
+        if callee not in summaries:
+            return args
+        return [arg for p, arg in zip(params_of[callee], args) if p in summaries[callee][kind]]
+
+    def visit(node):
+        match node:
+            case ("store" | "addr", name, *_):
+                written.add(name)
+            case ("asm", lines):
+                asm_written, asm_aliases = asm_pointer_flow(lines)
+                written.update(asm_written)
+                aliases.extend(asm_aliases)
+            case ("call", callee, args):
+                for arg in passed(callee, args, 0):
+                    written.update(pointees(arg))
+            case ("assign", name, expr):
+                aliases.append((name, pointees(expr)))
+            case ("ret", expr) if expr:
+                returned.update(pointees(expr))
+        return node
+
+    rewrite(body, visit)
+    changed = True
+    while changed:
+        changed = False
+        for name, names in aliases:
+            for flow in (written, returned):
+                if name in flow and not names <= flow:
+                    flow |= names
+                    changed = True
+    return written, returned
+
+
+def string_writes(program):
+    """The params each function of program writes through and may return,
+    grown from nothing until every call site agrees"""
+    fns = {node[1]: node for node in program if node[0] == "fn"}
+    params_of = {name: node[2] for name, node in fns.items()}
+    summaries = {name: (set(), set()) for name in fns}
+    changed = True
+    while changed:
+        changed = False
+        for name, (_, _, params, body) in fns.items():
+            written, returned = pointer_flow(body, params_of, summaries)
+            summary = (written & set(params), returned & set(params))
+            if summary != summaries[name]:
+                summaries[name] = summary
+                changed = True
+    return params_of, summaries
+
+
+def static_strings(params, body, written):
+    """The variables assigned one string literal and nothing else, which
+    stand for its label, mapped to whether anything writes through them.
+    A variable assigned more than once holds a pointer like any other."""
+    assigned = {}
+    for stmt in walk_statements(body):
+        if stmt[0] == "assign":
+            assigned.setdefault(stmt[1], []).append(stmt[2])
+    return {name: name in written for name, exprs in assigned.items()
+            if len(exprs) == 1 and exprs[0][0] == "str" and name not in params}
+
+
+def collect_block(body, refs, static):
+    for node in body:
+        match node:
+            case ("assign", name, expr):
+                if name in static:
+                    add_string(name, expr[1], static[name])
+                else:
+                    var_offset(name)
+                    collect_refs(expr, refs)
+            case ("store", name, index, value):
+                refs.append(name)
+                collect_refs(index, refs)
+                collect_refs(value, refs)
+            case ("if", cond, body, else_body):
+                collect_refs(cond, refs)
+                collect_block(body, refs, static)
+                if else_body:
+                    collect_block(else_body, refs, static)
+            case ("match", expr, cases, else_body):
+                collect_refs(expr, refs)
+                for _, body in cases:
+                    collect_block(body, refs, static)
+                if else_body:
+                    collect_block(else_body, refs, static)
+            case ("for", init, cond, post, body):
+                for stmt in (init, post):
+                    if stmt:
+                        var_offset(stmt[1])
+                        collect_refs(stmt[2], refs)
+                collect_refs(cond, refs)
+                collect_block(body, refs, static)
+            case ("ret", expr):
+                if expr:
+                    collect_refs(expr, refs)
+            case ("asm", lines):
+                for line in lines:
+                    refs.extend(ASM_VAR_RE.findall(line))
+            case ("call", _, _):
+                collect_refs(node, refs)
+            case ("mem", buffers):
+                mem_buffers.extend(buffers)
+
+
+def collect_refs(node, refs):
+    """Append the variable names read by an expression to refs"""
+    match node:
+        case ("var", name) | ("addr", name):
+            refs.append(name)
+        case ("index", name, index) | ("deref", name, index):
+            refs.append(name)
+            if index:
+                collect_refs(index, refs)
+        case ("binop", _, left, right) | ("cmp", _, left, right):
+            collect_refs(left, refs)
+            collect_refs(right, refs)
+        case ("call", _, args):
+            for arg in args:
+                collect_refs(arg, refs)
+
+
+# --- Register allocation ---
+# Callee-saved registers that can hold locals. rbx is left out because
+# code generation uses it as the right operand scratch.
+ALLOC_REGS = ["r12", "r13", "r14", "r15"]
+ALLOC_REG_RE = re.compile(r"\b(r1[2-5])[dwb]?\b")
+
+
+def live_intervals(params, body):
+    """Compute var -> [start, end, weight] over a linear numbering of the
+    statements. Uses are weighted by 10 per enclosing loop, and a variable
+    that occurs in a loop is live for the whole loop."""
+    intervals = {}
+    loops = []
+    point = 0
+
+    def use(names, depth):
+        for name in names:
+            interval = intervals.get(name)
+            if interval is None:
+                intervals[name] = [point, point, 10 ** depth]
+            else:
+                interval[1] = point
+                interval[2] += 10 ** depth
+
+    def uses(node):
+        names = []
+        collect_refs(node, names)
+        return names
+
+    def walk(body, depth):
+        nonlocal point
+        for node in body:
+            point += 1
+            match node:
+                case ("assign", name, expr):
+                    use(uses(expr), depth)
+                    use([name], depth)
+                case ("store", name, index, value):
+                    use([name] + uses(index) + uses(value), depth)
+                case ("if", cond, body, else_body):
+                    use(uses(cond), depth)
+                    walk(body, depth)
+                    walk(else_body or [], depth)
+                case ("match", expr, cases, else_body):
+                    use(uses(expr), depth)
+                    for _, body in cases:
+                        walk(body, depth)
+                    walk(else_body or [], depth)
+                case ("for", init, cond, post, body):
+                    if init:
+                        use(uses(init[2]) + [init[1]], depth)
+                    point += 1
+                    start = point
+                    use(uses(cond), depth + 1)
+                    walk(body, depth + 1)
+                    if post:
+                        walk([post], depth + 1)
+                    loops.append((start, point))
+                case ("ret", expr) if expr:
+                    use(uses(expr), depth)
+                case ("call", _, _):
+                    use(uses(node), depth)
+
+    use(params, 0)
+    walk(body, 0)
+
+    changed = True
+    while changed:
+        changed = False
+        for loop_start, loop_end in loops:
+            for interval in intervals.values():
+                start, end = interval[0], interval[1]
+                if start <= loop_end and end >= loop_start:
+                    if start > loop_start or end < loop_end:
+                        interval[0] = min(start, loop_start)
+                        interval[1] = max(end, loop_end)
+                        changed = True
+    return intervals
+
+
+def linear_scan(intervals, free):
+    """Assign registers from free to intervals; when none is free, the
+    lowest weight interval among the live ones stays on the stack"""
+    assigned = {}
+    active = []
+    free = list(free)
+    for name in sorted(intervals, key=lambda n: intervals[n][0]):
+        start, end, weight = intervals[name]
+        for other in list(active):
+            if intervals[other][1] < start:
+                active.remove(other)
+                free.append(assigned[other])
+        if free:
+            free.sort(key=ALLOC_REGS.index)
+            assigned[name] = free.pop(0)
+        else:
+            victim = min(active, key=lambda n: intervals[n][2])
+            if intervals[victim][2] >= weight:
+                continue
+            active.remove(victim)
+            assigned[name] = assigned.pop(victim)
+        active.append(name)
+    return assigned
+
+
+def allocate_registers(node):
+    """Move a function's hottest locals from stack slots into callee-saved
+    registers and rebuild its frame for the rest"""
+    global vars, stack_size
+    _, name, params, body = node
+    old_vars = fn_vars[name]
+
+    # variables used by asm blocks or whose address is taken stay in memory,
+    # registers that asm blocks touch are not handed out
+    pinned = set()
+    asm_regs = set()
+    for stmt in walk_statements(body):
+        if stmt[0] == "asm":
+            for line in stmt[1]:
+                pinned.update(ASM_VAR_RE.findall(line))
+                asm_regs.update(ALLOC_REG_RE.findall(line))
+        else:
+            pinned.update(addressed_vars(stmt))
+
+    intervals = {
+        var: interval
+        for var, interval in live_intervals(params, body).items()
+        if var in old_vars and var not in pinned
+    }
+    assigned = linear_scan(intervals, [r for r in ALLOC_REGS if r not in asm_regs])
+
+    vars = {}
+    stack_size = 0
+    for var in old_vars:
+        if var not in assigned:
+            var_offset(var)
+    # asm blocks may clobber callee-saved registers too, so save those as well
+    saved = []
+    for reg in ALLOC_REGS:
+        if reg in assigned.values() or reg in asm_regs:
+            stack_size += 8
+            saved.append((reg, stack_size))
+    fn_vars[name] = vars
+    fn_stack[name] = stack_size
+    fn_regs[name] = assigned
+    fn_saved[name] = saved
+
+
+def walk_statements(body):
+    """Yield every statement in body, including nested ones"""
+    for node in body:
+        yield node
+        match node:
+            case ("if", _, body, else_body):
+                yield from walk_statements(body)
+                yield from walk_statements(else_body or [])
+            case ("for", init, _, post, body):
+                yield from walk_statements([s for s in (init, post) if s])
+                yield from walk_statements(body)
+            case ("match", _, cases, else_body):
+                for _, body in cases:
+                    yield from walk_statements(body)
+                yield from walk_statements(else_body or [])
+
+
+def addressed_vars(node):
+    """Names used with & anywhere inside node"""
+    if not isinstance(node, tuple):
+        return set()
+    if node[0] == "addr":
+        return {node[1]}
+    names = set()
+    for child in node[1:]:
+        if isinstance(child, tuple):
+            names |= addressed_vars(child)
+        elif isinstance(child, list):
+            for item in child:
+                names |= addressed_vars(item)
+    return names
+
+
+# --- Code generation ---
+# Each function is generated on its own, with its labels numbered from 0
+# and its literals named by placeholders, so that functions can go to a
+# process pool. The results are merged in program order, which gives the
+# literals the labels a serial build gives them.
+out = []
+codegen_jobs = 1  # processes generating functions
+PARALLEL_MIN_FNS = 64  # fewer functions than this are generated serially
+codegen_fns = []  # fn nodes of the program, read by pool workers
+unit_literals = {}  # content -> placeholder label in the current function
+PLACEHOLDER_RE = re.compile(r"_str\?(\d+)")
+
+# Registers expressions are evaluated in, in order of preference. They
+# include the argument registers and are all clobbered by calls; rdx is
+# last because idiv needs it.
+EXPR_REGS = ["rax", "rcx", "rsi", "rdi", "r8", "r9", "r10", "r11", "rbx", "rdx"]
+BINOP_INSN = {"+": "add", "-": "sub", "*": "imul", "cmp": "cmp"}
 
 fn_end = """\
     mov rsp, rbp
@@ -802,350 +2511,2066 @@ fn_end = """\
     mov rax, 0
     ret"""
 
-while pos < len(prog):
-    if blocks and blocks[-1] == "asm":
-        skip_ws()
-        if peek() == "\n":
-            advance()
-            continue
-        line = read_until_newline().strip()
-        if line == "end":
-            blocks.pop()
-        else:
-            line = re.sub(r"\$(\w+)", replace_var, line)
-            out.append("    " + line)
-        continue
-
-    tok = next_token()
-    if tok is None:
-        break
-    if tok[0] == "nl":
-        continue
-
-    match tok:
-        case ("word", "fn"):
-            blocks.append("fn")
-            skip_ws()
-            name = read_word()
-            params = read_params()
-            current_fn = name
-            vars = fn_vars[name]
-            stack_size = fn_stack[name]
-
-            out.append(f"global {name}")
-            out.append(f"{name}:")
-            out.append("    push rbp")
-            out.append("    mov rbp, rsp")
-            out.append(f"    sub rsp, {stack_size}")
-
-            # copy args from registers to stack
-            for i, p in enumerate(params):
-                off = vars[p]
-                out.append(f"    mov [rbp - {off}], {arg_regs[i]}")
-
-            skip_line()
-
-        case ("word", "if"):
-            left = next_token()
-            cmp_op = next_token()
-            right = next_token()
-            skip_line()
-
-            out.append(load_val(left))
-            out.append(load_val_rbx(right))
-            out.append("    cmp rax, rbx")
-
-            else_label = f".if_else_{label_count}"
-            end_label = f".if_end_{label_count}"
-            label_count += 1
 
-            jump = {
-                "<": "jge",
-                ">": "jle",
-                "==": "jne",
-                "!=": "je",
-                "<=": "jg",
-                ">=": "jl",
-            }
-            out.append(f"    {jump[cmp_op[1]]} {else_label}")
+def var_loc(name):
+    """Operand for a local: its register or its stack slot"""
+    if name in regs:
+        return regs[name]
+    return f"[rbp - {var_offset(name)}]"
 
-            blocks.append(("if", else_label, end_label))
 
-        case ("word", "ret"):
-            first = next_token()
-            expr_asm = parse_expr(first)
-            out.append(expr_asm)
-            out.append("    mov rsp, rbp")
-            out.append("    pop rbp")
-            out.append("    ret")
+def base_operand(name):
+    """Operand holding the pointer that variable name stands for"""
+    if name in string_vars:
+        return string_vars[name]
+    return var_loc(name)
 
-        case ("word", "asm"):
-            blocks.append("asm")
-            skip_line()
 
-        case ("word", "for"):
-            # peek ahead to see if C-style (has ;) or while-style
-            start_pos = pos
-            line = read_until("\n")
-            pos = start_pos  # reset to parse properly
+def load_base(name, reg):
+    """Load the pointer held by variable name into reg"""
+    return f"    mov {reg}, {base_operand(name)}"
 
-            start_label = f".for_start_{label_count}"
-            end_label = f".for_end_{label_count}"
-            label_count += 1
 
-            if ";" in line:
-                # C-style: init; cond; post
-                # parse init
-                init_part = read_until(";")
-                advance()  # skip ;
-                skip_ws()
-
-                # parse condition
-                cond_left = next_token()
-                cond_left_idx = None
-                t = next_token()
-                if t == ("lbracket", None):
-                    cond_left_idx = next_token()
-                    next_token()  # skip ]
-                    cond_op = next_token()
+def reg_address(name, index, scale=""):
+    """[base + index] when the base is a register or a label and the index
+    is a register or a number, else None"""
+    if name in regs:
+        base = regs[name]
+    elif name in string_vars:
+        base = string_vars[name]
+    else:
+        return None
+    if index[0] == "num":
+        offset = int(index[1]) * (8 if scale else 1)
+        return f"[{base} + {offset}]"
+    if index[1] in regs:
+        return f"[{base} + {regs[index[1]]}{scale}]"
+    return None
+
+
+def load_val(node, reg="rax"):
+    """Load an operand into reg, using no register besides reg"""
+    match node:
+        case ("num", value):
+            return f"    mov {reg}, {value}"
+        case ("str", content):
+            return f"    mov {reg}, {literal_placeholder(content)}"
+        case ("var", name):
+            return load_base(name, reg)
+        case ("addr", name):
+            # &x - get address of variable
+            if name in string_vars:
+                return f"    mov {reg}, {string_vars[name]}"
+            return f"    lea {reg}, [rbp - {var_offset(name)}]"
+        case ("deref", name, index):
+            # @x - dereference as qword, @x[i] - indexed qword access
+            if index is None and name in regs:
+                return f"    mov {reg}, [{regs[name]}]"
+            address = index and reg_address(name, index, "*8")
+            if address:
+                return f"    mov {reg}, {address}"
+            if index is None:
+                return f"{load_base(name, reg)}\n    mov {reg}, [{reg}]"
+            if index[0] == "num":
+                return f"{load_base(name, reg)}\n    mov {reg}, [{reg} + {int(index[1]) * 8}]"
+            if index[1] in regs:
+                return f"{load_base(name, reg)}\n    mov {reg}, [{reg} + {regs[index[1]]}*8]"
+            return "\n".join([
+                f"    mov {reg}, {var_loc(index[1])}",
+                f"    shl {reg}, 3",
+                f"    add {reg}, {base_operand(name)}",
+                f"    mov {reg}, [{reg}]",
+            ])
+        case ("index", name, index):
+            # name[i] - byte access
+            address = reg_address(name, index)
+            if address:
+                return f"    movzx {reg}, byte {address}"
+            asm = [load_base(name, reg)]
+            if index[0] == "num":
+                asm.append(f"    movzx {reg}, byte [{reg} + {index[1]}]")
+            elif index[1] in regs:
+                asm.append(f"    movzx {reg}, byte [{reg} + {regs[index[1]]}]")
+            else:
+                asm.append(f"    add {reg}, {var_loc(index[1])}")
+                asm.append(f"    movzx {reg}, byte [{reg}]")
+            return "\n".join(asm)
+    return f"    mov {reg}, 0"
+
+
+def static_length(node):
+    """The length constant of strlen(s) for a string variable that stands
+    for a read-only literal, else None"""
+    match node:
+        case ("call", "strlen", [("var", name)]) if "strlen" in builtin_fns \
+                and name in fn_strings[current_fn] and string_vars[name] not in writable_strings:
+            return f"{string_vars[name]}_len"
+    return None
+
+
+def has_call(node):
+    match node:
+        case ("call", _, _):
+            return not static_length(node)
+        case ("binop" | "cmp", _, left, right):
+            return has_call(left) or has_call(right)
+    return False
+
+
+def direct_operand(node, imm=True):
+    """Source operand for node that needs no register: an immediate or a
+    local, else None"""
+    if imm and is_imm32(node):
+        return node[1]
+    if node[0] == "var" and node[1] not in string_vars:
+        loc = var_loc(node[1])
+        return f"qword {loc}" if loc.startswith("[") else loc
+    return None
+
+
+def reg_need(node):
+    """Registers needed to evaluate node without spilling (Sethi-Ullman)"""
+    if node[0] not in ("binop", "cmp"):
+        return 1
+    left = reg_need(node[2])
+    right = 0 if direct_operand(node[3]) else reg_need(node[3])
+    return left + 1 if left == right else max(left, right)
+
+
+def right_first(left, right):
+    """Evaluate the side with a call first so fewer values live across
+    it, else the side that needs more registers"""
+    if has_call(left) != has_call(right):
+        return has_call(right)
+    return not has_call(left) and reg_need(right) > reg_need(left)
+
+
+def gen_expr(node, target="rax", free=None):
+    """Emit code leaving the value of node in target. free lists the
+    registers that may be clobbered; other EXPR_REGS hold live values."""
+    if free is None:
+        free = [r for r in EXPR_REGS if r != target]
+    match node[0]:
+        case "call" if static_length(node):
+            out.append(f"    mov {target}, {static_length(node)}")
+        case "call":
+            gen_call(node, target, free)
+        case "binop" | "cmp":
+            gen_binop(node, target, free)
+        case _:
+            out.append(load_val(node, target))
+
+
+def gen_call(node, target="rax", free=None):
+    """Emit a call leaving its result in target. Live registers and the
+    results of all but the last argument containing a call are saved on
+    the stack; other arguments are evaluated straight into place."""
+    if free is None:
+        free = [r for r in EXPR_REGS if r != target]
+    _, name, args = node
+    live = [r for r in EXPR_REGS if r not in free and r != target]
+    for reg in live:
+        out.append(f"    push {reg}")
+    calls = [i for i, arg in enumerate(args) if has_call(arg)]
+    for i in calls[:-1]:
+        gen_expr(args[i])
+        out.append("    push rax")
+    filled = []
+    for i in calls[-1:] + [i for i in range(len(args)) if i not in calls]:
+        reg = arg_regs[i]
+        gen_expr(args[i], reg, [r for r in EXPR_REGS if r not in filled and r != reg])
+        filled.append(reg)
+    for i in reversed(calls[:-1]):
+        out.append(f"    pop {arg_regs[i]}")
+    out.append(f"    call {name}")
+    if target != "rax":
+        out.append(f"    mov {target}, rax")
+    for reg in reversed(live):
+        out.append(f"    pop {reg}")
+
+
+def gen_binop(node, target, free):
+    """Emit left op right into target; a cmp node only sets the flags"""
+    kind, op, left, right = node
+    if kind == "cmp":
+        op = "cmp"
+    if arith_opt_enabled and op == "*" and left[0] == "num":
+        left, right = right, left
+    if arith_opt_enabled and op in ("*", "/", "%") and right[0] == "num":
+        gen_expr(left, target, free)
+        gen_const_op(op, target, int(right[1]), free)
+        return
+    source = direct_operand(right, imm=op not in ("/", "%"))
+    if source:
+        gen_expr(left, target, free)
+        gen_op(op, target, source, free)
+        return
+    candidates = [r for r in free if op not in ("/", "%") or r not in ("rax", "rdx")]
+    victim = None
+    if not candidates:
+        # out of registers: borrow one and keep its value on the stack
+        victim = next(r for r in EXPR_REGS if r not in (target, "rax", "rdx"))
+        out.append(f"    push {victim}")
+        candidates = [victim]
+    reg = candidates[0]
+    rest = [r for r in free if r != reg]
+    # the side evaluated first may use the other side's register
+    if right_first(left, right):
+        gen_expr(right, reg, rest + [target] if target in EXPR_REGS else rest)
+        gen_expr(left, target, rest)
+    else:
+        gen_expr(left, target, free)
+        gen_expr(right, reg, rest)
+    gen_op(op, target, reg, rest)
+    if victim:
+        out.append(f"    pop {victim}")
+
+
+def gen_op(op, target, source, free):
+    if op not in ("/", "%"):
+        out.append(f"    {BINOP_INSN[op]} {target}, {source}")
+        return
+    # idiv divides rdx:rax; save them if they hold someone else's value
+    saved = [r for r in ("rax", "rdx") if r != target and r not in free]
+    for reg in saved:
+        out.append(f"    push {reg}")
+    if target != "rax":
+        out.append(f"    mov rax, {target}")
+    out.append("    cqo")
+    out.append(f"    idiv {source}")
+    result = "rax" if op == "/" else "rdx"
+    if target != result:
+        out.append(f"    mov {target}, {result}")
+    for reg in reversed(saved):
+        out.append(f"    pop {reg}")
+
+
+# Operations on a constant, unless --no-arith-opt: multiplying becomes
+# shifts and lea where that takes at most two instructions. Dividing by a
+# power of two is an arithmetic shift, after adding divisor - 1 to negative
+# dividends so that the quotient rounds toward zero like idiv. Other
+# divisors multiply by a fixed-point reciprocal and keep the high half
+# (Hacker's Delight 10-1). A remainder is the dividend minus
+# quotient * divisor.
+arith_opt_enabled = True
+
+
+def signed_magic(d):
+    """(multiplier, shift) for dividing by 2 <= d < 2**63: the quotient is
+    the high half of x * multiplier, plus x when the multiplier does not
+    fit a signed word, shifted right by shift and rounded toward zero"""
+    two63 = 1 << 63
+    anc = two63 - 1 - two63 % d
+    p = 63
+    q1, r1 = divmod(two63, anc)
+    q2, r2 = divmod(two63, d)
+    while True:
+        p += 1
+        q1, r1 = 2 * q1, 2 * r1
+        if r1 >= anc:
+            q1, r1 = q1 + 1, r1 - anc
+        q2, r2 = 2 * q2, 2 * r2
+        if r2 >= d:
+            q2, r2 = q2 + 1, r2 - d
+        delta = d - r2
+        if q1 > delta or q1 == delta and r1 != 0:
+            return q2 + 1, p - 64
+
+
+def lea_steps(c):
+    """Instructions computing target * c for c > 1 from shifts and lea
+    with scale 2, 4 or 8, or None when that takes more than two"""
+    shift = (c & -c).bit_length() - 1
+    odd = c >> shift
+    if odd == 1:
+        return [("shl", shift)]
+    if odd in (3, 5, 9):
+        return [("lea", odd - 1)] + ([("shl", shift)] if shift else [])
+    for a in (3, 5, 9):
+        if odd % a == 0 and odd // a in (3, 5, 9) and not shift:
+            return [("lea", a - 1), ("lea", odd // a - 1)]
+    return None
+
+
+def scratch_register(target, free, avoid=()):
+    """(register, pushed): a register besides target that may be
+    clobbered, pushed first when none is free"""
+    reg = next((r for r in free if r != target and r not in avoid), None)
+    if reg:
+        return reg, False
+    reg = next(r for r in EXPR_REGS if r != target and r not in avoid)
+    out.append(f"    push {reg}")
+    return reg, True
+
+
+def gen_const_op(op, target, c, free):
+    """target = target op c for a constant c"""
+    free = [r for r in free if r != target]
+    d = abs(c)
+    shift = d.bit_length() - 1
+    if op == "*":
+        steps = lea_steps(d) if 1 < d < 2**63 else None
+        if c == 0:
+            out.append(f"    mov {target}, 0")
+        elif d == 1:
+            if c < 0:
+                out.append(f"    neg {target}")
+        elif steps:
+            for kind, n in steps:
+                if kind == "shl":
+                    out.append(f"    shl {target}, {n}")
                 else:
-                    cond_op = t
-                cond_right = next_token()
-                skip_ws()
-                if peek() == ";":
-                    advance()  # skip ;
-                skip_ws()
-
-                # parse post
-                post_var = next_token()
-                post_eq = next_token()  # =
-                post_first = next_token()
-                post_asm_lines = []
-                # parse post expression
-                post_asm_lines.append(load_val(post_first))
-                while True:
-                    t = next_token()
-                    if t is None or t[0] == "nl":
-                        break
-                    if t[0] == "op":
-                        right = next_token()
-                        match t[1]:
-                            case "+":
-                                post_asm_lines.append(load_val_rbx(right))
-                                post_asm_lines.append("    add rax, rbx")
-                            case "-":
-                                post_asm_lines.append(load_val_rbx(right))
-                                post_asm_lines.append("    sub rax, rbx")
-                            case "*":
-                                post_asm_lines.append(load_val_rbx(right))
-                                post_asm_lines.append("    imul rax, rbx")
-                            case "/":
-                                post_asm_lines.append("    xor rdx, rdx")
-                                post_asm_lines.append(load_val_rbx(right))
-                                post_asm_lines.append("    idiv rbx")
-                off = var_offset(post_var[1])
-                post_asm_lines.append(f"    mov [rbp - {off}], rax")
-                post_asm = "\n".join(post_asm_lines)
-
-                # emit init
-                init_tokens = init_part.split()
-                if len(init_tokens) >= 3 and init_tokens[1] == "=":
-                    init_var = init_tokens[0]
-                    init_val = init_tokens[2]
-                    init_off = var_offset(init_var)
-                    out.append(f"    mov rax, {init_val}")
-                    out.append(f"    mov [rbp - {init_off}], rax")
-
-                # emit start label
-                out.append(f"{start_label}:")
-
-                # emit condition - load left into rax
-                if cond_left_idx:
-                    # indexed access
-                    if cond_left[1] in string_vars:
-                        out.append(f"    mov rdi, {string_vars[cond_left[1]]}")
-                    else:
-                        off = var_offset(cond_left[1])
-                        out.append(f"    mov rdi, [rbp - {off}]")
-                    if cond_left_idx[0] == "num":
-                        out.append(f"    add rdi, {cond_left_idx[1]}")
+                    out.append(f"    lea {target}, [{target} + {target}*{n}]")
+            if c < 0:
+                out.append(f"    neg {target}")
+        elif -2**31 <= c < 2**31:
+            out.append(f"    imul {target}, {target}, {c}")
+        else:
+            gen_imm_op(op, target, c, free)
+    elif d == 0:
+        gen_imm_op(op, target, c, free)  # faults at run time, like idiv
+    elif d == 1:
+        if op == "%":
+            out.append(f"    mov {target}, 0")
+        elif c < 0:
+            out.append(f"    neg {target}")
+    elif d & (d - 1) == 0 and (op == "/" or shift < 32):
+        # add d - 1 to a negative dividend: its sign bits shifted right
+        bias, pushed = scratch_register(target, free)
+        out.append(f"    mov {bias}, {target}")
+        if shift > 1:
+            out.append(f"    sar {bias}, 63")
+        out.append(f"    shr {bias}, {64 - shift}")
+        out.append(f"    add {target}, {bias}")
+        if op == "/":
+            out.append(f"    sar {target}, {shift}")
+            if c < 0:
+                out.append(f"    neg {target}")
+        else:
+            out.append(f"    and {target}, {d - 1}")
+            out.append(f"    sub {target}, {bias}")
+        if pushed:
+            out.append(f"    pop {bias}")
+    elif 2 < d < 2**63:
+        gen_magic_div(op, target, c, free)
+    else:
+        gen_imm_op(op, target, c, free)
+
+
+def gen_imm_op(op, target, c, free):
+    """target = target op c with c loaded into a register"""
+    avoid = ("rax", "rdx") if op != "*" else ()
+    reg, pushed = scratch_register(target, free, avoid)
+    out.append(f"    mov {reg}, {c}")
+    gen_op(op, target, reg, [r for r in free if r != reg])
+    if pushed:
+        out.append(f"    pop {reg}")
+
+
+def gen_magic_div(op, target, c, free):
+    """target = target / c or target % c through the high half of a
+    multiplication, which imul leaves in rdx"""
+    d = abs(c)
+    magic, shift = signed_magic(d)
+    saved = [r for r in ("rax", "rdx") if r != target and r not in free]
+    for reg in saved:
+        out.append(f"    push {reg}")
+    x, pushed = target, False
+    if target in ("rax", "rdx"):
+        x, pushed = scratch_register(target, free, ("rax", "rdx"))
+        out.append(f"    mov {x}, {target}")
+    out.append(f"    mov rax, {wrap(magic)}")
+    out.append(f"    imul {x}")
+    if magic >= 2**63:
+        out.append(f"    add rdx, {x}")
+    if shift:
+        out.append(f"    sar rdx, {shift}")
+    # round toward zero: add one to a negative quotient
+    out.append("    mov rax, rdx")
+    out.append("    shr rax, 63")
+    out.append("    add rdx, rax")
+    if op == "/":
+        if c < 0:
+            out.append("    neg rdx")
+        result = "rdx"
+    else:
+        if d < 2**31:
+            out.append(f"    imul rdx, rdx, {d}")
+        else:
+            out.append(f"    mov rax, {d}")
+            out.append("    imul rdx, rax")
+        out.append(f"    sub {x}, rdx")
+        result = x
+    if target != result:
+        out.append(f"    mov {target}, {result}")
+    if pushed:
+        out.append(f"    pop {x}")
+    for reg in reversed(saved):
+        out.append(f"    pop {reg}")
+
+
+def is_imm32(node):
+    """A number that fits an instruction's sign-extended immediate"""
+    return node[0] == "num" and -2**31 <= int(node[1]) < 2**31
+
+
+def reads_first_only(node, name):
+    """True when node reads name at most as its leftmost operand, so it
+    can be evaluated straight into name's register"""
+    if node[0] == "binop":
+        refs = []
+        collect_refs(node[3], refs)
+        return name not in refs and reads_first_only(node[2], name)
+    if node[0] == "var":
+        return True
+    refs = []
+    collect_refs(node, refs)
+    return name not in refs
+
+
+def gen_cond(cond, label, jumps=JUMP_IF_FALSE):
+    """Compare and jump to label, by default when the condition does not hold"""
+    gen_expr(cond)
+    out.append(f"    {jumps[cond[1]]} {label}")
+
+
+def gen_fn(node):
+    global current_fn, vars, regs, stack_size, string_vars
+    _, name, params, body = node
+    current_fn = name
+    vars = fn_vars[name]
+    regs = fn_regs[name]
+    stack_size = fn_stack[name]
+    # locals and params shadow mem buffers of the same name
+    string_vars = {
+        b: label for b, label in buffer_labels.items() if b not in vars and b not in regs
+    }
+    string_vars.update(fn_strings[name])
+
+    if name in global_fns:
+        out.append(f"global {name}")
+    out.append(f"{name}:")
+    out.append("    push rbp")
+    out.append("    mov rbp, rsp")
+    out.append(f"    sub rsp, {stack_size}")
+    for reg, off in fn_saved[name]:
+        out.append(f"    mov [rbp - {off}], {reg}")
+
+    # copy args from registers to their home
+    for i, p in enumerate(params):
+        out.append(f"    mov {var_loc(p)}, {arg_regs[i]}")
+
+    gen_block(body)
+    if not body or body[-1][0] != "ret":
+        gen_restore()
+        out.append(fn_end)
+    current_fn = None
+
+
+def gen_restore():
+    """Reload the callee-saved registers before returning"""
+    for reg, off in fn_saved[current_fn]:
+        out.append(f"    mov {reg}, [rbp - {off}]")
+
+
+def gen_block(body):
+    global label_count
+    for node in body:
+        match node:
+            case ("assign", name, expr):
+                if is_imm32(expr):
+                    loc = var_loc(name)
+                    size = "" if name in regs else "qword "
+                    out.append(f"    mov {size}{loc}, {expr[1]}")
+                elif name in regs and reads_first_only(expr, name):
+                    gen_expr(expr, regs[name])
+                elif name not in string_vars:
+                    gen_expr(expr)
+                    out.append(f"    mov {var_loc(name)}, rax")
+
+            case ("store", name, index, value):
+                # value first, then the address in a register it left alone
+                if value[0] == "num":
+                    source = f"{value[1]}"
+                elif value[0] == "var" and value[1] in regs:
+                    source = f"{regs[value[1]]}b"
+                else:
+                    gen_expr(value)
+                    source = "al"
+                address = reg_address(name, index)
+                if address is None:
+                    out.append(load_base(name, "rdi"))
+                    if index[0] == "num":
+                        address = f"[rdi + {index[1]}]"
+                    elif index[1] in regs:
+                        address = f"[rdi + {regs[index[1]]}]"
                     else:
-                        idx_off = var_offset(cond_left_idx[1])
-                        out.append(f"    mov rax, [rbp - {idx_off}]")
-                        out.append(f"    add rdi, rax")
-                    out.append(f"    movzx rax, byte [rdi]")
+                        out.append(f"    add rdi, {var_loc(index[1])}")
+                        address = "[rdi]"
+                size = "byte " if value[0] == "num" else ""
+                out.append(f"    mov {size}{address}, {source}")
+
+            case ("if", cond, body, else_body):
+                else_label = f".if_else_{label_count}"
+                end_label = f".if_end_{label_count}"
+                label_count += 1
+
+                gen_cond(cond, else_label)
+                gen_block(body)
+                if else_body is None:
+                    out.append(f"{else_label}:")
                 else:
-                    out.append(load_val(cond_left, check_index=False))
-                out.append(load_val_rbx(cond_right, check_index=False))
-                out.append("    cmp rax, rbx")
-                jump = {
-                    "<": "jge", ">": "jle", "==": "jne",
-                    "!=": "je", "<=": "jg", ">=": "jl",
-                }
-                out.append(f"    {jump[cond_op[1]]} {end_label}")
-
-                blocks.append(("for", start_label, end_label, post_asm))
-
-            else:
-                # while-style: just condition
-                cond_left = next_token()
-                cond_left_idx = None
-                # check for indexed access: s[i]
-                t = next_token()
-                if t == ("lbracket", None):
-                    cond_left_idx = next_token()
-                    next_token()  # skip ]
-                    cond_op = next_token()
+                    out.append(f"    jmp {end_label}")
+                    out.append(f"{else_label}:")
+                    gen_block(else_body)
+                    out.append(f"{end_label}:")
+
+            case ("match", expr, cases, else_body):
+                n = label_count
+                label_count += 1
+                end_label = f".match_end_{n}"
+                else_label = f".match_else_{n}" if else_body else end_label
+
+                gen_expr(expr)
+                targets = sorted((value, f".match_case_{n}_{i}")
+                                 for i, (values, _) in enumerate(cases) for value in values)
+                if targets:
+                    gen_dispatch(targets, else_label, n)
                 else:
-                    cond_op = t
-                cond_right = next_token()
-                skip_line()
-
-                # emit start label
+                    out.append(f"    jmp {else_label}")
+                for i, (_, body) in enumerate(cases):
+                    out.append(f".match_case_{n}_{i}:")
+                    gen_block(body)
+                    out.append(f"    jmp {end_label}")
+                if else_body:
+                    out.append(f"{else_label}:")
+                    gen_block(else_body)
+                out.append(f"{end_label}:")
+
+            case ("for", init, cond, post, body):
+                start_label = f".for_start_{label_count}"
+                end_label = f".for_end_{label_count}"
+                label_count += 1
+
+                if init:
+                    gen_block([init])
+                if loop_opt_enabled:
+                    # rotated: one guard, then the test at the bottom
+                    gen_cond(cond, end_label)
+                    out.append(f"{start_label}:")
+                    gen_block(body)
+                    if post:
+                        gen_block([post])
+                    gen_cond(cond, start_label, JUMP_IF_TRUE)
+                    out.append(f"{end_label}:")
+                    continue
                 out.append(f"{start_label}:")
-
-                # emit condition - load left into rax
-                if cond_left_idx:
-                    # indexed access
-                    if cond_left[1] in string_vars:
-                        out.append(f"    mov rdi, {string_vars[cond_left[1]]}")
-                    else:
-                        off = var_offset(cond_left[1])
-                        out.append(f"    mov rdi, [rbp - {off}]")
-                    if cond_left_idx[0] == "num":
-                        out.append(f"    add rdi, {cond_left_idx[1]}")
-                    else:
-                        idx_off = var_offset(cond_left_idx[1])
-                        out.append(f"    mov rax, [rbp - {idx_off}]")
-                        out.append(f"    add rdi, rax")
-                    out.append(f"    movzx rax, byte [rdi]")
+                gen_cond(cond, end_label)
+                gen_block(body)
+                if post:
+                    gen_block([post])
+                out.append(f"    jmp {start_label}")
+                out.append(f"{end_label}:")
+
+            case ("ret", expr):
+                if expr is None:
+                    out.append("    mov rax, 0")
                 else:
-                    out.append(load_val(cond_left, check_index=False))
-                out.append(load_val_rbx(cond_right, check_index=False))
-                out.append("    cmp rax, rbx")
-                jump = {
-                    "<": "jge", ">": "jle", "==": "jne",
-                    "!=": "je", "<=": "jg", ">=": "jl",
-                }
-                out.append(f"    {jump[cond_op[1]]} {end_label}")
-
-                blocks.append(("for", start_label, end_label, None))
-
-        case ("word", "else"):
-            block = blocks.pop()
-            out.append(f"    jmp {block[2]}")  # jump to end
-            out.append(f"{block[1]}:")         # else label
-            blocks.append(("else", block[2]))  # push end_label for end
-            skip_line()
-
-        case ("word", "end"):
-            block = blocks.pop()
-            if block[0] == "if":
-                # no else - else_label is where we land
-                out.append(f"{block[1]}:")
-            elif block[0] == "else":
-                # had else - emit end_label
-                out.append(f"{block[1]}:")
-            elif block[0] == "for":
-                # emit post statement if C-style
-                if block[3]:
-                    out.append(block[3])
-                out.append(f"    jmp {block[1]}")  # jump to start
-                out.append(f"{block[2]}:")         # end label
-            elif block[0] == "fn":
-                out.append(fn_end)
-                current_fn = None
-            skip_line()
-
-        case ("word", name):
-            # check if it's a function call or assignment
-            if name in functions:
-                # bare function call: print(f)
-                call_asm = parse_call(name)
-                out.append(call_asm)
+                    gen_expr(expr)
+                gen_restore()
+                out.append("    mov rsp, rbp")
+                out.append("    pop rbp")
+                out.append("    ret")
+
+            case ("asm", lines):
+                for line in lines:
+                    out.append("    " + ASM_VAR_RE.sub(replace_var, line))
+
+            case ("call", _, _):
+                gen_call(node)
+
+
+def gen_dispatch(targets, default, n, first=0):
+    """Jump to the label paired with the value in rax among the sorted
+    (value, label) targets, or to default. Dense values go through a jump
+    table, the others through a binary search on the values, which may
+    end in tables for dense runs."""
+    lo, hi = targets[0][0], targets[-1][0]
+    if len(targets) >= JUMP_TABLE_MIN_CASES and hi - lo < JUMP_TABLE_DENSITY * len(targets):
+        # one unsigned compare after the subtraction checks both bounds
+        if lo:
+            out.extend(with_imm32("sub", lo))
+        out.append(f"    cmp rax, {hi - lo}")
+        out.append(f"    ja {default}")
+        table = f".match_table_{n}_{first}"
+        slots = dict(targets)
+        out.append(f"    jmp [{table} + rax*8]")
+        out.append("    section .rodata")
+        out.append("    align 8")
+        out.append(f"{table}:")
+        out.append(f"    dq {', '.join(slots.get(v, default) for v in range(lo, hi + 1))}")
+        out.append("    section .text")
+        return
+    if len(targets) <= MATCH_LINEAR_CASES:
+        for value, label in targets:
+            out.extend(with_imm32("cmp", value))
+            out.append(f"    je {label}")
+        out.append(f"    jmp {default}")
+        return
+    mid = len(targets) // 2
+    value, label = targets[mid]
+    upper = f".match_upper_{n}_{first + mid}"
+    out.extend(with_imm32("cmp", value))
+    out.append(f"    je {label}")
+    out.append(f"    jg {upper}")
+    gen_dispatch(targets[:mid], default, n, first)
+    out.append(f"{upper}:")
+    gen_dispatch(targets[mid + 1:], default, n, first + mid + 1)
+
+
+def with_imm32(mnem, value):
+    """mnem rax, value, going through rcx for a value wider than 32 bits"""
+    if -2**31 <= value < 2**31:
+        return [f"    {mnem} rax, {value}"]
+    return [f"    mov rcx, {value}", f"    {mnem} rax, rcx"]
+
+
+def literal_placeholder(content):
+    """Label standing for a string literal until the function is merged"""
+    if content not in unit_literals:
+        unit_literals[content] = f"_str?{len(unit_literals)}"
+    return unit_literals[content]
+
+
+def gen_unit(node):
+    """Generate and peephole one function. Returns its lines, the
+    literals it uses in placeholder order and the peephole counts."""
+    global label_count
+    out.clear()
+    unit_literals.clear()
+    label_count = 0
+    gen_fn(node)
+    lines = "\n".join(out).split("\n")
+    stats = {}
+    if peephole_enabled:
+        lines = peephole(lines, stats=stats)
+    return lines, list(unit_literals), stats
+
+
+def gen_chunk(start, stop):
+    """Pool worker: generate codegen_fns[start:stop]"""
+    return [gen_unit(node) for node in codegen_fns[start:stop]]
+
+
+def gen_program(program, extern_buffers=frozenset()):
+    """The .text lines of a program"""
+    global buffer_labels, codegen_fns
+    # mem buffer names can be used like string labels
+    buffer_labels = {name: name for name in extern_buffers}
+    buffer_labels.update((name, name) for name, _ in mem_buffers)
+
+    codegen_fns = [node for node in program if node[0] == "fn"]
+    n = len(codegen_fns)
+    if codegen_jobs > 1 and n >= PARALLEL_MIN_FNS:
+        # forked workers see the symbol tables of the first pass; a few
+        # chunks per worker even out functions of different sizes
+        step = -(-n // (codegen_jobs * 4))
+        starts = range(0, n, step)
+        context = multiprocessing.get_context("fork")
+        with concurrent.futures.ProcessPoolExecutor(codegen_jobs, mp_context=context) as pool:
+            chunks = pool.map(gen_chunk, starts, [min(i + step, n) for i in starts])
+            units = [unit for chunk in chunks for unit in chunk]
+    else:
+        units = [gen_unit(node) for node in codegen_fns]
+
+    # .data is prepended after code generation so that string literals
+    # from calls are included
+    code = ["section .text", ""]
+    for lines, literals, stats in units:
+        if literals:
+            labels = [get_literal_string(content) for content in literals]
+            lines = [PLACEHOLDER_RE.sub(lambda m: labels[int(m[1])], line) for line in lines]
+        code += lines
+        for name, count in stats.items():
+            peephole_stats[name] = peephole_stats.get(name, 0) + count
+    return code
+
+
+# --- Peephole optimization ---
+# Each rule looks at the instruction list at index i and returns None, or
+# (n, replacement) to replace the next n lines. Rules are tried in order
+# and the pass repeats until nothing changes.
+peephole_enabled = True
+peephole_stats = {}  # rule name -> instructions removed, summed over modules
+
+REGISTER_ALIASES = {
+    "rax": ("rax", "eax", "ax", "al", "ah"),
+    "rbx": ("rbx", "ebx", "bx", "bl", "bh"),
+    "rcx": ("rcx", "ecx", "cx", "cl", "ch"),
+    "rdx": ("rdx", "edx", "dx", "dl", "dh"),
+    "rsi": ("rsi", "esi", "si", "sil"),
+    "rdi": ("rdi", "edi", "di", "dil"),
+    **{f"r{n}": (f"r{n}", f"r{n}d", f"r{n}w", f"r{n}b") for n in range(8, 16)},
+}
+
+
+# nasm directives that may appear in asm blocks; label db 1 needs no colon
+ASM_DIRECTIVES = {
+    "db", "dw", "dd", "dq", "dt", "do", "resb", "resw", "resd", "resq", "times",
+    "align", "alignb", "section", "segment", "global", "extern", "equ", "incbin",
+}
+
+
+def strip_comment(line):
+    """line without a ; comment, keeping semicolons inside quotes"""
+    quote = None
+    for i, c in enumerate(line):
+        if quote:
+            if c == quote:
+                quote = None
+        elif c in "\"'`":
+            quote = c
+        elif c == ";":
+            return line[:i]
+    return line
+
+
+def parse_insn(line):
+    """Split an instruction into (mnemonic, operands); None for labels,
+    including a label with an instruction after it, directives and blank
+    lines"""
+    text = (strip_comment(line) if ";" in line else line).strip()
+    if not text or not line.startswith("    "):
+        return None
+    parts = text.split(None, 1)
+    if parts[0].endswith(":") or parts[0].startswith("%") or parts[0] in ASM_DIRECTIVES \
+            or len(parts) == 2 and parts[1].split(None, 1)[0] in ASM_DIRECTIVES:
+        return None
+    if len(parts) == 1:
+        return (parts[0], [])
+    return (parts[0], [op.strip() for op in parts[1].split(",")])
+
+
+def register_of(operand):
+    """The 64-bit register an operand names, or None"""
+    return next((reg for reg, names in REGISTER_ALIASES.items() if operand in names), None)
+
+
+def mentions(reg, operand):
+    return any(re.search(rf"\b{alias}\b", operand) for alias in REGISTER_ALIASES[reg])
+
+
+def rule_store_reload(lines, i):
+    """mov a, b followed by mov b, a: the second move changes nothing,
+    unless the first one changed a register b's address uses. Only 64-bit
+    registers qualify: mov eax, ebx / mov ebx, eax clears the upper half
+    of rbx."""
+    first = parse_insn(lines[i])
+    second = parse_insn(lines[i + 1]) if i + 1 < len(lines) else None
+    if first and second and first[0] == second[0] == "mov" \
+            and len(first[1]) == 2 and first[1] == second[1][::-1]:
+        if any(register_of(op) and op not in REGISTER_ALIASES for op in first[1]):
+            return None
+        reg = register_of(first[1][0])
+        if reg and mentions(reg, first[1][1]):
+            return None
+        return 2, [lines[i]]
+    return None
+
+
+def rule_self_move(lines, i):
+    """mov a, a"""
+    insn = parse_insn(lines[i])
+    if insn and insn[0] == "mov" and len(insn[1]) == 2 and insn[1][0] == insn[1][1] \
+            and insn[1][0] in REGISTER_ALIASES:
+        return 1, []
+    return None
+
+
+def rule_dead_move(lines, i):
+    """mov r, x followed by mov r, y where y does not read r"""
+    first = parse_insn(lines[i])
+    second = parse_insn(lines[i + 1]) if i + 1 < len(lines) else None
+    if first and second and first[0] == second[0] == "mov" \
+            and len(first[1]) == len(second[1]) == 2:
+        reg = first[1][0]
+        if reg in REGISTER_ALIASES and second[1][0] == reg and not mentions(reg, second[1][1]):
+            return 2, [lines[i + 1]]
+    return None
+
+
+def rule_push_pop(lines, i):
+    """push a followed by pop b becomes mov b, a"""
+    first = parse_insn(lines[i])
+    second = parse_insn(lines[i + 1]) if i + 1 < len(lines) else None
+    if first and second and first[0] == "push" and second[0] == "pop" \
+            and first[1][0] in REGISTER_ALIASES and second[1][0] in REGISTER_ALIASES:
+        if first[1] == second[1]:
+            return 2, []
+        return 2, [f"    mov {second[1][0]}, {first[1][0]}"]
+    return None
+
+
+def rule_jump_to_next(lines, i):
+    """jmp to the label that immediately follows"""
+    insn = parse_insn(lines[i])
+    if insn and insn[0] == "jmp" and i + 1 < len(lines) \
+            and lines[i + 1] == f"{insn[1][0]}:":
+        return 1, []
+    return None
+
+
+def rule_unreachable(lines, i):
+    """instructions after ret or jmp up to the next label"""
+    insn = parse_insn(lines[i])
+    if not insn or insn[0] not in ("ret", "jmp"):
+        return None
+    n = 1
+    while i + n < len(lines) and parse_insn(lines[i + n]):
+        n += 1
+    if n == 1:
+        return None
+    return n, [lines[i]]
+
+
+PEEPHOLE_RULES = [
+    ("store-reload", rule_store_reload),
+    ("self-move", rule_self_move),
+    ("dead-move", rule_dead_move),
+    ("push-pop", rule_push_pop),
+    ("jump-to-next", rule_jump_to_next),
+    ("unreachable", rule_unreachable),
+]
+
+
+def peephole(lines, rules=None, stats=None):
+    """Apply the peephole rules to a list of assembly lines until no rule
+    matches; returns the new list and counts what each rule removed in
+    stats, by default peephole_stats"""
+    if rules is None:
+        rules = PEEPHOLE_RULES
+    if stats is None:
+        stats = peephole_stats
+    changed = True
+    while changed:
+        changed = False
+        result = []
+        i = 0
+        while i < len(lines):
+            for name, rule in rules:
+                match = rule(lines, i)
+                if match:
+                    n, replacement = match
+                    stats[name] = stats.get(name, 0) + n - len(replacement)
+                    result.extend(replacement)
+                    i += n
+                    changed = True
+                    break
             else:
-                tok2 = next_token()
-                if tok2 == ("lbracket", None):
-                    # array assignment: name[index] = value
-                    idx_tok = next_token()
-                    next_token()  # skip ]
-                    next_token()  # skip =
-                    val_tok = next_token()
-                    skip_line()
-
-                    # compute address: name + index
-                    if name in string_vars:
-                        out.append(f"    mov rdi, {string_vars[name]}")
-                    else:
-                        off = var_offset(name)
-                        out.append(f"    mov rdi, [rbp - {off}]")
+                result.append(lines[i])
+                i += 1
+        lines = result
+    return lines
+
+
+def program_buffers(body):
+    """Names of the mem buffers declared anywhere in a list of nodes"""
+    names = set()
+    for node in body:
+        match node:
+            case ("mem", buffers):
+                names.update(name for name, _ in buffers)
+            case ("fn", _, _, body) | ("for", _, _, _, body):
+                names |= program_buffers(body)
+            case ("if", _, body, else_body):
+                names |= program_buffers(body)
+                names |= program_buffers(else_body or [])
+            case ("match", _, cases, else_body):
+                for _, body in cases:
+                    names |= program_buffers(body)
+                names |= program_buffers(else_body or [])
+    return names
+
+
+def reset_state():
+    """Forget the symbols and output of the previously compiled program"""
+    global current_fn, vars, regs, stack_size, string_vars, buffer_labels, label_count
+    for table in (functions, fn_vars, fn_stack, fn_strings, fn_regs, fn_saved,
+                  literal_strings, global_fns, unit_literals, writable_strings):
+        table.clear()
+    strings.clear()
+    mem_buffers.clear()
+    out.clear()
+    current_fn = None
+    vars = {}
+    regs = {}
+    stack_size = 0
+    string_vars = {}
+    buffer_labels = {}
+    label_count = 0
+
+
+def db_operands(content):
+    """The operands of a db line spelling out content, without the 0"""
+    parts = []
+    current = ""
+    for c in content:
+        if c == "\n":
+            if current:
+                parts.append(f'"{current}"')
+            parts.append("10")
+            current = ""
+        elif c == "\t":
+            if current:
+                parts.append(f'"{current}"')
+            parts.append("9")
+            current = ""
+        else:
+            current += c
+    if current:
+        parts.append(f'"{current}"')
+    return parts
+
+
+def merge_tails(constants):
+    """Group (label, content) pairs so that a string ending another one
+    labels a position inside it: returns [(content, [(offset, label)])].
+    Sorted on the reversed content, a string is preceded by the strings
+    it ends."""
+    hosts = []
+    for label, content in sorted(constants, key=lambda s: s[1][::-1], reverse=True):
+        if hosts and hosts[-1][0].endswith(content):
+            hosts[-1][1].append((len(hosts[-1][0]) - len(content), label))
+        else:
+            hosts.append((content, [(0, label)]))
+    return hosts
+
+
+def gen_data(lengths=frozenset()):
+    """The .rodata and .data sections for the strings and the .bss section
+    for the mem buffers; run after code generation so literals are
+    included. lengths names the <label>_len constants the code uses."""
+    data_section = []
+    constants = [(label, content) for label, content in strings
+                 if label not in writable_strings]
+    if constants:
+        data_section.append("section .rodata")
+        for content, labels in merge_tails(constants):
+            labels.sort()
+            for i, (offset, label) in enumerate(labels):
+                end = labels[i + 1][0] if i + 1 < len(labels) else None
+                parts = db_operands(content[offset:end]) + (["0"] if end is None else [])
+                data_section.append(f"    {label}: db {', '.join(parts)}")
+                if f"{label}_len" in lengths:
+                    data_section.append(f"    {label}_len equ {len(content[offset:].encode())}")
+            count("string_bytes", len(content) + 1)
+        data_section.append("")
+    if writable_strings:
+        data_section.append("section .data")
+        for label, content in strings:
+            if label in writable_strings:
+                data_section.append(f"    {label}: db {', '.join(db_operands(content) + ['0'])}")
+                count("string_bytes", len(content) + 1)
+        data_section.append("")
+
+    # Generate .bss section for mem buffers
+    bss_section = []
+    if mem_buffers:
+        bss_section.append("section .bss")
+        for name, size in mem_buffers:
+            bss_section.append(f"    {name}: resb {size}")
+        bss_section.append("")
+    return data_section + bss_section
+
+
+WORD_RE = re.compile(r"\w+")
+
+
+def compile_to_asm(program, external=frozenset(), extern_buffers=frozenset(),
+                   called=frozenset()):
+    """Generate the assembly text for a parsed program.
+
+    external names the functions and buffers defined in other modules,
+    the ones this module uses are declared extern and its own mem buffers
+    are exported. called names the functions of this module that other
+    modules call; they are global along with _start and exported ones.
+    """
+    reset_state()
+    roots = program_roots(program) | called
+    global_fns.update(roots)
+    if inline_enabled:
+        program = timed("inline", inline_program, program, extern_buffers)
+    program = timed("fold", fold_program, program)
+    if dead_fn_enabled:
+        program = timed("dead-fn", drop_dead_fns, program, roots)
+    if loop_opt_enabled:
+        program = timed("loops", reduce_loops, program)
+    timed("pass1", collect_symbols, program, extern_buffers)
+    code = timed("pass2", gen_program, program, extern_buffers)
+
+    header = []
+    if external:
+        used = set(WORD_RE.findall("\n".join(code)))
+        header = [f"extern {name}" for name in sorted(external & used)]
+        header += [f"global {name}" for name, _ in mem_buffers]
+        if header:
+            header.append("")
+
+    lengths = {word for line in code if "_len" in line for word in WORD_RE.findall(line)}
+    data = timed("data", gen_data, lengths)
+
+    count("functions", len(fn_stack))
+    slots = compile_stats.setdefault("stack_slots", {})
+    slots.update((name, size // 8) for name, size in fn_stack.items())
+    count("instructions", sum(1 for line in code if parse_insn(line) is not None))
+    count("string_literals", len(strings))
+    count("mem_bytes", sum(size for _, size in mem_buffers))
+
+    # Combine: .data first, then .bss, then .text
+    return "\n".join(header + data + code)
+
+
+# --- x86-64 encoder ---
+# Assembles the nasm subset the compiler emits, and the instructions the
+# asm blocks of the standard library use, straight to machine code. Lines
+# it does not understand raise Unencodable and the build goes through
+# nasm and ld instead.
+class Unencodable(Exception):
+    pass
+
+
+REG_NAMES = {
+    64: ["rax", "rcx", "rdx", "rbx", "rsp", "rbp", "rsi", "rdi"],
+    32: ["eax", "ecx", "edx", "ebx", "esp", "ebp", "esi", "edi"],
+    16: ["ax", "cx", "dx", "bx", "sp", "bp", "si", "di"],
+    8: ["al", "cl", "dl", "bl", "spl", "bpl", "sil", "dil"],
+}
+REG_SUFFIX = {64: "", 32: "d", 16: "w", 8: "b"}
+REGISTERS = {}  # name -> (number, bits)
+for bits, names in REG_NAMES.items():
+    for i, name in enumerate(names + [f"r{n}{REG_SUFFIX[bits]}" for n in range(8, 16)]):
+        REGISTERS[name] = (i, bits)
+for i in range(16):
+    REGISTERS[f"xmm{i}"] = (i, 128)
+
+SIZE_WORDS = {"byte": 8, "word": 16, "dword": 32, "qword": 64, "oword": 128, "xmmword": 128}
+
+CONDITIONS = {
+    "o": 0, "no": 1, "b": 2, "c": 2, "nae": 2, "ae": 3, "nb": 3, "nc": 3,
+    "e": 4, "z": 4, "ne": 5, "nz": 5, "be": 6, "na": 6, "a": 7, "nbe": 7,
+    "s": 8, "ns": 9, "p": 10, "pe": 10, "np": 11, "po": 11,
+    "l": 12, "nge": 12, "ge": 13, "nl": 13, "le": 14, "ng": 14, "g": 15, "nle": 15,
+}
+ALU_OPS = {"add": 0, "or": 1, "adc": 2, "sbb": 3, "and": 4, "sub": 5, "xor": 6, "cmp": 7}
+SHIFT_OPS = {"rol": 0, "ror": 1, "rcl": 2, "rcr": 3, "shl": 4, "sal": 4, "shr": 5, "sar": 7}
+UNARY_OPS = {"not": (0xF6, 2), "neg": (0xF6, 3), "mul": (0xF6, 4), "div": (0xF6, 6),
+             "idiv": (0xF6, 7), "inc": (0xFE, 0), "dec": (0xFE, 1)}
+BIT_SCANS = {"bsf": b"\x0f\xbc", "bsr": b"\x0f\xbd", "popcnt": b"\xf3\x0f\xb8",
+             "tzcnt": b"\xf3\x0f\xbc", "lzcnt": b"\xf3\x0f\xbd"}
+NO_OPERANDS = {
+    "ret": b"\xc3", "leave": b"\xc9", "syscall": b"\x0f\x05", "cqo": b"\x48\x99",
+    "cdq": b"\x99", "cdqe": b"\x48\x98", "nop": b"\x90", "hlt": b"\xf4", "ud2": b"\x0f\x0b",
+    "int3": b"\xcc", "pause": b"\xf3\x90",
+    "movsb": b"\xa4", "movsq": b"\x48\xa5", "stosb": b"\xaa", "stosq": b"\x48\xab",
+    "lodsb": b"\xac", "cmpsb": b"\xa6", "scasb": b"\xae",
+}
+REPEAT_PREFIXES = {"rep": b"\xf3", "repe": b"\xf3", "repz": b"\xf3",
+                   "repne": b"\xf2", "repnz": b"\xf2"}
+# xmm, xmm/m128 instructions by (mandatory prefix, opcode after 0f)
+SSE_OPS = {
+    "pcmpeqb": (0x66, 0x74), "pcmpeqw": (0x66, 0x75), "pcmpeqd": (0x66, 0x76),
+    "pxor": (0x66, 0xEF), "por": (0x66, 0xEB), "pand": (0x66, 0xDB), "pandn": (0x66, 0xDF),
+    "pminub": (0x66, 0xDA), "pmaxub": (0x66, 0xDE), "paddb": (0x66, 0xFC), "psubb": (0x66, 0xF8),
+    "punpcklbw": (0x66, 0x60), "punpcklwd": (0x66, 0x61), "punpckldq": (0x66, 0x62),
+    "punpcklqdq": (0x66, 0x6C),
+}
+SSE_MOVES = {"movdqa": 0x66, "movdqu": 0xF3}
+
+NUMBER_RE = re.compile(r"-?(0x[0-9a-f]+|[0-9][0-9a-f]*h|0b[01]+|\d+)$", re.I)
+SYMBOL_RE = re.compile(r"[A-Za-z_.?][\w.?$@]*$")
+
+
+def split_operands(text):
+    parts, depth, quote, current = [], 0, None, ""
+    for c in text:
+        if quote:
+            quote = None if c == quote else quote
+        elif c in "\"'`":
+            quote = c
+        elif c == "[":
+            depth += 1
+        elif c == "]":
+            depth -= 1
+        elif c == "," and depth == 0:
+            parts.append(current.strip())
+            current = ""
+            continue
+        current += c
+    if current.strip():
+        parts.append(current.strip())
+    return parts
 
-                    if idx_tok[0] == "num":
-                        out.append(f"    add rdi, {idx_tok[1]}")
-                    else:
-                        idx_off = var_offset(idx_tok[1])
-                        out.append(f"    mov rax, [rbp - {idx_off}]")
-                        out.append(f"    add rdi, rax")
 
-                    # load value
-                    if val_tok[0] == "num":
-                        out.append(f"    mov byte [rdi], {val_tok[1]}")
-                    else:
-                        val_off = var_offset(val_tok[1])
-                        out.append(f"    mov al, [rbp - {val_off}]")
-                        out.append(f"    mov [rdi], al")
-
-                elif tok2 == ("op", "="):
-                    tok3 = next_token()
-                    if tok3[0] == "str":
-                        skip_line()
+def asm_number(text):
+    if not NUMBER_RE.match(text):
+        return None
+    sign, text = (-1, text[1:]) if text.startswith("-") else (1, text)
+    low = text.lower()
+    if low.endswith("h") and not low.startswith("0x"):
+        return sign * int(low[:-1], 16)
+    return sign * int(low, 0 if low[:2] in ("0x", "0b") else 10)
+
+
+def qualify(name, scope):
+    """nasm scopes .labels to the last ordinary label before them"""
+    return scope + name if name.startswith(".") else name
+
+
+def asm_value(text, scope, consts):
+    """(number, symbol or None) for an immediate like 12, label or label + 4"""
+    value, symbol = 0, None
+    for sign, term in re.findall(r"([+-]?)\s*([^+-]+)", text.replace(" ", "")):
+        term_value = asm_constant(term, consts)
+        if term_value is None:
+            name = qualify(term, scope)
+            if symbol or sign == "-" or not SYMBOL_RE.match(term):
+                raise Unencodable(f"can't encode the value {text!r}")
+            symbol = name
+        else:
+            value += -term_value if sign == "-" else term_value
+    return value, symbol
+
+
+def asm_constant(term, consts):
+    """Value of a number, constant or product of those, else None"""
+    if "*" in term:
+        product = 1
+        for factor in term.split("*"):
+            factor_value = asm_constant(factor, consts)
+            if factor_value is None:
+                return None
+            product *= factor_value
+        return product
+    if len(term) == 3 and term[0] == term[2] and term[0] in "'`\"":
+        return ord(term[1])
+    value = asm_number(term)
+    return consts.get(term) if value is None else value
+
+
+def asm_address(text, size, scope, consts):
+    base = index = symbol = None
+    scale, disp = 1, 0
+    for sign, term in re.findall(r"([+-]?)\s*([^+-]+)", text.replace(" ", "")):
+        factors = term.split("*")
+        regs = [f for f in factors if f in REGISTERS]
+        if regs:
+            others = [asm_constant(f, consts) for f in factors if f not in REGISTERS]
+            if len(regs) > 1 or sign == "-" or None in others or REGISTERS[regs[0]][1] != 64:
+                raise Unencodable(f"can't encode the address [{text}]")
+            reg_scale = 1
+            for factor in others:
+                reg_scale *= factor
+            number = REGISTERS[regs[0]][0]
+            if reg_scale == 1 and base is None:
+                base = number
+            elif index is None and reg_scale in (1, 2, 4, 8) and number != 4:
+                index, scale = number, reg_scale
+            else:
+                raise Unencodable(f"can't encode the address [{text}]")
+            continue
+        value, name = asm_value(term, scope, consts)
+        if name:
+            if symbol or sign == "-":
+                raise Unencodable(f"can't encode the address [{text}]")
+            symbol = name
+        disp += -value if sign == "-" else value
+    return ("mem", size, base, index, scale, disp, symbol)
+
+
+def asm_operand(text, scope, consts):
+    """("reg", number, bits), ("mem", bits, base, index, scale, disp, symbol)
+    or ("imm", bits, value, symbol); bits is None when not given"""
+    size = None
+    words = text.split(None, 1)
+    if len(words) == 2 and words[0].lower() in SIZE_WORDS:
+        size, text = SIZE_WORDS[words[0].lower()], words[1].strip()
+    if text.startswith("[") and text.endswith("]"):
+        return asm_address(text[1:-1].strip(), size, scope, consts)
+    if text in REGISTERS:
+        return ("reg", *REGISTERS[text])
+    return ("imm", size, *asm_value(text, scope, consts))
+
+
+def fits(value, bits):
+    return -(1 << (bits - 1)) <= value < (1 << (bits - 1))
+
+
+def rex_prefix(w, reg, rm, force=False):
+    """REX byte for operand size w and the high bits of the register and
+    r/m operands, or nothing when none is needed"""
+    rex = 0x40 | w << 3 | (reg >> 3 & 1) << 2
+    if rm[0] == "reg":
+        rex |= rm[1] >> 3
+    else:
+        _, _, base, index, _, _, _ = rm
+        rex |= (index or 0) >> 3 << 1 | (base or 0) >> 3
+    return bytes([rex]) if rex != 0x40 or force else b""
+
+
+def modrm(reg, rm, symbols):
+    """ModRM, SIB and displacement bytes for register field reg and the r/m
+    operand; addresses of symbols are always a 32-bit displacement"""
+    if rm[0] == "reg":
+        return bytes([0xC0 | (reg & 7) << 3 | rm[1] & 7])
+    _, _, base, index, scale, disp, symbol = rm
+    if symbol:
+        disp += symbols(symbol)
+    if not fits(disp, 32):
+        raise Unencodable("displacement out of range")
+    reg = (reg & 7) << 3
+    ss = {1: 0, 2: 1, 4: 2, 8: 3}[scale] << 6
+    if base is None:
+        # absolute address or index * scale + disp32, no base
+        sib = ss | (4 if index is None else index & 7) << 3 | 5
+        return bytes([reg | 4, sib]) + disp.to_bytes(4, "little", signed=True)
+    if symbol is None and disp == 0 and base & 7 != 5:
+        mod, tail = 0x00, b""
+    elif symbol is None and fits(disp, 8):
+        mod, tail = 0x40, disp.to_bytes(1, "little", signed=True)
+    else:
+        mod, tail = 0x80, disp.to_bytes(4, "little", signed=True)
+    if index is None and base & 7 != 4:
+        return bytes([mod | reg | base & 7]) + tail
+    sib = ss | (4 if index is None else index & 7) << 3 | base & 7
+    return bytes([mod | reg | 4, sib]) + tail
+
+
+def encode_rm(opcode, reg, rm, bits, symbols, prefix=b"", imm=b"", byte_regs=()):
+    """An instruction taking a ModRM operand: operand-size and mandatory
+    prefixes, REX, opcode, ModRM and the immediate"""
+    # spl, bpl, sil and dil only exist with a REX prefix
+    force = any(r[0] == "reg" and r[2] == 8 and 4 <= r[1] < 8 for r in byte_regs)
+    size = b"\x66" if bits == 16 else b""
+    return (size + prefix + rex_prefix(bits == 64, reg, rm, force) + opcode
+            + modrm(reg, rm, symbols) + imm)
+
+
+def immediate(value, bits):
+    return (value & ((1 << bits) - 1)).to_bytes(bits // 8, "little")
+
+
+def operand_size(ops):
+    """Size of the instruction's operands, given by a register or size word"""
+    sizes = {op[2] if op[0] == "reg" else op[1] for op in ops} - {None}
+    if len(sizes) != 1:
+        raise Unencodable("operand size is ambiguous")
+    return sizes.pop()
+
+
+def imm_value(op, symbols):
+    _, _, value, symbol = op
+    return value + symbols(symbol) if symbol else value
+
+
+def encode_insn(mnem, ops, symbols, addr=0):
+    """Machine code for one instruction at addr; symbols maps a label to
+    its address"""
+    kinds = tuple(op[0] for op in ops)
+    match mnem, kinds:
+        case _, () if mnem in NO_OPERANDS:
+            return NO_OPERANDS[mnem]
+
+        case ("mov", ("reg" | "mem", "reg")) | ("mov", ("reg", "mem")):
+            bits = operand_size(ops)
+            if bits == 128:
+                raise Unencodable("use movdqa or movdqu for xmm registers")
+            reg, rm = (ops[1], ops[0]) if kinds[1] == "reg" else (ops[0], ops[1])
+            opcode = (0x88 if kinds[1] == "reg" else 0x8A) | (bits != 8)
+            return encode_rm(bytes([opcode]), reg[1], rm, bits, symbols, byte_regs=ops)
+
+        case "mov", ("reg", "imm"):
+            number, bits = ops[0][1], ops[0][2]
+            value = imm_value(ops[1], symbols)
+            rex = b"\x41" if number >= 8 else b""
+            if bits == 64 and ops[1][3] is None and not 0 <= value < 1 << 32:
+                if fits(value, 32):
+                    return encode_rm(b"\xc7", 0, ops[0], 64, symbols, imm=immediate(value, 32))
+                return bytes([0x48 | number >> 3, 0xB8 | number & 7]) + immediate(value, 64)
+            if bits == 8:
+                rex = b"\x41" if number >= 8 else b"\x40" if number >= 4 else b""
+                return rex + bytes([0xB0 | number & 7]) + immediate(value, 8)
+            # a 32-bit move zero-extends, which covers labels and other
+            # unsigned 32-bit values for 64-bit registers too
+            size = b"\x66" if bits == 16 else b""
+            return size + rex + bytes([0xB8 | number & 7]) + immediate(value, min(bits, 32))
+
+        case "mov", ("mem", "imm"):
+            bits = operand_size(ops[:1])
+            value = imm_value(ops[1], symbols)
+            if not (fits(value, min(bits, 32)) or bits <= 32 and 0 <= value < 1 << bits):
+                raise Unencodable("immediate out of range")
+            return encode_rm(b"\xc6" if bits == 8 else b"\xc7", 0, ops[0], bits, symbols,
+                             imm=immediate(value, min(bits, 32)))
+
+        case ("movzx" | "movsx"), ("reg", "reg" | "mem"):
+            source = ops[1][2] if kinds[1] == "reg" else ops[1][1]
+            if source not in (8, 16):
+                raise Unencodable(f"{mnem} needs a byte or word source")
+            opcode = (0xB6 if mnem == "movzx" else 0xBE) | (source == 16)
+            return encode_rm(bytes([0x0F, opcode]), ops[0][1], ops[1], ops[0][2], symbols,
+                             byte_regs=ops)
+
+        case "movsxd", ("reg", "reg" | "mem"):
+            return encode_rm(b"\x63", ops[0][1], ops[1], 64, symbols)
+
+        case "lea", ("reg", "mem"):
+            return encode_rm(b"\x8d", ops[0][1], ops[1], ops[0][2], symbols)
+
+        case _, ("reg" | "mem", "reg") | ("reg", "mem") if mnem in ALU_OPS:
+            bits = operand_size(ops)
+            reg, rm = (ops[1], ops[0]) if kinds[1] == "reg" else (ops[0], ops[1])
+            opcode = ALU_OPS[mnem] << 3 | (0 if kinds[1] == "reg" else 2) | (bits != 8)
+            return encode_rm(bytes([opcode]), reg[1], rm, bits, symbols, byte_regs=ops)
+
+        case _, ("reg" | "mem", "imm") if mnem in ALU_OPS:
+            bits = operand_size(ops[:1])
+            value = imm_value(ops[1], symbols)
+            n = ALU_OPS[mnem]
+            if bits == 8:
+                return encode_rm(b"\x80", n, ops[0], 8, symbols, imm=immediate(value, 8),
+                                 byte_regs=ops)
+            if ops[1][3] is None and fits(value, 8):
+                return encode_rm(b"\x83", n, ops[0], bits, symbols, imm=immediate(value, 8))
+            width = min(bits, 32)
+            if not (fits(value, width) or bits == 32 and 0 <= value < 1 << 32):
+                raise Unencodable("immediate out of range")
+            if kinds[0] == "reg" and ops[0][1] == 0:
+                # the short form for rax, eax and ax
+                size = b"\x66" if bits == 16 else b"\x48" if bits == 64 else b""
+                return size + bytes([n << 3 | 5]) + immediate(value, width)
+            return encode_rm(b"\x81", n, ops[0], bits, symbols, imm=immediate(value, width))
+
+        case "test", ("reg" | "mem", "reg"):
+            bits = operand_size(ops)
+            return encode_rm(bytes([0x84 | (bits != 8)]), ops[1][1], ops[0], bits, symbols,
+                             byte_regs=ops)
+
+        case "test", ("reg" | "mem", "imm"):
+            bits = operand_size(ops[:1])
+            value = imm_value(ops[1], symbols)
+            opcode = b"\xf6" if bits == 8 else b"\xf7"
+            return encode_rm(opcode, 0, ops[0], bits, symbols, imm=immediate(value, min(bits, 32)),
+                             byte_regs=ops)
+
+        case "imul", ("reg", "reg" | "mem"):
+            return encode_rm(b"\x0f\xaf", ops[0][1], ops[1], operand_size(ops), symbols)
+
+        case "imul", ("reg", "imm") | ("reg", "reg" | "mem", "imm"):
+            source = ops[0] if len(ops) == 2 else ops[1]
+            bits = operand_size(ops[:-1])
+            value = imm_value(ops[-1], symbols)
+            if fits(value, 8):
+                return encode_rm(b"\x6b", ops[0][1], source, bits, symbols, imm=immediate(value, 8))
+            return encode_rm(b"\x69", ops[0][1], source, bits, symbols,
+                             imm=immediate(value, min(bits, 32)))
+
+        case _, ("reg" | "mem",) if mnem in UNARY_OPS or mnem == "imul":
+            opcode, n = UNARY_OPS.get(mnem, (0xF6, 5))
+            bits = operand_size(ops)
+            return encode_rm(bytes([opcode | (bits != 8)]), n, ops[0], bits, symbols,
+                             byte_regs=ops)
+
+        case _, ("reg" | "mem", "imm" | "reg") if mnem in SHIFT_OPS:
+            bits = operand_size(ops[:1])
+            n = SHIFT_OPS[mnem]
+            wide = bits != 8
+            if kinds[1] == "reg":
+                if ops[1][1:] != (1, 8):
+                    raise Unencodable("shift counts come in cl")
+                return encode_rm(bytes([0xD2 | wide]), n, ops[0], bits, symbols, byte_regs=ops)
+            count = imm_value(ops[1], symbols)
+            if count == 1:
+                return encode_rm(bytes([0xD0 | wide]), n, ops[0], bits, symbols, byte_regs=ops)
+            return encode_rm(bytes([0xC0 | wide]), n, ops[0], bits, symbols,
+                             imm=immediate(count, 8), byte_regs=ops)
+
+        case _, ("reg", "reg" | "mem") if mnem in BIT_SCANS:
+            code = BIT_SCANS[mnem]
+            prefix, opcode = (code[:1], code[1:]) if len(code) == 3 else (b"", code)
+            return encode_rm(opcode, ops[0][1], ops[1], operand_size(ops), symbols, prefix=prefix)
+
+        case "push", ("reg",) if ops[0][2] == 64:
+            return (b"\x41" if ops[0][1] >= 8 else b"") + bytes([0x50 | ops[0][1] & 7])
+
+        case "pop", ("reg",) if ops[0][2] == 64:
+            return (b"\x41" if ops[0][1] >= 8 else b"") + bytes([0x58 | ops[0][1] & 7])
+
+        case "push", ("imm",):
+            value = imm_value(ops[0], symbols)
+            if ops[0][3] is None and fits(value, 8):
+                return b"\x6a" + immediate(value, 8)
+            return b"\x68" + immediate(value, 32)
+
+        case "push" | "pop", ("mem",):
+            opcode, n = (b"\xff", 6) if mnem == "push" else (b"\x8f", 0)
+            return encode_rm(opcode, n, ops[0], 32, symbols)
+
+        case "call", ("imm",) if ops[0][3]:
+            return b"\xe8" + immediate(imm_value(ops[0], symbols) - addr - 5, 32)
+
+        case "call" | "jmp", ("reg" | "mem",):
+            return encode_rm(b"\xff", 2 if mnem == "call" else 4, ops[0], 32, symbols)
+
+        case _, ("reg" | "mem",) if mnem.startswith("set") and mnem[3:] in CONDITIONS:
+            return encode_rm(bytes([0x0F, 0x90 | CONDITIONS[mnem[3:]]]), 0, ops[0], 8, symbols,
+                             byte_regs=ops)
+
+        case _, ("reg", "reg" | "mem") if mnem.startswith("cmov") and mnem[4:] in CONDITIONS:
+            return encode_rm(bytes([0x0F, 0x40 | CONDITIONS[mnem[4:]]]), ops[0][1], ops[1],
+                             operand_size(ops), symbols)
+
+        case _, ("reg", "reg" | "mem") if mnem in SSE_OPS and ops[0][2] == 128:
+            prefix, opcode = SSE_OPS[mnem]
+            return encode_rm(bytes([0x0F, opcode]), ops[0][1], ops[1], 128, symbols,
+                             prefix=bytes([prefix]))
+
+        case _, ("reg", "reg" | "mem") | ("mem", "reg") if mnem in SSE_MOVES:
+            store = kinds[0] == "mem"
+            reg, rm = (ops[1], ops[0]) if store else (ops[0], ops[1])
+            return encode_rm(bytes([0x0F, 0x7F if store else 0x6F]), reg[1], rm, 128, symbols,
+                             prefix=bytes([SSE_MOVES[mnem]]))
+
+        case "pshufd", ("reg", "reg" | "mem", "imm"):
+            return encode_rm(b"\x0f\x70", ops[0][1], ops[1], 128, symbols, prefix=b"\x66",
+                             imm=immediate(imm_value(ops[2], symbols), 8))
+
+        case "pmovmskb", ("reg", "reg") if ops[1][2] == 128:
+            return encode_rm(b"\x0f\xd7", ops[0][1], ops[1], 32, symbols, prefix=b"\x66")
+
+        case "movd" | "movq", ("reg", "reg" | "mem") | ("mem", "reg"):
+            to_xmm = ops[0][0] == "reg" and ops[0][2] == 128
+            xmm, other = (ops[0], ops[1]) if to_xmm else (ops[1], ops[0])
+            if xmm[0] != "reg" or xmm[2] != 128 or other[0] == "reg" and other[2] == 128:
+                raise Unencodable(f"unsupported {mnem} operands")
+            bits = 64 if mnem == "movq" else 32
+            return encode_rm(bytes([0x0F, 0x6E if to_xmm else 0x7E]), xmm[1], other, bits,
+                             symbols, prefix=b"\x66")
+
+    raise Unencodable(f"can't encode {mnem} {', '.join(kinds)}".rstrip())
+
+
+def branch(mnem, rel, short):
+    """jmp or jcc with a rel8 or rel32 displacement from its end"""
+    if mnem == "jmp":
+        return b"\xeb" + immediate(rel - 2, 8) if short else b"\xe9" + immediate(rel - 5, 32)
+    cc = CONDITIONS[mnem[1:]]
+    if short:
+        return bytes([0x70 | cc]) + immediate(rel - 2, 8)
+    return bytes([0x0F, 0x80 | cc]) + immediate(rel - 6, 32)
+
+
+def is_branch(mnem, ops):
+    return (mnem == "jmp" or mnem[0] == "j" and mnem[1:] in CONDITIONS) \
+        and len(ops) == 1 and ops[0][0] == "imm" and ops[0][3] is not None
+
+
+def parse_asm(source):
+    """The sections of an assembly text as lists of items:
+    ("label", name), ("insn", mnem, operands), ("data", bytes, symbols),
+    ("space", size) and ("align", n). Also returns the names declared
+    global and the names of the labels that are not local .labels."""
+    sections = {".text": [], ".rodata": [], ".data": [], ".bss": []}
+    consts = {}
+    globals_ = set()
+    named = set()
+    items = sections[".text"]
+    scope = ""
+    for line in source.split("\n"):
+        line = strip_comment(line).strip()
+        if not line:
+            continue
+        match = re.match(r"([\w.?$@]+)\s+equ\s+(.+)$", line)
+        if match:
+            name = qualify(match[1], scope)
+            value = asm_constant(match[2].strip(), consts)
+            if value is None:
+                value, symbol = asm_value(match[2], scope, consts)
+                if symbol:
+                    raise Unencodable(f"can't encode {line!r}")
+            consts[name] = value
+            continue
+        match = re.match(r"([\w.?$@]+):\s*(.*)$", line)
+        if match:
+            if not match[1].startswith("."):
+                scope = match[1]
+                named.add(scope)
+            items.append(("label", qualify(match[1], scope)))
+            line = match[2]
+            if not line:
+                continue
+        mnem, _, rest = line.partition(" ")
+        mnem, rest = mnem.lower(), rest.strip()
+        if mnem == "section":
+            if rest not in sections:
+                raise Unencodable(f"unknown section {rest}")
+            items = sections[rest]
+        elif mnem == "global":
+            globals_.update(name.strip() for name in rest.split(","))
+        elif mnem == "align":
+            items.append(("align", asm_constant(rest, consts)))
+        elif mnem in ("db", "dw", "dd", "dq"):
+            items.append(data_item(mnem, rest, scope, consts))
+        elif mnem in ("resb", "resw", "resd", "resq"):
+            count = asm_constant(rest.replace(" ", ""), consts)
+            if count is None:
+                raise Unencodable(f"can't encode {line!r}")
+            items.append(("space", count * {"b": 1, "w": 2, "d": 4, "q": 8}[mnem[-1]]))
+        elif mnem in REPEAT_PREFIXES and rest in NO_OPERANDS:
+            items.append(("data", REPEAT_PREFIXES[mnem] + NO_OPERANDS[rest], ()))
+        else:
+            ops = [asm_operand(op, scope, consts) for op in split_operands(rest)]
+            items.append(("insn", mnem, ops))
+    return sections, globals_, named
+
+
+def data_item(directive, text, scope, consts):
+    """("data", bytes, [(offset, symbol, addend)]) for a db/dw/dd/dq line"""
+    width = {"db": 1, "dw": 2, "dd": 4, "dq": 8}[directive]
+    data = bytearray()
+    relocs = []
+    for part in split_operands(text):
+        if part[0] in "\"'`" and part[-1] == part[0] and len(part) > 1:
+            data += part[1:-1].encode()
+            data += bytes(-len(data) % width if width > 1 else 0)
+            continue
+        value, symbol = asm_value(part, scope, consts)
+        if symbol:
+            if width < 4:
+                raise Unencodable(f"can't store an address in {directive}")
+            relocs.append((len(data), symbol, value, width))
+            value = 0
+        data += immediate(value, width * 8)
+    return ("data", bytes(data), relocs)
+
+
+def layout(items, base, symbols):
+    """Give every label of a section its address from base, widening
+    branches that don't reach with a rel8 until nothing changes. Returns
+    the section size and the per-item sizes."""
+    short = {i: True for i, item in enumerate(items)
+             if item[0] == "insn" and is_branch(item[1], item[2])}
+    sizes = {}
+    while True:
+        addr = base
+        positions = []
+        for i, item in enumerate(items):
+            positions.append(addr)
+            match item:
+                case ("label", name):
+                    symbols[name] = addr
+                case ("insn", mnem, ops):
+                    if i in short:
+                        addr += 2 if short[i] else 5 if mnem == "jmp" else 6
                     else:
-                        expr_asm = parse_expr(tok3)
-                        out.append(expr_asm)
-                        off = var_offset(name)
-                        out.append(f"    mov [rbp - {off}], rax")
+                        if i not in sizes:
+                            sizes[i] = len(encode_insn(mnem, ops, lambda name: 0, addr))
+                        addr += sizes[i]
+                case ("data", data, _):
+                    addr += len(data)
+                case ("space", size):
+                    addr += size
+                case ("align", n):
+                    addr += -addr % n
+        changed = False
+        for i, is_short in short.items():
+            target = symbols.get(items[i][2][0][3])
+            if target is None:
+                raise Unencodable(f"unknown label {items[i][2][0][3]}")
+            target += items[i][2][0][2]
+            if is_short and not fits(target - positions[i] - 2, 8):
+                short[i] = False
+                changed = True
+        if not changed:
+            return addr - base, positions, short
+
+
+def emit_section(items, base, size, positions, short, lookup, fill):
+    """The bytes of a laid out section, gaps filled with the fill byte"""
+    code = bytearray()
+    for i, item in enumerate(items):
+        addr = positions[i]
+        code += fill * (addr - base - len(code))
+        match item:
+            case ("insn", mnem, ops):
+                if i in short:
+                    code += branch(mnem, imm_value(ops[0], lookup) - addr, short[i])
+                else:
+                    code += encode_insn(mnem, ops, lookup, addr)
+            case ("data", data, relocs):
+                data = bytearray(data)
+                for offset, symbol, addend, width in relocs:
+                    data[offset:offset + width] = immediate(lookup(symbol) + addend, width * 8)
+                code += data
+    return bytes(code + fill * (size - len(code)))
+
+
+# --- ELF writer ---
+# A static executable: one read-execute segment with the headers, .text
+# and .rodata, one read-write segment with .data followed by .bss, and section
+# headers with a symbol table for debuggers and profilers.
+ELF_BASE = 0x400000
+PAGE_SIZE = 0x1000
+
+
+def align(value, n):
+    return value + -value % n
+
+
+def link_executable(source):
+    """The bytes of a static x86-64 ELF executable for assembly source"""
+    sections, globals_, named = parse_asm(source)
+    text, rodata = sections[".text"], sections[".rodata"]
+    data, bss = sections[".data"], sections[".bss"]
+    has_data = bool(data or bss)
+    text_offset = align(64 + 56 * (1 + has_data), 16)
+    symbols = {}
+
+    def lookup(name):
+        if name not in symbols:
+            raise Unencodable(f"unknown symbol {name}")
+        return symbols[name]
+
+    text_base = ELF_BASE + text_offset
+    text_size, text_positions, short = layout(text, text_base, symbols)
+    # read-only data shares the code's segment, which is not writable
+    rodata_offset = align(text_offset + text_size, 16)
+    rodata_base = ELF_BASE + rodata_offset
+    rodata_size, rodata_positions, _ = layout(rodata, rodata_base, symbols)
+    data_offset = align(rodata_offset + rodata_size, 16)
+    # a segment's address has to match its file offset modulo the page size
+    data_base = align(ELF_BASE + data_offset, PAGE_SIZE) + data_offset % PAGE_SIZE
+    data_size, data_positions, _ = layout(data, data_base, symbols)
+    bss_base = align(data_base + data_size, 16)
+    bss_size, _, _ = layout(bss, bss_base, symbols)
+    if "_start" not in symbols:
+        raise Unencodable("no _start")
+
+    code = emit_section(text, text_base, text_size, text_positions, short, lookup, b"\x90")
+    constants = emit_section(rodata, rodata_base, rodata_size, rodata_positions, {}, lookup,
+                             b"\0")
+    initialized = emit_section(data, data_base, data_size, data_positions, {}, lookup, b"\0")
+
+    # named labels become symbols; functions are sized up to the next one
+    named = sorted((addr, name) for name, addr in symbols.items() if name in named)
+    strtab = bytearray(b"\0")
+    local_syms, global_syms = [], []
+    for i, (addr, name) in enumerate(named):
+        if text_base <= addr < text_base + text_size:
+            shndx, kind = 1, 2  # STT_FUNC
+            end = next((a for a, _ in named[i + 1:] if a > addr), text_base + text_size)
+            size = min(end, text_base + text_size) - addr
+        elif addr < data_base:
+            shndx, kind, size = 2, 1, 0  # STT_OBJECT
+        else:
+            shndx, kind, size = (3 if addr < bss_base else 4), 1, 0
+        binding = 1 if name in globals_ else 0
+        entry = struct.pack("<IBBHQQ", len(strtab), binding << 4 | kind, 0, shndx, addr, size)
+        (global_syms if binding else local_syms).append(entry)
+        strtab += name.encode() + b"\0"
+    symtab = bytes(24) + b"".join(local_syms + global_syms)
+
+    shstrtab = b"\0.text\0.rodata\0.data\0.bss\0.symtab\0.strtab\0.shstrtab\0"
+    symtab_offset = align(data_offset + data_size, 8)
+    strtab_offset = symtab_offset + len(symtab)
+    shstrtab_offset = strtab_offset + len(strtab)
+    shoff = align(shstrtab_offset + len(shstrtab), 8)
+
+    def section(name, kind, flags, addr, offset, size, link=0, info=0, alignment=1, entsize=0):
+        return struct.pack("<IIQQQQIIQQ", shstrtab.index(name.encode() + b"\0"), kind, flags,
+                           addr, offset, size, link, info, alignment, entsize)
+
+    headers = [
+        bytes(64),
+        section(".text", 1, 6, text_base, text_offset, text_size, alignment=16),
+        section(".rodata", 1, 2, rodata_base, rodata_offset, rodata_size, alignment=16),
+        section(".data", 1, 3, data_base, data_offset, data_size, alignment=16),
+        section(".bss", 8, 3, bss_base, data_offset + data_size, bss_size, alignment=16),
+        section(".symtab", 2, 0, 0, symtab_offset, len(symtab), 6, 1 + len(local_syms), 8, 24),
+        section(".strtab", 3, 0, 0, strtab_offset, len(strtab)),
+        section(".shstrtab", 3, 0, 0, shstrtab_offset, len(shstrtab)),
+    ]
+
+    ident = b"\x7fELF\x02\x01\x01" + bytes(9)
+    elf_header = ident + struct.pack("<HHIQQQIHHHHHH", 2, 0x3E, 1, symbols["_start"], 64, shoff,
+                                     0, 64, 56, 1 + has_data, 64, len(headers), 7)
+    program_headers = struct.pack("<IIQQQQQQ", 1, 5, 0, ELF_BASE, ELF_BASE,
+                                  rodata_offset + rodata_size, rodata_offset + rodata_size,
+                                  PAGE_SIZE)
+    if has_data:
+        program_headers += struct.pack("<IIQQQQQQ", 1, 6, data_offset, data_base, data_base,
+                                       data_size, bss_base + bss_size - data_base, PAGE_SIZE)
+
+    image = bytearray(elf_header + program_headers)
+    image += bytes(text_offset - len(image)) + code
+    image += bytes(rodata_offset - len(image)) + constants
+    image += bytes(data_offset - len(image)) + initialized
+    image += bytes(symtab_offset - len(image)) + symtab + strtab + shstrtab
+    image += bytes(shoff - len(image)) + b"".join(headers)
+    return bytes(image)
+
+
+def write_executable(source, path):
+    """Assemble and link source into the executable path"""
+    image = link_executable(source)
+    temp = f"{path}.{os.getpid()}.tmp"
+    with open(temp, "wb") as f:
+        f.write(image)
+    os.chmod(temp, 0o755)
+    os.replace(temp, path)
+
+
+def build(path, backend="nasm", output="out"):
+    """Compile path and its imports as one program into the executable
+    output, by way of output.asm and output.o. The builtin backend writes
+    output directly, going through nasm and ld only for assembly it can't
+    encode."""
+    global builtin_fns
+    fn_inline.clear()
+    fn_exported.clear()
+    included = set()
+    with open(path) as f:
+        chunks = []
+        timed("preprocess", preprocess_and_import, f.read(), None, included, None, chunks)
+    try:
+        toks, toks_positions = timed("tokenize", tokenize_program, chunks)
+        count("tokens", len(toks))
+        program = timed("parse", parse_tokens, toks, toks_positions)
+        builtin_fns = set()
+        for name in included:
+            if os.path.basename(name) == "std.un":
+                with open(name) as f:
+                    builtin_fns = std_builtins(tokenize(f.read())[0], program)
+        asm_out = compile_to_asm(program)
+    except CompileError as e:
+        raise CompileError(f"{path}:{e}")
+    count("asm_bytes", len(asm_out))
+    if backend == "builtin":
+        try:
+            timed("encode", write_executable, asm_out, output)
+            count("executable_bytes", os.path.getsize(output))
+            return
+        except Unencodable as e:
+            print(f"{path}: {e}, assembling with nasm", file=sys.stderr)
+    with open(f"{output}.asm", "w") as f:
+        f.write(asm_out)
+    # print(asm_out)
+    if run_tool("assemble", ["nasm", "-felf64", f"{output}.asm", "-o", f"{output}.o"]) != 0:
+        raise CompileError(f"{path}: nasm failed")
+    if run_tool("link", ["ld", f"{output}.o", "-o", output]) != 0:
+        raise CompileError(f"{path}: ld failed")
+    count("executable_bytes", os.path.getsize(output))
+
+
+def build_separate(path, output="out"):
+    """Compile every module to its own object file and link them into output.
+
+    Objects are cached on the module's preprocessed text and the symbols
+    the other modules define, so an unchanged module is not regenerated or
+    reassembled.
+    """
+    global builtin_fns
+    fn_inline.clear()
+    fn_exported.clear()
+    modules = []
+    with open(path) as f:
+        text = timed("preprocess", preprocess_and_import, f.read(), None, None, modules)
+    modules.append((path, text))
+
+    tokenized = []
+    for name, text in modules:
+        # imports are tokenized once per content, like in tokenize_program
+        if import_cache and name != path:
+            toks = timed("tokenize", imported_tokens, text)
+        else:
+            toks = timed("tokenize", tokenize, text)
+        tokenized.append((name, text, *toks))
+    count("tokens", sum(len(toks) for _, _, toks, _ in tokenized))
+    all_fns = set()
+    for _, _, toks, _ in tokenized:
+        all_fns |= scan_fn_names(toks)
+    parsed = []
+    for name, text, toks, toks_positions in tokenized:
+        try:
+            parsed.append((name, text, timed("parse", parse_tokens, toks, toks_positions,
+                                             all_fns)))
+        except CompileError as e:
+            raise CompileError(f"{name}:{e}")
+    module_buffers = {name: program_buffers(program) for name, _, program in parsed}
+    all_buffers = set().union(*module_buffers.values())
+    whole = [node for _, _, program in parsed for node in program]
+    builtin_fns = set()
+    for name, _, toks, _ in tokenized:
+        if os.path.basename(name) == "std.un" and name != path:
+            builtin_fns = std_builtins(toks, whole)
+    # the calls into each module from the live functions of the others
+    live = reachable_fns(whole, program_roots(whole)) if dead_fn_enabled else set()
+    calls_out = {
+        name: called_fns([node[3] for node in program
+                          if node[0] == "fn" and (not live or node[1] in live)], all_fns)
+        for name, _, program in parsed
+    }
+
+    obj_dir = import_cache.path if import_cache else tempfile.mkdtemp(prefix="un-")
+    objects = []
+    for name, text, program in parsed:
+        fns = {node[1] for node in program if node[0] == "fn"}
+        local = module_buffers[name] | fns
+        called = fns & set().union(*(calls for other, calls in calls_out.items() if other != name))
+        options = [inline_enabled, loop_opt_enabled, peephole_enabled, dead_fn_enabled,
+                   arith_opt_enabled]
+        key = file_hash(json.dumps([COMPILER_HASH, text, sorted(all_fns), sorted(all_buffers),
+                                    sorted(builtin_fns), sorted(called), sorted(fn_exported),
+                                    options]))
+        obj = import_cache.get_object(key) if import_cache else None
+        if obj is None:
+            try:
+                asm_out = compile_to_asm(program, (all_fns | all_buffers) - local,
+                                         all_buffers - module_buffers[name], called)
+            except CompileError as e:
+                raise CompileError(f"{name}:{e}")
+            obj = os.path.join(obj_dir, key + ".o")
+            asm_path = f"{obj}.{os.getpid()}.asm"
+            count("asm_bytes", len(asm_out))
+            with open(asm_path, "w") as f:
+                f.write(asm_out)
+            returncode = run_tool("assemble", ["nasm", "-felf64", asm_path, "-o", asm_path + ".o"])
+            os.remove(asm_path)
+            if returncode != 0:
+                raise CompileError(f"{name}: nasm failed")
+            os.replace(asm_path + ".o", obj)
+        objects.append(obj)
+    returncode = run_tool("link", ["ld", *objects, "-o", output])
+    if import_cache:
+        import_cache.evict()
+    if returncode != 0:
+        raise CompileError(f"{path}: ld failed")
+    count("executable_bytes", os.path.getsize(output))
+
+
+def output_path(path):
+    """Where batch mode writes the executable for path: beside it, without
+    the .un"""
+    base, ext = os.path.splitext(path)
+    return base if ext == ".un" else path + ".out"
+
+
+def argument_parser():
+    parser = argparse.ArgumentParser(
+        description="Compile a .un program to ./out, or several to executables beside them")
+    parser.add_argument("files", metavar="file", nargs="*")
+    parser.add_argument("-o", "--output", metavar="FILE",
+                        help="write the executable to FILE instead of out (one file only)")
+    parser.add_argument("--server", metavar="SOCKET",
+                        help="compile the command lines sent to the Unix socket SOCKET, "
+                             "keeping imports warm between them")
+    parser.add_argument("--connect", metavar="SOCKET",
+                        help="have the server on SOCKET run this command line")
+    parser.add_argument("--separate", action="store_true",
+                        help="compile each module to its own cached object file")
+    parser.add_argument("--backend", choices=["nasm", "builtin"], default="nasm",
+                        help="assemble and link with nasm and ld, or encode the executable "
+                             "in-process (falls back to nasm for what it can't encode)")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="generate functions on this many processes, 0 for one per "
+                             "CPU (the output is the same as with one)")
+    parser.add_argument("--no-peephole", action="store_true",
+                        help="skip the peephole pass over the generated assembly")
+    parser.add_argument("--no-inline", action="store_true",
+                        help="keep every call, even to small functions")
+    parser.add_argument("--no-dead-fn-elim", action="store_true",
+                        help="emit every function, even ones _start can't reach")
+    parser.add_argument("--no-loop-opt", action="store_true",
+                        help="keep for loops unrotated and skip strength reduction")
+    parser.add_argument("--no-arith-opt", action="store_true",
+                        help="multiply, divide and take remainders by constants with imul "
+                             "and idiv")
+    parser.add_argument("--peephole-report", action="store_true",
+                        help="print how many instructions each peephole rule removed")
+    parser.add_argument("--dead-fn-report", action="store_true",
+                        help="print the functions dropped as unreachable")
+    parser.add_argument("--inline-report", action="store_true",
+                        help="print the functions inlined and how many calls each replaced")
+    parser.add_argument("--time-passes", action="store_true",
+                        help="print the wall time and peak memory of each phase")
+    parser.add_argument("--stats", action="store_true",
+                        help="print counts of tokens, functions, stack slots, instructions, "
+                             "string literals and mem bytes")
+    parser.add_argument("--stats-json", metavar="FILE",
+                        help="write the phase times and counts as JSON to FILE, - for stdout")
+    return parser
+
+
+def compile_command(argv):
+    """Build the files of one command line and print the reports it asks
+    for; returns the exit status. A file that fails to compile does not
+    stop the others."""
+    global peephole_enabled, loop_opt_enabled, inline_enabled, dead_fn_enabled, codegen_jobs
+    global arith_opt_enabled, tool_stats
+    parser = argument_parser()
+    args = parser.parse_args(argv)
+    if not args.files:
+        parser.error("no input files")
+    if args.output and len(args.files) > 1:
+        parser.error("-o needs a single input file")
+    peephole_enabled = not args.no_peephole
+    loop_opt_enabled = not args.no_loop_opt
+    inline_enabled = not args.no_inline
+    dead_fn_enabled = not args.no_dead_fn_elim
+    arith_opt_enabled = not args.no_arith_opt
+    codegen_jobs = args.jobs or os.cpu_count() or 1
+    tool_stats = args.time_passes or bool(args.stats_json)
+    for table in (peephole_stats, inline_stats, inline_refused, pass_times, compile_stats):
+        table.clear()
+    removed_fns.clear()
+    if import_cache is not None:
+        import_cache.reset_counters()
+
+    if len(args.files) == 1:
+        outputs = [args.output or "out"]
+    else:
+        outputs = [output_path(path) for path in args.files]
+    status = 0
+    for path, output in zip(args.files, outputs):
+        try:
+            if args.separate:
+                build_separate(path, output)
+            else:
+                build(path, args.backend, output)
+        except (CompileError, OSError) as e:
+            print(e, file=sys.stderr)
+            status = 1
+
+    if args.peephole_report:
+        for name, _ in PEEPHOLE_RULES:
+            print(f"peephole {name}: {peephole_stats.get(name, 0)} removed", file=sys.stderr)
+    if args.inline_report:
+        for name, count in sorted(inline_stats.items()):
+            print(f"inline {name}: {count} inlined", file=sys.stderr)
+        for name, reason in sorted(inline_refused.items()):
+            print(f"inline {name}: not inlined, {reason}", file=sys.stderr)
+    if args.dead_fn_report:
+        for name in removed_fns:
+            print(f"dead fn {name}: removed", file=sys.stderr)
+    if args.time_passes:
+        for name, (seconds, peak) in pass_times.items():
+            print(f"time {name}: {seconds * 1000:.1f} ms, peak {peak / 1024:.1f} MiB",
+                  file=sys.stderr)
+    if args.stats:
+        for name, value in compile_stats.items():
+            if name == "stack_slots":
+                for fn, slots in value.items():
+                    print(f"stats stack slots {fn}: {slots}", file=sys.stderr)
+            else:
+                print(f"stats {name.replace('_', ' ')}: {value}", file=sys.stderr)
+    if args.stats_json == "-":
+        print(stats_json())
+    elif args.stats_json:
+        with open(args.stats_json, "w") as f:
+            f.write(stats_json())
+
+    if import_cache is not None:
+        totals = import_cache.save_stats()
+        if os.environ.get("UN_CACHE_STATS"):
+            print(f"import cache: {import_cache.hits} hits, {import_cache.misses} misses, "
+                  f"{import_cache.object_hits} object hits, "
+                  f"{import_cache.object_misses} object misses, "
+                  f"{import_cache.evictions} evictions "
+                  f"(total {totals['hits']} hits, {totals['misses']} misses)", file=sys.stderr)
+    return status
+
+
+# --- Compile server ---
+# The server answers one request per connection: the client sends a JSON
+# object with its working directory and command line and closes its end;
+# the server replies with the exit status and what the command printed.
+# Requests are compiled one at a time since the compiler state is global.
+
+def read_all(conn):
+    chunks = []
+    while chunk := conn.recv(65536):
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+
+def serve(path):
+    """Compile the command lines sent to the Unix socket path until
+    interrupted or terminated"""
+    if os.path.exists(path):
+        os.remove(path)  # left behind by a server that was killed
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen()
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        while True:
+            conn, _ = listener.accept()
+            with conn:
+                conn.sendall(json.dumps(handle_request(read_all(conn))).encode())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.close()
+        os.remove(path)
+
+
+def handle_request(data):
+    stdout, stderr = io.StringIO(), io.StringIO()
+    cwd = os.getcwd()
+    sys.stdout, sys.stderr = stdout, stderr
+    try:
+        request = json.loads(data)
+        os.chdir(request["cwd"])
+        status = compile_command(request["argv"])
+    except SystemExit as e:  # a bad command line
+        status = e.code if isinstance(e.code, int) else 1
+    except Exception:
+        traceback.print_exc()
+        status = 1
+    finally:
+        sys.stdout, sys.stderr = sys.__stdout__, sys.__stderr__
+        os.chdir(cwd)
+    return {"status": status, "stdout": stdout.getvalue(), "stderr": stderr.getvalue()}
+
+
+def connect(path, argv):
+    """Have the server on path run argv in this directory; returns its
+    exit status"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        conn.connect(path)
+        conn.sendall(json.dumps({"cwd": os.getcwd(), "argv": argv}).encode())
+        conn.shutdown(socket.SHUT_WR)
+        reply = json.loads(read_all(conn))
+    sys.stdout.write(reply["stdout"])
+    sys.stderr.write(reply["stderr"])
+    return reply["status"]
+
+
+def main():
+    global import_cache
+    argv = sys.argv[1:]
+    args = argument_parser().parse_args(argv)
+    if args.connect:
+        sys.exit(connect(args.connect, argv))
+
+    if os.environ.get("UN_CACHE", "1") != "0":
+        cache_dir = os.environ.get("UN_CACHE_DIR") or os.path.join(
+            os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "un")
+        import_cache = ImportCache(cache_dir, int(os.environ.get("UN_CACHE_MAX_BYTES", 64 << 20)))
+    if args.server:
+        serve(args.server)
+    else:
+        sys.exit(compile_command(argv))
 
-        case _:
-            skip_line()
 
-# Generate .data section (after code generation so literals are included)
-data_section = []
-if strings:
-    data_section.append("section .data")
-    for label, content in strings:
-        parts = []
-        current = ""
-        for c in content:
-            if c == "\n":
-                if current:
-                    parts.append(f'"{current}"')
-                parts.append("10")
-                current = ""
-            elif c == "\t":
-                if current:
-                    parts.append(f'"{current}"')
-                parts.append("9")
-                current = ""
-            else:
-                current += c
-        if current:
-            parts.append(f'"{current}"')
-        parts.append("0")
-        data_section.append(f"    {label}: db {', '.join(parts)}")
-    data_section.append("")
-
-# Generate .bss section for mem buffers
-bss_section = []
-if mem_buffers:
-    bss_section.append("section .bss")
-    for name, size in mem_buffers:
-        bss_section.append(f"    {name}: resb {size}")
-    bss_section.append("")
-
-# Combine: .data first, then .bss, then .text
-asm_out = "\n".join(data_section + bss_section + out)
-with open("out.asm", "w") as f:
-    f.write(asm_out)
-# print(asm_out)
-subprocess.run(["nasm", "-felf64", "out.asm", "-o", "out.o"])
-subprocess.run(["ld", "out.o", "-o", "out"])
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,26 @@
+import os
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+
+@pytest.fixture
+def run_program(tmp_path):
+    """Compile a program with the builtin backend and run it; returns the
+    completed process with stdout and stderr merged"""
+    for name in ("std.un", "io.un", "mem.un"):
+        shutil.copy(os.path.join(ROOT, name), tmp_path)
+
+    def run(source, *flags, stdin=None):
+        (tmp_path / "prog.un").write_text(source)
+        subprocess.run([sys.executable, os.path.join(ROOT, "main.py"), "--backend", "builtin",
+                        *flags, "prog.un"],
+                       cwd=tmp_path, check=True, env={**os.environ, "UN_CACHE": "0"})
+        return subprocess.run([str(tmp_path / "out")], input=stdin, stdout=subprocess.PIPE,
+                              stderr=subprocess.STDOUT)
+    return run
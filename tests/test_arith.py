@@ -0,0 +1,80 @@
+import random
+
+import pytest
+
+import main
+
+CONSTANTS = [1, -1, 2, -2, 3, 5, 7, -7, 8, 9, 10, 12, 16, -16, 25, 45, 100, 641, 1000,
+             1 << 31, 1 << 32, (1 << 31) - 1, 1 << 40, -(1 << 40), 1 << 62, (1 << 63) - 1,
+             -(1 << 63), 123456789123]
+VALUES = [0, 1, -1, 5, -5, 99, -100, 12345, -987654321, 1 << 40, (1 << 63) - 1, -(1 << 63)]
+
+
+def checks():
+    rng = random.Random(0)
+    cases = []
+    for c in CONSTANTS:
+        for x in VALUES + [rng.randrange(-(1 << 63), 1 << 63) for _ in range(3)]:
+            for op in "*/%":
+                if not (op != "*" and c == -1 and x == -(1 << 63)):  # idiv faults
+                    cases.append((op, x, c, main.fold_binop(op, x, c)))
+    return cases
+
+
+def literal(value):
+    """value in source, which has no unary minus"""
+    return str(value) if value >= 0 else f"(0 - {-value})"
+
+
+def test_constant_operands_match_the_folded_value(run_program):
+    # argc keeps x unknown at compile time
+    lines = ['import "std.un"', "fn main(argc, argv)"]
+    for i, (op, x, c, want) in enumerate(checks()):
+        lines += [f"    x = argc * {literal(x)}",
+                  f"    if x {op} {literal(c)} != {literal(want)}",
+                  f'        print "bad {i}\\n"',
+                  "    end"]
+    lines += ['    print "done"', "    ret 0", "end"]
+    assert run_program("\n".join(lines) + "\n").stdout == b"done"
+
+
+def test_remainder_under_register_pressure(run_program):
+    source = """import "std.un"
+noinline fn id(x)
+    ret x
+end
+fn main(argc, argv)
+    a = argc * 1000003
+    b = argc * (0 - 77777)
+    t = a / 7 + (b % 9) * (a / (0 - 3)) - id(b) / 10 + (a % 16) * (b % 1024) + id(a % 100)
+    if t == {}
+        print "ok"
+    end
+    ret 0
+end
+"""
+    f = main.fold_binop
+    a, b = 1000003, -77777
+    t = f("/", a, 7) + f("%", b, 9) * f("/", a, -3) - f("/", b, 10) + f("%", a, 16) * f("%", b, 1024) \
+        + f("%", a, 100)
+    assert run_program(source.format(t)).stdout == b"ok"
+
+
+@pytest.mark.parametrize("expr, insns", [
+    ("x * 8", ["shl rax, 3"]),
+    ("x * 10", ["lea rax, [rax + rax*4]", "shl rax, 1"]),
+    ("x * 45", ["lea rax, [rax + rax*4]", "lea rax, [rax + rax*8]"]),
+    ("x * 7", ["imul rax, rax, 7"]),
+    ("x / 7", ["imul rcx"]),
+    ("x / 4", ["sar rcx, 63", "shr rcx, 62", "add rax, rcx", "sar rax, 2"]),
+    ("x % 8", ["and rax, 7"]),
+])
+def test_constant_operands_avoid_idiv(expr, insns):
+    main.fn_inline.clear()
+    main.fn_exported.clear()
+    source = f"noinline fn f(x)\n    ret {expr}\nend\n"
+    asm = main.compile_to_asm(main.parse_tokens(*main.tokenize(source)))
+    body = [line.strip() for line in asm.split("f:")[1].splitlines()]
+    assert "idiv" not in asm.split("f:")[1]
+    for insn in insns:
+        assert insn in body
@@ -0,0 +1,28 @@
+import json
+import os
+import subprocess
+import sys
+
+from conftest import ROOT
+
+SUITE = os.path.join(ROOT, "bench", "suite.py")
+
+
+def test_results_and_comparison(tmp_path):
+    out = tmp_path / "results.json"
+    subprocess.run([sys.executable, SUITE, "--sizes", "1", "--repeat", "1", "-o", str(out)],
+                   cwd=tmp_path, check=True, stdout=subprocess.DEVNULL)
+    results = json.loads(out.read_text())
+    assert {"commit", "python", "machine", "cpus", "backend"} <= results.keys()
+    [entry] = results["compile"]
+    assert entry["size"] == 1 and entry["functions"] == 40
+    assert entry["total"] == sum(entry["phases"].values())
+    assert {"preprocess", "tokenize", "parse", "pass1", "pass2", "data"} <= entry["phases"].keys()
+    kernels = [kernel["kernel"] for kernel in results["runtime"]]
+    assert kernels and all(len(kernel["runs"]) == 1 for kernel in results["runtime"])
+
+    comparison = subprocess.run([sys.executable, SUITE, "--compare", str(out), str(out)],
+                                check=True, stdout=subprocess.PIPE, text=True).stdout
+    assert "size   1: total   1.00x" in comparison
+    for kernel in kernels:
+        assert f"{kernel}: time   1.00x" in comparison
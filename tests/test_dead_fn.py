@@ -0,0 +1,35 @@
+import os
+import subprocess
+import sys
+
+from conftest import ROOT
+
+
+def test_unreachable_functions_are_dropped(run_program, tmp_path):
+    source = """import "std.un"
+fn bump(x)
+    ret x + 1
+end
+fn unused_leaf(x)
+    ret x * 2
+end
+fn unused_caller(x)
+    ret unused_leaf(x) + bump(x)
+end
+export fn kept(x)
+    ret x
+end
+fn main(argc, argv)
+    ret bump(argc) + 10
+end
+"""
+    result = run_program(source)
+    assert result.returncode == 12
+    # without inlining, so only the unreachable functions are reported
+    report = subprocess.run([sys.executable, os.path.join(ROOT, "main.py"), "--backend", "builtin",
+                             "--dead-fn-report", "--no-inline", "prog.un"], cwd=tmp_path, stderr=subprocess.PIPE,
+                            text=True, env={**os.environ, "UN_CACHE": "0"})
+    removed = {line.split()[2].rstrip(":") for line in report.stderr.splitlines()
+               if line.startswith("dead fn ")}
+    assert {"unused_leaf", "unused_caller"} <= removed
+    assert not removed & {"bump", "kept", "main"}
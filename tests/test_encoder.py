@@ -0,0 +1,287 @@
+"""Encodings of the builtin backend, against a table of golden encodings
+and, where GNU as is installed, against as for random operands"""
+import os
+import random
+import re
+import shutil
+import subprocess
+
+import pytest
+
+import main
+
+# checked against GNU as; where as picks another encoding of the same
+# instruction, the table keeps ours
+GOLDEN = [
+    ("add rax, rbx", "4801d8"),
+    ("add r12, r9", "4d01cc"),
+    ("sub rsp, 8", "4883ec08"),
+    ("sub rsp, 4096", "4881ec00100000"),
+    ("add qword [rbp - 8], 1", "488345f801"),
+    ("cmp rax, 0x7fffffff", "483dffffff7f"),
+    ("cmp eax, -3", "83f8fd"),
+    ("xor eax, eax", "31c0"),
+    ("xor r8d, r8d", "4531c0"),
+    ("and rdi, -16", "4883e7f0"),
+    ("or ecx, edx", "09d1"),
+    ("cmp byte [rsi + rcx], 0", "803c0e00"),
+    ("cmp r11b, [rdi]", "443a1f"),
+    ("test rax, rax", "4885c0"),
+    ("test eax, 0xffff", "f7c0ffff0000"),
+    ("test sil, sil", "4084f6"),
+    ("mov rax, rbx", "4889d8"),
+    ("mov rbp, rsp", "4889e5"),
+    ("mov r13, [rbp - 16]", "4c8b6df0"),
+    ("mov [rbp - 24], r14", "4c8975e8"),
+    ("mov [rsp], rax", "48890424"),
+    ("mov [r12], rax", "49890424"),
+    ("mov [r13], rax", "49894500"),
+    ("mov rax, [rdi + rcx*8]", "488b04cf"),
+    ("mov rax, [rbx + r12*8 + 128]", "4a8b84e380000000"),
+    ("mov rax, [rdx*4 + 16]", "488b049510000000"),
+    ("mov rax, [8]", "488b042508000000"),
+    ("mov eax, [rsi + 4]", "8b4604"),
+    ("mov ax, [rdi]", "668b07"),
+    ("mov al, [rdi - 129]", "8a877fffffff"),
+    ("mov [rdi + 1], sil", "40887701"),
+    ("mov [rax], r9b", "448808"),
+    ("mov byte [rdi + 3], 7", "c6470307"),
+    ("mov word [rdi], 7", "66c7070700"),
+    ("mov dword [rdi], 7", "c70707000000"),
+    ("mov qword [rbp - 8], -1", "48c745f8ffffffff"),
+    ("mov rax, 5", "b805000000"),  # mov eax, 5: the upper half is zeroed anyway
+    ("mov rax, -1", "48c7c0ffffffff"),
+    ("mov rax, 0x100000000", "48b80000000001000000"),
+    ("mov r10, 0x123456789abc", "49babc9a785634120000"),
+    ("mov ecx, 7", "b907000000"),
+    ("mov cl, 3", "b103"),
+    ("movzx eax, byte [rsi]", "0fb606"),
+    ("movzx rcx, byte [rdi + rax]", "480fb60c07"),
+    ("movzx eax, word [rdi]", "0fb707"),
+    ("movzx eax, al", "0fb6c0"),
+    ("movzx r8d, sil", "440fb6c6"),
+    ("lea rax, [rbp - 8]", "488d45f8"),
+    ("lea r8, [rdi + rax]", "4c8d0407"),
+    ("lea rax, [rax + rax*2]", "488d0440"),
+    ("lea rdx, [rax*8]", "488d14c500000000"),
+    ("push rbp", "55"),
+    ("push r12", "4154"),
+    ("pop rbp", "5d"),
+    ("pop r15", "415f"),
+    ("not rax", "48f7d0"),
+    ("neg rcx", "48f7d9"),
+    ("mul rbx", "48f7e3"),
+    ("div rcx", "48f7f1"),
+    ("idiv r9", "49f7f9"),
+    ("inc rax", "48ffc0"),
+    ("dec qword [rbp - 8]", "48ff4df8"),
+    ("inc byte [rdi]", "fe07"),
+    ("imul rax, rbx", "480fafc3"),
+    ("imul rax, [rbp - 8]", "480faf45f8"),
+    ("imul rax, rcx, 10", "486bc10a"),
+    ("imul r12, r12, 1000", "4d69e4e8030000"),
+    ("shl rax, 3", "48c1e003"),
+    ("shr eax, cl", "d3e8"),
+    ("sar rdx, 63", "48c1fa3f"),
+    ("shl rax, 1", "48d1e0"),
+    ("rol r8, 1", "49d1c0"),
+    ("sete al", "0f94c0"),
+    ("setl cl", "0f9cc1"),
+    ("setne r9b", "410f95c1"),
+    ("cmovne rax, rbx", "480f45c3"),
+    ("cmovl r12, [rbp - 8]", "4c0f4c65f8"),
+    ("bsf eax, eax", "0fbcc0"),
+    ("bsr rcx, rax", "480fbdc8"),
+    ("popcnt rax, rdi", "f3480fb8c7"),
+    ("tzcnt eax, ecx", "f30fbcc1"),
+    ("lzcnt r8, r9", "f34d0fbdc1"),
+    ("syscall", "0f05"),
+    ("ret", "c3"),
+    ("leave", "c9"),
+    ("cqo", "4899"),
+    ("cdq", "99"),
+    ("cdqe", "4898"),
+    ("nop", "90"),
+    ("ud2", "0f0b"),
+    ("movsb", "a4"),
+    ("stosq", "48ab"),
+    ("pxor xmm0, xmm0", "660fefc0"),
+    ("pcmpeqb xmm1, xmm0", "660f74c8"),
+    ("pcmpeqb xmm9, [rdi]", "66440f740f"),
+    ("pminub xmm2, [rsi + 16]", "660fda5610"),
+    ("punpcklbw xmm0, xmm0", "660f60c0"),
+    ("movdqa xmm1, [rdi]", "660f6f0f"),
+    ("movdqu xmm8, [rsi + rcx]", "f3440f6f040e"),
+    ("movdqu [rdi], xmm3", "f30f7f1f"),
+    ("pmovmskb eax, xmm1", "660fd7c1"),
+    ("pmovmskb r10d, xmm12", "66450fd7d4"),
+    ("pshufd xmm0, xmm0, 0", "660f70c000"),
+    ("movd xmm0, eax", "660f6ec0"),
+    ("movq rax, xmm1", "66480f7ec8"),
+    ("movq xmm2, r9", "66490f6ed1"),
+    ("jmp rax", "ffe0"),
+    ("call rax", "ffd0"),
+]
+
+
+def encode(line, symbols=lambda name: 0, addr=0):
+    mnem, _, rest = line.partition(" ")
+    ops = [main.asm_operand(op, "", {}) for op in main.split_operands(rest)]
+    return main.encode_insn(mnem, ops, symbols, addr)
+
+
+@pytest.mark.parametrize("line, expected", GOLDEN, ids=[line for line, _ in GOLDEN])
+def test_golden(line, expected):
+    assert encode(line).hex() == expected
+
+
+def test_relative_operands():
+    assert encode("call f", {"f": 0x401000}.get, 0x400ffb).hex() == "e800000000"
+    assert encode("mov rax, [msg + 8]", {"msg": 0x402010}.get).hex() == "488b042518204000"
+    assert encode("mov rsi, msg", {"msg": 0x402010}.get).hex() == "be10204000"
+
+
+def test_unencodable():
+    for line in ("fld st0", "mov rax, [rsp*2]", "add rax, eax"):
+        with pytest.raises(main.Unencodable):
+            encode(line)
+
+
+def test_branches_widen_to_reach():
+    near = "\n".join(["    nop"] * 100)
+    far = "\n".join(["    nop"] * 200)
+    source = f"""section .text
+global _start
+_start:
+    jmp .near
+{near}
+.near:
+    jz .far
+{far}
+.far:
+    mov eax, 60
+    xor edi, edi
+    syscall"""
+    sections, _, _ = main.parse_asm(source)
+    symbols = {}
+    size, _, short = main.layout(sections[".text"], 0, symbols)
+    assert sorted(short.values()) == [False, True]
+    assert size == 2 + 100 + 6 + 200 + 5 + 2 + 2
+
+
+def test_executable_runs(tmp_path):
+    source = """section .data
+    msg: db "hi", 10, 0
+section .bss
+    count: resq 1
+section .text
+global _start
+_start:
+    mov qword [count], 41
+    inc qword [count]
+    mov eax, 1
+    mov edi, 1
+    mov rsi, msg
+    mov edx, 3
+    syscall
+    mov rdi, [count]
+    mov eax, 60
+    syscall"""
+    path = str(tmp_path / "out")
+    main.write_executable(source, path)
+    result = subprocess.run([path], capture_output=True)
+    assert (result.returncode, result.stdout) == (42, b"hi\n")
+
+
+REGS = {bits: [name for name, (_, size) in main.REGISTERS.items() if size == bits]
+        for bits in (8, 16, 32, 64, 128)}
+
+
+def random_memory(rng):
+    base = rng.choice(REGS[64] + [None])
+    index = rng.choice([r for r in REGS[64] if r != "rsp"] + [None, None])
+    parts = [base] if base else []
+    if index:
+        parts.append(f"{index}*{rng.choice([1, 2, 4, 8])}")
+    disp = rng.choice([0, 8, -8, 127, 128, -129, 4096])
+    if disp or not parts:
+        parts.append(str(disp))
+    return "[" + " + ".join(parts).replace("+ -", "- ") + "]"
+
+
+def random_insn(rng):
+    r64, r32, r8, xmm = REGS[64], REGS[32], REGS[8], REGS[128]
+    gpr = r64 + r32 + REGS[16] + r8
+    return rng.choice([
+        lambda: f"{rng.choice(list(main.ALU_OPS))} {rng.choice(r64)}, {rng.choice(r64)}",
+        lambda: f"{rng.choice(list(main.ALU_OPS))} {rng.choice(r32)}, {rng.choice([5, -3, 1000])}",
+        lambda: f"{rng.choice(list(main.ALU_OPS))} qword {random_memory(rng)}, "
+                f"{rng.choice([5, -300])}",
+        lambda: f"{rng.choice(list(main.ALU_OPS))} {rng.choice(r8)}, {random_memory(rng)}",
+        lambda: f"mov {random_memory(rng)}, {rng.choice(gpr)}",
+        lambda: f"mov {rng.choice(gpr)}, {random_memory(rng)}",
+        lambda: f"mov {rng.choice(['byte', 'word', 'dword', 'qword'])} {random_memory(rng)}, 7",
+        lambda: f"movzx {rng.choice(r64 + r32)}, {rng.choice(['byte', 'word'])} "
+                f"{random_memory(rng)}",
+        lambda: f"lea {rng.choice(r64)}, {random_memory(rng)}",
+        lambda: f"{rng.choice(['push', 'pop'])} {rng.choice(r64)}",
+        lambda: f"{rng.choice(list(main.UNARY_OPS))} {rng.choice(r64 + r32 + r8)}",
+        lambda: f"imul {rng.choice(r64)}, {rng.choice(r64)}, {rng.choice([3, 1000])}",
+        lambda: f"{rng.choice(list(main.SHIFT_OPS))} {rng.choice(r64 + r32 + r8)}, "
+                f"{rng.choice(['cl', '1', '5'])}",
+        lambda: f"{rng.choice(list(main.SSE_OPS))} {rng.choice(xmm)}, "
+                f"{rng.choice(xmm + [random_memory(rng)])}",
+        lambda: f"{rng.choice(list(main.SSE_MOVES))} {rng.choice(xmm)}, {random_memory(rng)}",
+        lambda: f"{rng.choice(list(main.SSE_MOVES))} {random_memory(rng)}, {rng.choice(xmm)}",
+        lambda: f"mov {rng.choice(r32 + r8)}, {rng.choice([1, -1, 100])}",
+        lambda: f"mov {rng.choice(r64)}, {rng.choice([-1, 2**40])}",
+    ])()
+
+
+def gas_syntax(line):
+    for size in ("qword", "dword", "word", "byte"):
+        line = line.replace(f"{size} [", f"{size} ptr [")
+    return line
+
+
+def disassemble(code, path):
+    with open(path, "wb") as f:
+        f.write(code)
+    listing = subprocess.run(["objdump", "-D", "--no-show-raw-insn", "-b", "binary",
+                              "-mi386:x86-64", "-M", "intel", path],
+                             capture_output=True, text=True, check=True).stdout
+    # [r8], [r8*1] and [r8*1 + 0] are the same address
+    return [re.sub(r"\*1\b|\+0x0\]", lambda m: "]" if m[0] == "+0x0]" else "",
+                   line.split("\t")[-1])
+            for line in listing.splitlines() if "\t" in line]
+
+
+@pytest.mark.skipif(not (shutil.which("as") and shutil.which("objdump")),
+                    reason="needs GNU as and objdump")
+def test_matches_gnu_as(tmp_path):
+    """Each random instruction, assembled by as behind its own label;
+    where the bytes differ, both have to disassemble the same"""
+    rng = random.Random(1)
+    lines = [random_insn(rng) for _ in range(2000)]
+    source = ".intel_syntax noprefix\n" + "".join(
+        f"l{i}: {gas_syntax(line)}\n" for i, line in enumerate(lines)) + f"l{len(lines)}:\n"
+    (tmp_path / "t.s").write_text(source)
+    subprocess.run(["as", "--64", "t.s", "-o", "t.o"], cwd=tmp_path, check=True)
+    subprocess.run(["objcopy", "-O", "binary", "-j", ".text", "t.o", "t.bin"], cwd=tmp_path,
+                   check=True)
+    text = (tmp_path / "t.bin").read_bytes()
+    symbols = subprocess.run(["nm", "t.o"], cwd=tmp_path, capture_output=True, text=True,
+                             check=True).stdout
+    offsets = {}
+    for row in symbols.splitlines():
+        value, _, name = row.split()
+        offsets[int(name[1:])] = int(value, 16)
+    differ = []
+    for i, line in enumerate(lines):
+        theirs = text[offsets[i]:offsets[i + 1]]
+        ours = encode(line)
+        if ours != theirs:
+            differ.append((line, ours, theirs))
+    for line, ours, theirs in differ:
+        assert disassemble(ours, os.path.join(tmp_path, "ours")) \
+            == disassemble(theirs, os.path.join(tmp_path, "theirs")), line
@@ -0,0 +1,18 @@
+def test_precedence_parentheses_and_calls(run_program):
+    result = run_program("""import "std.un"
+fn add3(a, b, c)
+    ret a + b * c
+end
+
+fn main(argc, argv)
+    x = argc + 2
+    y = (x + 1) * (x - 1) / 2
+    d = x - (y - (x - (y - (x - (y - (x - (y - (x - (y - (x - y))))))))))
+    e = add3(x, 1, 1) * (y + add3(y, 2, 2)) - add3(1, x, y)
+    if x * 2 > y + 1
+        ret add3(x, y * 2, x - 1) + d + e
+    end
+    ret 0
+end
+""")
+    assert result.returncode == 19 - 6 + 35
@@ -0,0 +1,90 @@
+import main
+
+
+def compile_source(source):
+    return main.compile_to_asm(main.parse_tokens(*main.tokenize(source)))
+
+
+def test_constants_propagate_into_decided_branches():
+    asm = compile_source("""
+fn answer()
+    x = 6
+    y = x * 7
+    if y > 40
+        ret y
+    end
+    ret 0
+end
+""")
+    assert "42" in asm
+    assert "cmp" not in asm and "imul" not in asm
+
+
+def test_folded_division_matches_run_time(run_program):
+    result = run_program("""import "std.un"
+fn main(argc, argv)
+    a = 0 - 7
+    b = a / 2
+    n = 0 - 7 - argc + 1
+    c = n / 2
+    k = 5
+    asm
+        mov rax, 9
+        mov $k, rax
+    end
+    ret b - c + k
+end
+""")
+    assert result.returncode == 9
+
+
+def test_builtins_only_for_the_std_definitions():
+    std = main.tokenize("fn strlen(s)\n    ret 0\nend\nfn strcmp(a, b)\n    ret 0\nend\n")[0]
+    program = main.parse_tokens(*main.tokenize("""
+fn strlen(s)
+    ret 0
+end
+fn strcmp(a, b)
+    ret 0
+end
+fn strcmp(a, b)
+    ret 1
+end
+"""))
+    assert main.std_builtins(std, program) == {"strlen"}
+
+
+def test_user_strlen_takes_precedence(run_program):
+    result = run_program("""fn strlen(s)
+    ret 99
+end
+
+fn _start()
+    n = strlen("abc")
+    asm
+        mov rdi, $n
+        mov rax, 60
+        syscall
+    end
+end
+""")
+    assert result.returncode == 99
+
+
+def test_pure_calls_on_literals(run_program):
+    result = run_program("""import "std.un"
+fn count(s, c)
+    n = 0
+    for i = 0; s[i] != 0; i = i + 1
+        if s[i] == c
+            n = n + 1
+        end
+    end
+    ret n
+end
+
+fn main()
+    ret strlen("hello") * 10 + strcmp("b", "a") + count("banana", 97) * 2
+end
+""")
+    assert result.returncode == 57
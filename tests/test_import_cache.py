@@ -0,0 +1,59 @@
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+from conftest import ROOT
+
+PROGRAM = 'import "lib.un"\nfn main()\n    ret value()\nend\n'
+LIB = 'import "std.un"\nimport "inner.un"\n'
+INNER = "fn value()\n    ret {}\nend\n"
+
+
+@pytest.fixture
+def compile_cached(tmp_path):
+    """Build prog.un with the import cache in tmp_path/cache; returns the
+    exit code of the program and the cache counters the build printed"""
+    if shutil.which("nasm") is None:
+        pytest.skip("nasm is not installed")
+    shutil.copy(os.path.join(ROOT, "std.un"), tmp_path)
+    (tmp_path / "prog.un").write_text(PROGRAM)
+    (tmp_path / "lib.un").write_text(LIB)
+    (tmp_path / "inner.un").write_text(INNER.format(3))
+
+    def run(max_bytes=64 << 20):
+        env = {**os.environ, "UN_CACHE_DIR": str(tmp_path / "cache"), "UN_CACHE_STATS": "1",
+               "UN_CACHE_MAX_BYTES": str(max_bytes)}
+        build = subprocess.run([sys.executable, os.path.join(ROOT, "main.py"), "prog.un"],
+                               cwd=tmp_path, env=env, stderr=subprocess.PIPE, text=True,
+                               check=True)
+        counters = build.stderr.split("import cache: ")[1].split(" (")[0]
+        counters = re.sub(r" \d+ object hits, \d+ object misses,", "", counters)
+        return subprocess.run([str(tmp_path / "out")]).returncode, counters
+    return run
+
+
+def test_hit_after_miss(compile_cached, tmp_path):
+    # lib.un, std.un and inner.un each get an entry; lib.un's covers the others
+    assert compile_cached() == (3, "0 hits, 3 misses, 0 evictions")
+    assert compile_cached() == (3, "1 hits, 0 misses, 0 evictions")
+    for name in os.listdir(tmp_path / "cache"):
+        if name != "stats.json":
+            with open(tmp_path / "cache" / name) as f:
+                entry = json.load(f)
+            assert len(entry["positions"]) == len(entry["tokens"]) > 0
+
+
+def test_changed_nested_import_is_a_miss(compile_cached, tmp_path):
+    compile_cached()
+    (tmp_path / "inner.un").write_text(INNER.format(4))
+    assert compile_cached() == (4, "1 hits, 2 misses, 0 evictions")
+
+
+def test_eviction_past_max_bytes(compile_cached):
+    assert compile_cached(max_bytes=1) == (3, "0 hits, 3 misses, 3 evictions")
+    assert compile_cached(max_bytes=1) == (3, "0 hits, 3 misses, 3 evictions")
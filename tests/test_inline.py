@@ -0,0 +1,36 @@
+import main
+
+
+def test_callee_locals_are_renamed(run_program):
+    result = run_program("""import "std.un"
+fn five()
+    asm
+        mov qword $v, 5
+    end
+    ret v
+end
+fn main(argc, argv)
+    asm
+        mov qword $v, 100
+    end
+    x = five()
+    ret v + x
+end
+""")
+    assert result.returncode == 105
+
+
+def test_dropped_results_leave_no_statement():
+    program = main.inline_program(main.parse_tokens(*main.tokenize("""
+mem counter 8
+fn bump(n)
+    counter[0] = counter[0] + n
+    ret 0
+end
+fn main(argc, argv)
+    bump(argc)
+    ret 0
+end
+""")))
+    body = next(node for node in program if node[1] == "main")[3]
+    assert [node[0] for node in body] == ["store", "ret"]
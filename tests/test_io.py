@@ -0,0 +1,22 @@
+import pytest
+
+
+@pytest.mark.parametrize("size", [0, 4096, 10000])
+def test_map_file(run_program, tmp_path, size):
+    data = bytes(b"0123456789abcdef\n"[i % 17] for i in range(size))
+    path = tmp_path / "data.txt"
+    path.write_bytes(data)
+    result = run_program(f"""import "std.un"
+import "io.un"
+fn main()
+    size = 0
+    data = map_file("{path}", &size)
+    buffered_write(1, data, size)
+    munmap(data, size)
+    missing = 0
+    map_file("{path}.missing", &missing)
+    ret 0 - missing
+end
+""")
+    assert result.stdout == data
+    assert result.returncode == 1
@@ -0,0 +1,46 @@
+import re
+
+import pytest
+
+import main
+
+
+@pytest.mark.parametrize("flags", [(), ("--no-loop-opt",)], ids=["loop-opt", "no-loop-opt"])
+def test_loops(run_program, flags):
+    result = run_program("""import "std.un"
+mem buf 64
+fn main(argc, argv)
+    n = argc + 39
+    for i = 0; i < n; i = i + 1
+        buf[i] = i
+    end
+    total = 0
+    for i = 0; i < n; i = i + 2
+        total = total + buf[i] + i * 3
+    end
+    s = "abcdef"
+    k = 0
+    for j = 0; s[j] != 0; j = j + 1
+        k = k + 1
+    end
+    for m = 0; m < 0; m = m + 1
+        k = 0
+    end
+    ret total / 10 + k
+end
+""", *flags)
+    assert result.returncode == 1520 // 10 + 6
+
+
+def test_products_of_the_counter_are_derived():
+    asm = main.compile_to_asm(main.parse_tokens(*main.tokenize("""
+fn sum(n)
+    t = 0
+    for i = 0; i < n; i = i + 1
+        t = t + i * 12
+    end
+    ret t
+end
+""")))
+    loop = re.search(r"\.for_start_\d+:(.*)\.for_end_\d+:", asm, re.S).group(1)
+    assert "imul" not in loop and "add r" in loop and ", 12\n" in loop
@@ -0,0 +1,25 @@
+import main
+
+
+def test_whole_identifiers_outside_strings():
+    defines = {"N": "4", "M": "N + N", "LOOP": "LOOP + 1"}
+    assert main.expand_macros('x = N + NAME + M "N"', defines) == 'x = 4 + NAME + 4 + 4 "N"'
+    assert main.expand_macros("y = LOOP", defines) == "y = LOOP + 1"
+
+
+def test_defines_across_imports_but_not_in_asm(run_program, tmp_path):
+    (tmp_path / "sizes.un").write_text("#define WIDTH 3\n#define AREA WIDTH * WIDTH\n"
+                                       "#define rdx WIDTH\n")
+    result = run_program("""import "std.un"
+import "sizes.un"
+fn main()
+    WIDTHS = AREA + 1
+    n = 0
+    asm
+        mov rdx, 7
+        mov $n, rdx
+    end
+    ret WIDTHS + n
+end
+""")
+    assert result.returncode == 17
@@ -0,0 +1,116 @@
+import subprocess
+import sys
+
+import pytest
+
+import main
+from conftest import ROOT
+
+NAME = """import "std.un"
+
+fn name(op)
+    match op
+    case 0
+        ret "zero "
+    case 1, 2
+        ret "small "
+    case 3
+        ret "three "
+    case 4
+        ret "four "
+    case 6
+        ret "six "
+    case 100, 0 - 5
+        ret "far "
+    case 1000000000000
+        ret "huge "
+    else
+        ret "other "
+    end
+end
+
+fn main(argc, argv)
+    for i = 0 - 6; i < 8; i = i + argc
+        print name(i)
+    end
+    print name(100)
+    print name(1000000000000)
+    ret 0
+end
+"""
+
+EXPECTED = (b"other far other other other other zero small small three four other six other "
+            b"far huge ")
+
+
+def compile_source(source):
+    main.fn_inline.clear()
+    main.fn_exported.clear()
+    return main.compile_to_asm(main.parse_tokens(*main.tokenize(source)))
+
+
+@pytest.mark.parametrize("flags", [(), ("--no-inline",), ("--no-peephole",)])
+def test_match_picks_the_case_of_the_value(run_program, flags):
+    assert run_program(NAME, *flags).stdout == EXPECTED
+
+
+def test_sparse_values_and_no_else(run_program):
+    result = run_program("""import "std.un"
+fn count(x)
+    r = 0
+    match x
+    case 10
+        r = 1
+    case 200
+        r = 2
+    case 3000
+        r = 3
+    case 40000
+        r = 4
+    case 500000
+        r = 5
+    end
+    ret r
+end
+fn main(argc, argv)
+    t = 0
+    for i = 0; i < 600000; i = i + argc
+        t = t + count(i)
+    end
+    if t == 15
+        print "ok"
+    end
+    ret 0
+end
+""")
+    assert result.stdout == b"ok"
+
+
+def test_dense_values_get_a_jump_table_and_sparse_ones_compares():
+    dense = "".join(f"    case {k}\n        r = {k + 1}\n" for k in range(8))
+    sparse = "".join(f"    case {k * 1000}\n        r = {k + 1}\n" for k in range(8))
+    template = "noinline fn f(x)\n    r = 0\n    match x\n{}    end\n    ret r\nend\n"
+    asm = compile_source(template.format(dense))
+    assert "    jmp [.match_table_0_0 + rax*8]" in asm
+    assert asm.count(".match_case_0_") == 16  # one table slot and one label each
+    asm = compile_source(template.format(sparse))
+    assert "match_table" not in asm
+    assert asm.count("    cmp rax, ") == 8
+
+
+def test_constant_subject_is_folded():
+    asm = compile_source("fn f\n    match 2\n    case 1\n        ret 10\n    case 2\n"
+                         "        ret 20\n    end\n    ret 0\nend\n")
+    assert "match" not in asm and "mov rax, 20" in asm
+
+
+@pytest.mark.parametrize("source, message", [
+    ("fn f(x)\n    match x\n    case 1, 1\n    end\nend\n", "duplicate case value 1"),
+    ("fn f(x)\n    match x\n    case x\n    end\nend\n", "case values must be constants"),
+    ("fn f(x)\n    match x\n    ret 1\n    end\nend\n", "expected case"),
+])
+def test_bad_match(tmp_path, source, message):
+    (tmp_path / "bad.un").write_text(source)
+    result = subprocess.run([sys.executable, f"{ROOT}/main.py", "bad.un"], cwd=tmp_path,
+                            stderr=subprocess.PIPE, text=True)
+    assert result.returncode == 1 and message in result.stderr
@@ -0,0 +1,33 @@
+def test_regions_grow_align_and_restore(run_program):
+    result = run_program("""import "std.un"
+import "mem.un"
+fn main()
+    bad = 0
+    r = region_new(100)
+    first = region_alloc(r, 24)
+    mark = region_mark(r)
+    for i = 0; i < 2000; i = i + 1
+        p = region_alloc(r, 100)
+        if p - p / 16 * 16 != 0
+            bad = bad + 1
+        end
+        p[0] = 1
+        p[99] = 7
+    end
+    q = region_alloc_aligned(r, 10, 4096)
+    if q - q / 4096 * 4096 != 0
+        bad = bad + 1
+    end
+    region_restore(r, mark)
+    if region_alloc(r, 24) != first + 32
+        bad = bad + 1
+    end
+    region_reset(r)
+    if region_alloc(r, 24) != first
+        bad = bad + 1
+    end
+    region_free(r)
+    ret bad
+end
+""")
+    assert result.returncode == 0
@@ -0,0 +1,41 @@
+import os
+import shutil
+
+import main
+from conftest import ROOT
+
+FUNCTION = """
+noinline fn f{i}(n)
+    t = 0
+    for k = 0; k < n; k = k + 1
+        if k == {i}
+            print "hit {tag}\\n"
+        end
+        t = t + k
+    end
+    ret f{next}(t)
+end
+"""
+
+
+def compile_source(source, jobs):
+    main.fn_inline.clear()
+    main.fn_exported.clear()
+    program = main.parse_tokens(*main.tokenize(main.preprocess_and_import(source)))
+    main.codegen_jobs = jobs
+    try:
+        return main.compile_to_asm(program)
+    finally:
+        main.codegen_jobs = 1
+
+
+def test_pool_output_matches_serial(tmp_path, monkeypatch):
+    shutil.copy(os.path.join(ROOT, "std.un"), tmp_path)
+    monkeypatch.chdir(tmp_path)
+    functions = 2 * main.PARALLEL_MIN_FNS
+    source = 'import "std.un"\n' + "".join(
+        FUNCTION.format(i=i, tag=i % 7, next=(i + 1) % functions) for i in range(functions))
+    source += 'fn main\n    print "hit 3\\n"\n    ret f0(2)\nend\n'
+    serial = compile_source(source, 1)
+    assert compile_source(source, 3) == serial
+    assert serial.count("_str") > 7 and "_str?" not in serial
@@ -0,0 +1,45 @@
+import os
+import subprocess
+import sys
+
+from conftest import ROOT
+
+
+def test_scoping_mem_blocks_and_fall_through(run_program):
+    result = run_program("""import "std.un"
+mem
+    buf 16
+    count 8
+end
+
+fn greet()
+    s = "hi\\n"
+    print s
+end
+
+fn part()
+    s = "bye\\n"
+    print s
+    ret 0
+end
+
+fn main()
+    greet()
+    part()
+    count = 5
+    buf[0] = 65
+    buf[1] = 10
+    print buf
+    ret count
+end
+""")
+    assert result.stdout == b"hi\nbye\nA\n"
+    assert result.returncode == 5
+
+
+def test_parse_error_has_a_position(tmp_path):
+    (tmp_path / "bad.un").write_text("fn main()\n    x =\nend\n")
+    result = subprocess.run([sys.executable, os.path.join(ROOT, "main.py"), "bad.un"],
+                            cwd=tmp_path, stderr=subprocess.PIPE, text=True)
+    assert result.returncode == 1
+    assert result.stderr.startswith("bad.un:2:")
@@ -0,0 +1,78 @@
+import pytest
+
+import main
+
+
+def indent(lines):
+    return [line if line.endswith(":") else f"    {line}" for line in lines]
+
+
+def optimize(lines):
+    return main.peephole(indent(lines))
+
+
+def test_store_reload():
+    assert optimize(["mov [rbp - 8], rax", "mov rax, [rbp - 8]"]) == indent(["mov [rbp - 8], rax"])
+
+
+def test_32_bit_round_trip_kept():
+    # each 32-bit mov zeroes the upper half of its destination
+    for lines in (["mov eax, ebx", "mov ebx, eax"], ["mov [rbp - 8], eax", "mov eax, [rbp - 8]"]):
+        assert optimize(lines) == indent(lines)
+    assert optimize(["mov rax, rbx", "mov rbx, rax"]) == indent(["mov rax, rbx"])
+
+
+def test_reload_through_loaded_register_kept():
+    lines = ["mov rax, [rax + 8]", "mov [rax + 8], rax"]
+    assert optimize(lines) == indent(lines)
+    lines = ["mov eax, [rax]", "mov [rax], eax"]
+    assert optimize(lines) == indent(lines)
+
+
+def test_unreachable_stops_at_label_with_instruction():
+    lines = ["jmp .top", "xor eax, eax", ".top: inc rax", "ret"]
+    assert optimize(lines) == indent(["jmp .top", ".top: inc rax", "ret"])
+
+
+def test_unreachable_keeps_data():
+    lines = ["jmp .after", "table dq 1, 2", "db 0", "align 8", ".after:"]
+    assert optimize(lines) == indent(lines)
+
+
+ASM_RELOAD = """import "std.un"
+mem cell 32
+fn main
+    r = 0
+    asm
+        mov rax, cell
+        lea rdx, [rax + 16]
+        mov [rax + 8], rdx
+        mov rax, [rax + 8]
+        mov [rax + 8], rax
+        mov rax, [cell + 24]
+        sub rax, cell
+        sub rax, 15
+        mov $r, rax
+    end
+    ret r
+end
+"""
+
+ASM_LABEL = """import "std.un"
+fn main
+    n = 0
+    asm
+        xor eax, eax
+        jmp .count_top
+    .count_top: inc rax
+        mov $n, rax
+    end
+    ret n
+end
+"""
+
+
+@pytest.mark.parametrize("source", [ASM_RELOAD, ASM_LABEL], ids=["reload", "label"])
+@pytest.mark.parametrize("flags", [(), ("--no-peephole",)], ids=["peephole", "no-peephole"])
+def test_asm_blocks(run_program, source, flags):
+    assert run_program(source, *flags).returncode == 1
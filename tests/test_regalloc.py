@@ -0,0 +1,33 @@
+import main
+
+
+def test_lowest_weight_interval_stays_on_the_stack():
+    intervals = {"cold": [0, 10, 1]}
+    intervals.update({f"hot{i}": [i + 1, 10, 100] for i in range(4)})
+    assigned = main.linear_scan(intervals, main.ALLOC_REGS)
+    assert "cold" not in assigned
+    assert sorted(assigned.values()) == sorted(main.ALLOC_REGS)
+
+
+def test_spilled_locals_and_asm_clobbers(run_program):
+    result = run_program("""import "std.un"
+fn main(argc, argv)
+    a = argc
+    b = a + 1
+    c = b + 1
+    d = c + 1
+    e = d + 1
+    f = 0
+    for i = 0; i < 10; i = i + 1
+        f = f + a + b + c + d + e
+    end
+    n = 0
+    asm
+        mov r12, 99
+        mov r13, 99
+        mov $n, r12
+    end
+    ret f + n - 99
+end
+""")
+    assert result.returncode == 150
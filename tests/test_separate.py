@@ -0,0 +1,44 @@
+import os
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+from conftest import ROOT
+
+PROGRAM = """#define VALUE {}
+import "lib.un"
+fn main()
+    store(VALUE)
+    x = shared[0]
+    ret x
+end
+"""
+LIB = """import "std.un"
+mem shared 8
+fn store(v)
+    shared[0] = v
+    ret 0
+end
+"""
+
+
+def test_modules_link_and_reuse_objects(tmp_path):
+    if shutil.which("nasm") is None:
+        pytest.skip("nasm is not installed")
+    shutil.copy(os.path.join(ROOT, "std.un"), tmp_path)
+    (tmp_path / "lib.un").write_text(LIB)
+    env = {**os.environ, "UN_CACHE_DIR": str(tmp_path / "cache"), "UN_CACHE_STATS": "1"}
+
+    def build(value):
+        (tmp_path / "prog.un").write_text(PROGRAM.format(value))
+        result = subprocess.run([sys.executable, os.path.join(ROOT, "main.py"), "--separate",
+                                 "prog.un"], cwd=tmp_path, env=env, stderr=subprocess.PIPE,
+                                text=True, check=True)
+        counters = result.stderr.split("misses, ")[1].split(", ")[:2]
+        return subprocess.run([str(tmp_path / "out")]).returncode, counters
+
+    assert build(5) == (5, ["0 object hits", "3 object misses"])
+    assert build(5) == (5, ["3 object hits", "0 object misses"])
+    assert build(6) == (6, ["2 object hits", "1 object misses"])
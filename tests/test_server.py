@@ -0,0 +1,70 @@
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+from conftest import ROOT
+
+MAIN = os.path.join(ROOT, "main.py")
+PROGRAM = 'import "std.un"\nfn main\n    print "{}\\n"\nend\n'
+
+
+def setup(tmp_path):
+    for name in ("std.un", "io.un", "mem.un"):
+        shutil.copy(os.path.join(ROOT, name), tmp_path)
+    (tmp_path / "one.un").write_text(PROGRAM.format("one"))
+    (tmp_path / "two.un").write_text(PROGRAM.format("two"))
+    (tmp_path / "bad.un").write_text("fn main\n    x =\nend\n")
+    return {**os.environ, "UN_CACHE_DIR": str(tmp_path / "cache")}
+
+
+def test_batch_writes_each_executable_beside_its_file(tmp_path):
+    env = setup(tmp_path)
+    result = subprocess.run([sys.executable, MAIN, "--backend", "builtin", "one.un", "bad.un",
+                             "two.un"], cwd=tmp_path, env=env, stderr=subprocess.PIPE, text=True)
+    assert result.returncode == 1
+    assert result.stderr.startswith("bad.un:2:")
+    for name in ("one", "two"):
+        assert subprocess.run([str(tmp_path / name)], stdout=subprocess.PIPE).stdout == \
+            f"{name}\n".encode()
+    assert not (tmp_path / "out").exists()
+
+
+def test_failing_tools_fail_the_build(tmp_path):
+    env = setup(tmp_path)
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    for tool, script in (("nasm", 'touch "$4"'), ("ld", "exit 1")):
+        (bin_dir / tool).write_text(f"#!/bin/sh\n{script}\n")
+        (bin_dir / tool).chmod(0o755)
+    env["PATH"] = f"{bin_dir}:{env['PATH']}"
+    result = subprocess.run([sys.executable, MAIN, "one.un", "two.un"], cwd=tmp_path, env=env,
+                            stderr=subprocess.PIPE, text=True)
+    assert result.returncode == 1
+    assert result.stderr.splitlines() == ["one.un: ld failed", "two.un: ld failed"]
+
+
+def test_server_builds_in_the_client_directory(tmp_path):
+    env = setup(tmp_path)
+    sock = str(tmp_path / "sock")
+    server = subprocess.Popen([sys.executable, MAIN, "--server", sock], env=env)
+    try:
+        while not os.path.exists(sock):
+            time.sleep(0.01)
+
+        def connect(*argv):
+            return subprocess.run([sys.executable, MAIN, "--connect", sock, "--backend",
+                                   "builtin", *argv], cwd=tmp_path, stderr=subprocess.PIPE,
+                                  text=True)
+        for name in ("one", "two", "one"):
+            assert connect("-o", name, f"{name}.un").returncode == 0
+            assert subprocess.run([str(tmp_path / name)], stdout=subprocess.PIPE).stdout == \
+                f"{name}\n".encode()
+        result = connect("bad.un")
+        assert result.returncode == 1 and result.stderr.startswith("bad.un:2:")
+        assert connect("one.un").returncode == 0  # still serving after an error
+    finally:
+        server.terminate()
+        server.wait()
+    assert not os.path.exists(sock)
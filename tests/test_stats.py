@@ -0,0 +1,56 @@
+import json
+import os
+import re
+import subprocess
+import sys
+
+import main
+from conftest import ROOT
+
+PROGRAM = """fn _start()
+    s = "hi"
+    for i = 0; i < 3; i = i + 1
+        asm
+            nop
+        end
+    end
+    asm
+{extra}        mov rax, 60
+        xor rdi, rdi
+        syscall
+    end
+end
+"""
+
+
+def test_report_shapes(tmp_path):
+    (tmp_path / "prog.un").write_text(PROGRAM.format(extra=""))
+    result = subprocess.run([sys.executable, os.path.join(ROOT, "main.py"), "--backend", "builtin",
+                             "--time-passes", "--stats", "--stats-json", "-", "prog.un"],
+                            cwd=tmp_path, capture_output=True, text=True, check=True,
+                            env={**os.environ, "UN_CACHE": "0"})
+    report = json.loads(result.stdout)
+    assert list(report["phases"]) == ["preprocess", "tokenize", "parse", "inline", "fold",
+                                      "dead-fn", "loops", "pass1", "pass2", "data", "encode"]
+    for phase in report["phases"].values():
+        assert set(phase) == {"seconds", "peak_rss_kib"} and phase["peak_rss_kib"] > 0
+    stats = report["stats"]
+    assert stats["functions"] == 1 and stats["stack_slots"] == {"_start": 1}
+    assert stats["string_literals"] == 1 and stats["mem_bytes"] == 0
+    assert stats["executable_bytes"] == os.path.getsize(tmp_path / "out")
+
+    lines = result.stderr.splitlines()
+    times = [line for line in lines if line.startswith("time ")]
+    assert len(times) == len(report["phases"])
+    assert all(re.fullmatch(r"time [\w-]+: \d+\.\d ms, peak \d+\.\d MiB", line) for line in times)
+    assert f"stats instructions: {stats['instructions']}" in lines
+    assert "stats stack slots _start: 1" in lines
+
+
+def test_directives_are_not_instructions():
+    counts = []
+    for extra in ("", "        align 16\n        dq 0\n"):
+        main.compile_stats.clear()
+        main.compile_to_asm(main.parse_tokens(*main.tokenize(PROGRAM.format(extra=extra))))
+        counts.append(main.compile_stats["instructions"])
+    assert counts[0] == counts[1]
@@ -0,0 +1,26 @@
+def test_stdout_and_stderr_stay_in_order(run_program):
+    result = run_program("""import "std.un"
+fn main
+    print "head "
+    eprint "err\\n"
+    print "tail"
+    eprint "!"
+    ret 0
+end
+""")
+    assert result.stdout == b"head err\ntail!"
+
+
+def test_stderr_written_before_a_crash(run_program):
+    result = run_program("""import "std.un"
+fn main
+    print "lost"
+    eprint "err\\n"
+    asm
+        ud2
+    end
+    ret 0
+end
+""")
+    assert result.returncode < 0
+    assert result.stdout == b"lost" + b"err\n"
@@ -0,0 +1,58 @@
+def test_every_length_and_alignment(run_program):
+    result = run_program("""import "std.un"
+mem a 64
+mem b 64
+
+fn fill(p, len, last)
+    for i = 0; i < len; i = i + 1
+        p[i] = 120
+    end
+    if len > 0
+        j = len - 1
+        p[j] = last
+    end
+    p[len] = 0
+    ret 0
+end
+
+fn main()
+    bad = 0
+    for off = 0; off < 16; off = off + 1
+        for len = 0; len < 40; len = len + 1
+            s = a + off
+            t = b + 15 - off
+            fill(s, len, 120)
+            fill(t, len, 120)
+            if strlen(s) != len
+                bad = bad + 1
+            end
+            if memchr(s, 0, len + 1) != s + len
+                bad = bad + 1
+            end
+            if memchr(s, 121, len) != 0
+                bad = bad + 1
+            end
+            if strcmp(s, t) != 0
+                bad = bad + 1
+            end
+            if memcmp(s, t, len) != 0
+                bad = bad + 1
+            end
+            if len > 0
+                fill(t, len, 121)
+                if strcmp(s, t) != 0 - 1
+                    bad = bad + 1
+                end
+                if memcmp(s, t, len) != 0 - 1
+                    bad = bad + 1
+                end
+                if memchr(t, 121, len) != t + len - 1
+                    bad = bad + 1
+                end
+            end
+        end
+    end
+    ret bad
+end
+""")
+    assert result.returncode == 0
@@ -0,0 +1,185 @@
+import signal
+
+import main
+
+
+def compile_source(source):
+    main.fn_inline.clear()
+    main.fn_exported.clear()
+    return main.compile_to_asm(main.parse_tokens(*main.tokenize(source)))
+
+
+def rodata(asm):
+    section = asm.split("section .rodata\n")[1]
+    return section.split("\n\n")[0].split("\n")
+
+
+def test_equal_strings_share_a_label_and_tails_are_merged():
+    asm = compile_source("""
+noinline fn show(s)
+    asm
+        mov rax, $s
+    end
+end
+fn main
+    a = "hello world\\n"
+    c = "hello world\\n"
+    show("world\\n")
+    show("\\n")
+    ret a[0] + c[1]
+end
+""")
+    assert rodata(asm) == ['    _str0: db "hello "', '    _str1: db "world"',
+                           "    _str2: db 10, 0"]
+    assert "section .data" not in asm
+
+
+def test_named_strings_read_by_callees_are_shared():
+    asm = compile_source("""
+noinline fn show(s)
+    asm
+        mov rsi, $s
+        mov al, [rsi]
+    end
+end
+fn main
+    a = "hello\\n"
+    b = "hello\\n"
+    c = "llo\\n"
+    show(a)
+    show(b)
+    show(c)
+    ret 0
+end
+""")
+    assert rodata(asm) == ['    _str0: db "he"', '    _str1: db "llo", 10, 0']
+    assert asm.count("mov rdi, _str0") == 2
+    assert "section .data" not in asm
+
+
+def test_strlen_of_a_named_literal_is_its_length_constant(monkeypatch):
+    monkeypatch.setattr(main, "builtin_fns", {"strlen"})
+    asm = compile_source("""
+noinline fn strlen(s)
+    asm
+        mov rsi, $s
+        mov al, [rsi]
+    end
+    ret 0
+end
+fn main
+    a = "hello\\n"
+    b = "bye\\n"
+    ret strlen(a) + strlen(b)
+end
+""")
+    assert rodata(asm) == ['    _str0: db "hello", 10, 0', "    _str0_len equ 6",
+                           '    _str1: db "bye", 10, 0', "    _str1_len equ 4"]
+    assert "call strlen" not in asm.split("main:")[1]
+
+
+def test_literal_arguments_of_inlined_calls_stay_read_only():
+    asm = compile_source("""
+noinline fn show(s)
+    asm
+        mov rax, $s
+    end
+end
+fn put(s)
+    show(s)
+    ret 0
+end
+fn main
+    put("hi\\n")
+    put("hi\\n")
+    ret 0
+end
+""")
+    assert rodata(asm) == ['    _str0: db "hi", 10, 0']
+    assert "section .data" not in asm
+
+
+def test_string_written_into_gets_its_own_bytes(run_program):
+    result = run_program("""import "std.un"
+fn main
+    s = "abc\\n"
+    t = "abc\\n"
+    s[0] = 65
+    print s
+    print t
+    ret 0
+end
+""")
+    assert result.stdout == b"Abc\nabc\n"
+
+
+def test_literals_are_read_only(run_program):
+    result = run_program("""import "std.un"
+noinline fn poke(p)
+    p[0] = 65
+    ret 0
+end
+fn main
+    print "before\\n"
+    flush()
+    poke("abc")
+    ret 0
+end
+""")
+    assert result.stdout == b"before\n"
+    assert result.returncode == -signal.SIGSEGV
+
+
+def test_string_passed_to_a_writing_callee_gets_its_own_bytes(run_program):
+    result = run_program("""import "std.un"
+noinline fn upcase(p)
+    for i = 0; p[i] != 0; i = i + 1
+        if p[i] >= 97
+            p[i] = p[i] - 32
+        end
+    end
+    ret 0
+end
+fn main
+    s = "hello\\n"
+    upcase(s)
+    print s
+    ret 0
+end
+""")
+    assert result.stdout == b"HELLO\n" and result.returncode == 0
+
+
+def test_strings_written_through_asm_calls_and_copies_get_their_own_bytes(run_program):
+    result = run_program("""import "std.un"
+noinline fn poke(p, c)
+    asm
+        mov rdi, $p
+        mov rax, $c
+        mov [rdi], al
+    end
+end
+noinline fn poke_via(p)
+    poke(p + 1, 69)
+    ret 0
+end
+noinline fn same(p)
+    ret p
+end
+fn main
+    a = "hello\\n"
+    b = "hello\\n"
+    c = "hello\\n"
+    d = "hello\\n"
+    poke(a, 72)
+    poke_via(b)
+    t = same(c)
+    t[4] = 79
+    print a
+    print b
+    print c
+    print d
+    ret 0
+end
+""")
+    assert result.stdout == b"Hello\nhEllo\nhellO\nhello\n" and result.returncode == 0
@@ -0,0 +1,19 @@
+def test_comments_escapes_and_asm_lines(run_program):
+    result = run_program("""import "std.un"
+; a comment line, even with "quotes" and asm in it
+fn main()
+    msg = "a\\tb=c; d\\n"
+    print msg
+    n = 0
+    asm
+        mov rax, 7 ; kept verbatim
+        mov $n, rax
+    end
+    if n != 7
+        ret 1
+    end
+    ret n
+end
+""")
+    assert result.stdout == b"a\tb=c; d\n"
+    assert result.returncode == 7